@@ -0,0 +1,288 @@
+"""
+Offline benchmark of the inference UDFs against the local mock OpenAI-compatible server.
+
+Each (target, rows) case runs in its own subprocess so peak RSS is measured per case. The
+mock server runs in this process, which also reports how many requests the client kept in
+flight. For example:
+ python benchmarks/bench_structured_outputs.py --rows 100 1000 10000 --latency-ms 20 --output bench.json
+With `--replicas N`, N mock servers are started and prod_udf balances requests across them.
+The `--max-in-flight`, `--min-in-flight`, `--min-rows-per-s` and `--min-scaling` thresholds
+fail the run on scaling regressions, see `check_thresholds`.
+
+Targets:
+ - prod_udf: `StructuredOutputsProdUDF` from the workload script
+ - prod_udf_http: `StructuredOutputsProdUDF` with `transport="http"`, bypassing the OpenAI SDK
+ - llm_generate: `daft.functions.llm_generate` with the openai provider (text only)
+ - friction_function_udf: `image_inference_no_concurrency` from friction/issue_5088_mre.py
+ - friction_class_udf: `ImageInferenceWithConcurrencyClassUDF` from friction/issue_5088_mre.py
+ - friction_concurrency_udf: `image_inference_with_concurrency`, expected to fail (issue 5088)
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ("prod_udf", "prod_udf_http", "llm_generate", "friction_function_udf", "friction_class_udf", "friction_concurrency_udf")
+# Targets that are known to fail and are reported rather than counted as regressions
+EXPECTED_FAILURES = ("friction_concurrency_udf",)
+# Targets that cap the requests they keep in flight, see `--max-in-flight`
+BOUNDED_TARGETS = ("prod_udf", "prod_udf_http")
+CHOICES = ["A", "B", "C", "D"]
+
+
+def make_rows(num_rows: int, image_kb: int) -> list[dict[str, Any]]:
+    import base64
+
+    image = base64.b64encode(os.urandom(image_kb * 1024)).decode("utf-8")
+    return [
+        {"question": f"Question {i}: which option is correct?", "choices_string": "A. w\nB. x\nC. y\nD. z", "image_base64": image}
+        for i in range(num_rows)
+    ]
+
+
+def run_case(target: str, num_rows: int, base_url: str, image_kb: int) -> dict[str, Any]:
+    """Runs one target over `num_rows` rows in this process and returns its measurements.
+
+    `base_url` may list several comma-separated replicas, which only prod_udf balances across.
+    """
+    endpoints = base_url.split(",")
+    base_url = endpoints[0]
+    import daft
+    from daft import col
+    from daft.functions import format
+
+    df = daft.from_pylist(make_rows(num_rows, image_kb))
+    prompt = format("{} \n {}", col("question"), col("choices_string"))
+    image_url = format("data:image/png;base64,{}", col("image_base64"))
+
+    if target in ("prod_udf", "prod_udf_http"):
+        import structured_outputs_workload as workload
+
+        workload.get_metrics().reset()
+        result = workload.StructuredOutputsProdUDF.with_init_args(
+            base_url=base_url,
+            api_key="none",
+            endpoints=endpoints if len(endpoints) > 1 else None,
+            transport="http" if target == "prod_udf_http" else "sdk",
+        )(
+            model_id="mock-model",
+            text_col=prompt,
+            image_col=col("image_base64"),
+            sampling_params={"temperature": 0.0},
+            extra_body={"guided_choice": CHOICES},
+        ).struct.get("result")
+    elif target == "llm_generate":
+        from daft.functions import llm_generate
+
+        result = llm_generate(
+            prompt, model="mock-model", provider="openai", base_url=base_url, api_key="none",
+            extra_body={"guided_choice": CHOICES},
+        )
+    else:
+        import issue_5088_mre as friction
+        from openai import AsyncOpenAI
+
+        friction.client = AsyncOpenAI(base_url=base_url, api_key="none")
+        if target == "friction_function_udf":
+            result = friction.image_inference_no_concurrency("mock-model", prompt, image_url)
+        elif target == "friction_class_udf":
+            result = friction.ImageInferenceWithConcurrencyClassUDF.with_init_args(base_url=base_url, api_key="none")(
+                "mock-model", prompt, image_url
+            )
+        elif target == "friction_concurrency_udf":
+            result = friction.image_inference_with_concurrency("mock-model", prompt, image_url)
+        else:
+            raise ValueError(f"Unknown target {target!r}")
+
+    start = time.perf_counter()
+    error = None
+    completed = 0
+    try:
+        completed = sum(r is not None for r in df.with_column("result", result).select("result").to_pydict()["result"])
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"[:500]
+    elapsed = time.perf_counter() - start
+
+    measurement = {
+        "target": target,
+        "rows": num_rows,
+        "completed": completed,
+        "seconds": elapsed,
+        "rows_per_s": completed / elapsed if elapsed > 0 else None,
+        "peak_rss_mb": (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        ) / 1024,
+        "error": error,
+    }
+    if target in ("prod_udf", "prod_udf_http"):
+        requests = workload.get_metrics().report()["requests"]
+        measurement.update({
+            k: requests[k] for k in ("latency_p50_s", "latency_p90_s", "latency_p99_s", "latency_max_s", "new_connections")
+        })
+    return measurement
+
+
+def run_benchmarks(
+    targets: list[str],
+    row_counts: list[int],
+    config: MockServerConfig,
+    image_kb: int = 4,
+    timeout_s: float = 600,
+    replicas: int = 1,
+) -> list[dict[str, Any]]:
+    """Runs every (target, rows) case in a subprocess against `replicas` mock servers."""
+    # Daft runs class UDFs in worker processes, which import the UDF modules from PYTHONPATH
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(REPO_ROOT, "workload"), os.path.join(REPO_ROOT, "friction")]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    results = []
+    with contextlib.ExitStack() as stack:
+        servers = [stack.enter_context(MockOpenAIServer(config)) for _ in range(replicas)]
+        env["WORKLOAD_METRICS_DIR"] = stack.enter_context(tempfile.TemporaryDirectory())
+        base_url = ",".join(server.base_url for server in servers)
+        for target in targets:
+            for num_rows in row_counts:
+                for server in servers:
+                    server.reset_stats()
+                command = [
+                    sys.executable, os.path.abspath(__file__), "--case", target, "--rows", str(num_rows),
+                    "--base-url", base_url, "--image-kb", str(image_kb),
+                ]
+                # CPU of the case process and its UDF workers, including Daft startup
+                cpu_before = cpu_s(resource.getrusage(resource.RUSAGE_CHILDREN))
+                try:
+                    proc = subprocess.run(command, capture_output=True, text=True, timeout=timeout_s, env=env)
+                    lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+                    result = json.loads(lines[-1]) if lines else {
+                        "target": target, "rows": num_rows, "error": proc.stderr.strip()[-500:] or "no output",
+                    }
+                    result["cpu_s"] = cpu_s(resource.getrusage(resource.RUSAGE_CHILDREN)) - cpu_before
+                    if result.get("completed"):
+                        result["cpu_ms_per_row"] = result["cpu_s"] * 1000 / result["completed"]
+                except subprocess.TimeoutExpired:
+                    result = {"target": target, "rows": num_rows, "error": f"timed out after {timeout_s}s"}
+                result["expected_failure"] = target in EXPECTED_FAILURES
+                stats = [server.stats() for server in servers]
+                result["server"] = {key: sum(stat[key] for stat in stats) for key in stats[0]}
+                if replicas > 1:
+                    result["replica_requests"] = [stat["requests"] for stat in stats]
+                results.append(result)
+                print(format_result(result), file=sys.stderr)
+    return results
+
+
+def check_thresholds(
+    results: list[dict[str, Any]],
+    max_in_flight: int | None = None,
+    min_in_flight: int | None = None,
+    min_rows_per_s: float | None = None,
+    min_scaling: float | None = None,
+) -> list[str]:
+    """Returns a message for every successful case that breaks a threshold.
+
+    Args:
+        max_in_flight: Cap on the requests the server saw in flight at once for
+            `BOUNDED_TARGETS`, which an unbounded gather exceeds
+        min_in_flight: Requests the server must have seen in flight at once, which requests
+            sent one at a time fall short of
+        min_rows_per_s: Throughput floor of every case
+        min_scaling: Minimum ratio of a target's rows/s at its largest row count to its rows/s
+            at its smallest, which per-row overhead growing with the row count falls short of
+    """
+    failures = []
+    ok = [r for r in results if not r.get("error")]
+    for r in ok:
+        case = f"{r['target']} {r['rows']} rows"
+        in_flight = r["server"]["max_in_flight"]
+        if max_in_flight is not None and r["target"] in BOUNDED_TARGETS and in_flight > max_in_flight:
+            failures.append(f"{case}: server saw {in_flight} requests in flight, above the cap of {max_in_flight}")
+        if min_in_flight is not None and in_flight < min_in_flight:
+            failures.append(f"{case}: server saw at most {in_flight} requests in flight, below {min_in_flight}")
+        if min_rows_per_s is not None and r["rows_per_s"] < min_rows_per_s:
+            failures.append(f"{case}: {r['rows_per_s']:.1f} rows/s, below the floor of {min_rows_per_s}")
+    if min_scaling is not None:
+        for target in dict.fromkeys(r["target"] for r in ok):
+            cases = sorted((r for r in ok if r["target"] == target), key=lambda r: r["rows"])
+            if len(cases) > 1 and cases[-1]["rows_per_s"] < min_scaling * cases[0]["rows_per_s"]:
+                failures.append(
+                    f"{target}: {cases[-1]['rows_per_s']:.1f} rows/s at {cases[-1]['rows']} rows is below "
+                    f"{min_scaling}x the {cases[0]['rows_per_s']:.1f} rows/s at {cases[0]['rows']} rows"
+                )
+    return failures
+
+
+def cpu_s(usage: resource.struct_rusage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+def format_result(result: dict[str, Any]) -> str:
+    if result.get("error"):
+        status = "expected failure" if result.get("expected_failure") else "FAILED"
+        return f"{result['target']:>26} {result['rows']:>6} rows  {status}: {result['error'].splitlines()[0]}"
+    p99 = result.get("latency_p99_s")
+    return (
+        f"{result['target']:>26} {result['rows']:>6} rows  {result['rows_per_s']:9.1f} rows/s  "
+        f"p99 {'n/a' if p99 is None else f'{p99 * 1000:.1f} ms':>9}  "
+        f"CPU {result.get('cpu_ms_per_row', float('nan')):6.2f} ms/row  peak RSS {result['peak_rss_mb']:.0f} MB  "
+        f"server max in flight {result['server']['max_in_flight']}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=TARGETS)
+    parser.add_argument("--rows", nargs="+", type=int, default=[100, 1000, 10000])
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--latency-dist", default="lognormal", choices=["constant", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-num-seqs", type=int, default=256)
+    parser.add_argument("--replicas", type=int, default=1, help="Number of mock servers to balance prod_udf across")
+    parser.add_argument("--image-kb", type=int, default=4)
+    parser.add_argument("--timeout-s", type=float, default=600)
+    parser.add_argument("--output", help="Path of a JSON file to write the results to")
+    parser.add_argument("--max-in-flight", type=int, help="Fail if a bounded target exceeds this many requests in flight")
+    parser.add_argument("--min-in-flight", type=int, help="Fail if a target keeps fewer requests in flight")
+    parser.add_argument("--min-rows-per-s", type=float, help="Fail if a case is slower than this")
+    parser.add_argument("--min-scaling", type=float, help="Fail if rows/s at the most rows is below this multiple of rows/s at the fewest")
+    # Internal: run a single case in this process
+    parser.add_argument("--case", choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.rows[0], args.base_url, args.image_kb)))
+        sys.exit(0)
+
+    results = run_benchmarks(
+        args.targets,
+        args.rows,
+        MockServerConfig(
+            latency_ms=args.latency_ms,
+            latency_dist=args.latency_dist,
+            error_rate=args.error_rate,
+            max_num_seqs=args.max_num_seqs,
+        ),
+        image_kb=args.image_kb,
+        timeout_s=args.timeout_s,
+        replicas=args.replicas,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # Unexpected failures and broken thresholds fail the run so CI catches client-side scaling regressions
+    failures = check_thresholds(results, args.max_in_flight, args.min_in_flight, args.min_rows_per_s, args.min_scaling)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    sys.exit(int(bool(failures) or any(r.get("error") and not r["expected_failure"] for r in results)))
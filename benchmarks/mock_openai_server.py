@@ -0,0 +1,344 @@
+"""
+A local stand-in for an OpenAI-compatible chat completions server (e.g. vLLM).
+
+Answers `POST /v1/chat/completions` and `GET /v1/models` with configurable latency
+distributions and error rates, honouring vLLM's `guided_choice`, `guided_regex` and
+`guided_json` extra_body fields, so client-side throughput can be measured without a GPU.
+
+Run standalone with:
+ python benchmarks/mock_openai_server.py --port 8000 --latency-ms 50 --latency-dist lognormal
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class MockServerConfig:
+    """Behaviour of the mock server.
+
+    Args:
+        latency_ms: Mean latency of each completion
+        latency_dist: One of "constant", "uniform", "exponential" or "lognormal"
+        latency_sigma: Shape of the lognormal distribution
+        error_rate: Fraction of completions answered with `error_status`
+        error_status: HTTP status returned for injected errors, e.g. 429, 500 or 503
+        max_num_seqs: Completions served concurrently, like vLLM's `--max-num-seqs`.
+            Requests beyond it queue, so latency grows with load.
+        prefix_cache_size: Number of prompt prefixes (the model and first content part of the
+            first message, e.g. its image) kept in a simulated LRU prefix cache, like vLLM's
+            automatic prefix caching. Hits are counted in `stats()`.
+        seed: Seed for latency and error sampling
+    """
+
+    latency_ms: float = 20.0
+    latency_dist: str = "constant"
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    error_status: int = 503
+    max_num_seqs: int | None = None
+    prefix_cache_size: int = 0
+    seed: int | None = 0
+
+
+def sample_latency_s(config: MockServerConfig, rng: random.Random) -> float:
+    mean = config.latency_ms / 1000
+    if config.latency_dist == "constant":
+        return mean
+    if config.latency_dist == "uniform":
+        return rng.uniform(0, 2 * mean)
+    if config.latency_dist == "exponential":
+        return rng.expovariate(1 / mean) if mean > 0 else 0.0
+    if config.latency_dist == "lognormal":
+        if mean <= 0:
+            return 0.0
+        # Parametrized so that the distribution's mean is `mean`
+        return rng.lognormvariate(math.log(mean) - config.latency_sigma**2 / 2, config.latency_sigma)
+    raise ValueError(f"Unknown latency distribution {config.latency_dist!r}")
+
+
+def instance_from_schema(schema: dict[str, Any]) -> Any:
+    """Builds a minimal instance that satisfies a (simple) JSON schema."""
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "const" in schema:
+        return schema["const"]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return instance_from_schema(schema[key][0])
+    kind = schema.get("type", "object")
+    if isinstance(kind, list):
+        kind = kind[0]
+    if kind == "object":
+        properties = schema.get("properties", {})
+        defs = schema.get("$defs", {})
+        instance = {}
+        for name, prop in properties.items():
+            if "$ref" in prop:
+                prop = {**defs.get(prop["$ref"].rsplit("/", 1)[-1], {}), "$defs": defs}
+            instance[name] = instance_from_schema(prop)
+        return instance
+    if kind == "array":
+        return [instance_from_schema(schema["items"])] * schema.get("minItems", 0) if "items" in schema else []
+    if kind == "integer":
+        return int(schema.get("minimum", 0))
+    if kind == "number":
+        return float(schema.get("minimum", 0))
+    if kind == "boolean":
+        return False
+    if kind == "null":
+        return None
+    return "x" * schema.get("minLength", 0)
+
+
+def prompt_text(messages: list[dict[str, Any]]) -> str:
+    content = messages[-1].get("content", "") if messages else ""
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+def completion_content(body: dict[str, Any]) -> str:
+    """Echoes the prompt, constrained by the request's structured output spec.
+
+    `guided_choice` picks a choice deterministically from the prompt, `guided_json` and
+    `json_schema` response formats return a minimal schema instance and `guided_regex`
+    echoes the prompt, since the mock does not generate strings from regexes.
+    """
+    text = prompt_text(body.get("messages", []))
+    if body.get("guided_choice"):
+        choices = body["guided_choice"]
+        return choices[zlib.crc32(text.encode("utf-8")) % len(choices)]
+    schema = body.get("guided_json")
+    response_format = body.get("response_format") or {}
+    if schema is None and response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"].get("schema", {})
+    if schema is not None:
+        if isinstance(schema, str):
+            schema = json.loads(schema)
+        return json.dumps(instance_from_schema(schema))
+    return text
+
+
+class MockOpenAIServer:
+    """Serves the mock API from an event loop on a background thread.
+
+    Usage:
+        with MockOpenAIServer(MockServerConfig(latency_ms=10)) as server:
+            client = AsyncOpenAI(base_url=server.base_url, api_key="none")
+    """
+
+    def __init__(self, config: MockServerConfig | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or MockServerConfig()
+        self.host = host
+        self.port = port
+        self._rng = random.Random(self.config.seed)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._server: asyncio.base_events.Server | None = None
+        self._thread: threading.Thread | None = None
+        self._seqs: asyncio.Semaphore | None = None
+        self._connections: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self.reset_stats()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def reset_stats(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_received = 0
+        self.prefix_cache_hits = 0
+        self._prefixes: OrderedDict[int, None] = OrderedDict()
+        self.bodies: list[dict[str, Any]] = []
+        self.record_bodies = False
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "max_in_flight": self.max_in_flight,
+            "bytes_received": self.bytes_received,
+            "prefix_cache_hits": self.prefix_cache_hits,
+        }
+
+    def start(self) -> "MockOpenAIServer":
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            if self.config.max_num_seqs:
+                self._seqs = asyncio.Semaphore(self.config.max_num_seqs)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port, backlog=4096)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="mock-openai-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            # Closing the transports ends each connection's read loop with EOF
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self._route(method, path.split("?", 1)[0], body)
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple[int, dict[str, Any]]:
+        if method == "GET" and path.endswith("/models"):
+            return 200, {"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "mock"}]}
+        if method == "POST" and path.endswith("/chat/completions"):
+            return await self._chat_completion(body)
+        return 404, {"error": {"message": f"Unknown route {method} {path}"}}
+
+    def _lookup_prefix(self, body: dict[str, Any]) -> None:
+        messages = body.get("messages") or [{}]
+        content = messages[0].get("content")
+        first = content[0] if isinstance(content, list) and content else content
+        key = hash((body.get("model"), json.dumps(first, sort_keys=True)))
+        if key in self._prefixes:
+            self.prefix_cache_hits += 1
+            self._prefixes.move_to_end(key)
+            return
+        self._prefixes[key] = None
+        if len(self._prefixes) > self.config.prefix_cache_size:
+            self._prefixes.popitem(last=False)
+
+    async def _chat_completion(self, raw: bytes) -> tuple[int, dict[str, Any]]:
+        self.requests += 1
+        self.bytes_received += len(raw)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body = json.loads(raw)
+            if self.record_bodies:
+                self.bodies.append(body)
+            if self.config.prefix_cache_size:
+                self._lookup_prefix(body)
+            latency = sample_latency_s(self.config, self._rng)
+            fail = self._rng.random() < self.config.error_rate
+            if self._seqs is not None:
+                async with self._seqs:
+                    await asyncio.sleep(latency)
+            else:
+                await asyncio.sleep(latency)
+        finally:
+            self.in_flight -= 1
+
+        if fail:
+            self.errors += 1
+            return self.config.error_status, {"error": {"message": "Injected mock error", "code": self.config.error_status}}
+
+        content = completion_content(body)
+        prompt_tokens = len(raw) // 4
+        completion_tokens = max(1, len(content) // 4)
+        return 200, {
+            "id": f"chatcmpl-mock-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock-model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--latency-dist", default="constant", choices=["constant", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--max-num-seqs", type=int, default=None)
+    parser.add_argument("--prefix-cache-size", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(
+        MockServerConfig(
+            latency_ms=args.latency_ms,
+            latency_dist=args.latency_dist,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            max_num_seqs=args.max_num_seqs,
+            prefix_cache_size=args.prefix_cache_size,
+        ),
+        host=args.host,
+        port=args.port,
+    ).start()
+    print(f"Mock OpenAI server listening on {server.base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
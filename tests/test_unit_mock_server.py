@@ -0,0 +1,63 @@
+"""Unit tests for the offline mock OpenAI-compatible server and benchmark harness."""
+import json
+
+import pytest
+from openai import OpenAI, RateLimitError
+
+from bench_structured_outputs import check_thresholds, run_benchmarks
+from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+
+@pytest.fixture
+def server():
+    with MockOpenAIServer(MockServerConfig(latency_ms=1)) as server:
+        yield server
+
+
+def _chat(server: MockOpenAIServer, **kwargs) -> str:
+    client = OpenAI(base_url=server.base_url, api_key="none", max_retries=0)
+    completion = client.chat.completions.create(
+        model="mock-model", messages=[{"role": "user", "content": "Which option?"}], **kwargs
+    )
+    return completion.choices[0].message.content
+
+
+def test_guided_choice_returns_a_choice(server):
+    assert _chat(server, extra_body={"guided_choice": ["A", "B", "C", "D"]}) in {"A", "B", "C", "D"}
+
+
+def test_guided_json_returns_schema_instance(server):
+    schema = {
+        "type": "object",
+        "properties": {"brand": {"type": "string"}, "year": {"type": "integer"}, "kind": {"enum": ["sedan", "suv"]}},
+    }
+    assert json.loads(_chat(server, extra_body={"guided_json": schema})) == {"brand": "", "year": 0, "kind": "sedan"}
+
+
+def test_injected_errors_surface_as_status_codes():
+    with MockOpenAIServer(MockServerConfig(latency_ms=0, error_rate=1.0, error_status=429)) as server:
+        with pytest.raises(RateLimitError):
+            _chat(server)
+        assert server.stats()["errors"] == 1
+
+
+def test_benchmark_runs_prod_udf_offline():
+    (result,) = run_benchmarks(["prod_udf"], [50], MockServerConfig(latency_ms=1), image_kb=1, timeout_s=120)
+
+    assert result["error"] is None
+    assert result["completed"] == 50
+    assert result["server"]["requests"] == 50
+    assert result["latency_p99_s"] is not None
+
+
+def test_benchmark_thresholds_flag_scaling_regressions():
+    def case(target, rows, rows_per_s, in_flight):
+        return {"target": target, "rows": rows, "rows_per_s": rows_per_s, "server": {"max_in_flight": in_flight}, "error": None}
+
+    healthy = [case("prod_udf", 100, 50.0, 40), case("prod_udf", 1000, 200.0, 64), case("llm_generate", 100, 50.0, 90)]
+    assert check_thresholds(healthy, max_in_flight=64, min_in_flight=16, min_rows_per_s=10, min_scaling=1.5) == []
+
+    unbounded = [case("prod_udf", 100, 50.0, 100), case("prod_udf", 1000, 200.0, 1000)]
+    assert len(check_thresholds(unbounded, max_in_flight=64)) == 2
+    collapsed = [case("prod_udf", 100, 50.0, 1), case("prod_udf", 1000, 40.0, 1)]
+    assert len(check_thresholds(collapsed, min_in_flight=16, min_rows_per_s=45, min_scaling=1.5)) == 4
@@ -0,0 +1,1212 @@
+"""Unit tests for the structured outputs workload that run without an inference server."""
+import asyncio
+import base64
+import io
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import daft
+from daft import col, lit
+import pyarrow as pa
+import pydantic
+import pytest
+
+import structured_outputs_workload as workload
+
+
+class FakeCompletions:
+    """Stands in for `AsyncOpenAI().chat.completions`, echoing the prompt text back."""
+
+    def __init__(self, latency_s: float = 0.001):
+        self.latency_s = latency_s
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    async def create(self, messages, model, extra_body=None, **kwargs):
+        self.calls.append({"messages": messages, "model": model, "extra_body": extra_body, **kwargs})
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency_s)
+        finally:
+            self.in_flight -= 1
+        text = next(c["text"] for c in messages[0]["content"] if c["type"] == "text")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def results_of(outputs: list[dict]) -> list[str | None]:
+    return [output["result"] for output in outputs]
+
+
+def make_udf(completions: FakeCompletions, **init_kwargs):
+    udf = workload.StructuredOutputsProdUDF.inner(base_url="http://fake/v1", api_key="none", **init_kwargs)
+    udf.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return udf
+
+
+class Answer(pydantic.BaseModel):
+    answer: str
+    confidence: float | None = None
+
+
+class StubEngine:
+    """Stands in for `VLLMEngine` on CPU, answering with the first allowed choice, or an
+    `Answer` given a JSON schema."""
+
+    def __init__(self, model_id: str, fail: bool = False):
+        self.model_id = model_id
+        self.fail = fail
+        self.batches = []
+
+    def generate(self, requests: list[dict]) -> list[str]:
+        if self.fail:
+            raise RuntimeError("CUDA out of memory")
+        self.batches.append(requests)
+        return [
+            r["guided"]["choice"][0] if "choice" in r["guided"]
+            else '{"answer": "A"}' if "json" in r["guided"]
+            else r["text"]
+            for r in requests
+        ]
+
+
+def test_windowed_gather_preserves_order_and_bounds_window():
+    in_flight = 0
+    peak = 0
+
+    async def work(i):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001 * (i % 3))
+        in_flight -= 1
+        return i
+
+    results = asyncio.run(workload.windowed_gather((work(i) for i in range(50)), window=7))
+    assert results == list(range(50))
+    assert peak <= 7
+
+
+def test_udf_caps_in_flight_requests():
+    completions = FakeCompletions()
+    udf = make_udf(completions, max_in_flight=5, process_max_in_flight=100)
+    texts = [f"q{i}" for i in range(40)]
+
+    results = results_of(udf(
+        "model",
+        daft.Series.from_pylist(texts),
+        daft.Series.from_pylist([None] * 40),
+        sampling_params={"temperature": 0.0},
+    ))
+
+    assert results == texts
+    assert completions.max_in_flight == 5
+
+
+def test_process_limiter_caps_instances_across_threads():
+    completions = FakeCompletions(latency_s=0.005)
+    results = {}
+
+    def run(name):
+        udf = make_udf(completions, max_in_flight=10, process_max_in_flight=3)
+        results[name] = results_of(udf(
+            "model",
+            daft.Series.from_pylist([f"{name}{i}" for i in range(20)]),
+            daft.Series.from_pylist([None] * 20),
+        ))
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results["a"] == [f"a{i}" for i in range(20)]
+    assert results["b"] == [f"b{i}" for i in range(20)]
+    assert completions.max_in_flight == 3
+    assert workload.get_process_limiter(3).in_flight == 0
+
+
+def test_background_loop_pipelines_batches_in_order():
+    completions = FakeCompletions(latency_s=0.01)
+    udf = make_udf(completions, max_in_flight=4, background_loop=True)
+    try:
+        first = udf.submit_batch("model", [f"a{i}" for i in range(10)], [None] * 10)
+        second = udf.submit_batch("model", [f"b{i}" for i in range(10)], [None] * 10)
+
+        assert results_of(first.result(timeout=5)) == [f"a{i}" for i in range(10)]
+        assert results_of(second.result(timeout=5)) == [f"b{i}" for i in range(10)]
+        # Both batches share one window, so the second fills slots freed by the first's tail
+        assert completions.max_in_flight == 4
+        started = [call["messages"][0]["content"][0]["text"][0] for call in completions.calls]
+        assert started.index("b") < len(started) - started[::-1].index("a") - 1
+
+        assert results_of(udf("model", daft.Series.from_pylist(["c"]), daft.Series.from_pylist([None]))) == ["c"]
+    finally:
+        udf.close()
+
+
+def test_pipeline_background_loop_overlaps_daft_batches(monkeypatch):
+    batch_of, in_flight, overlapped = {}, {}, []
+    submit_batch = workload.StructuredOutputsProdUDF.inner.submit_batch
+
+    def record_submit(self, model_id, texts, *args, **kwargs):
+        batch = len(set(batch_of.values()))
+        batch_of.update((text, batch) for text in texts)
+        return submit_batch(self, model_id, texts, *args, **kwargs)
+
+    async def generate(self, model_id, text, *args, **kwargs):
+        batch = batch_of[text]
+        in_flight[batch] = in_flight.get(batch, 0) + 1
+        overlapped.append(sum(n > 0 for n in in_flight.values()) > 1)
+        # The last row of each batch is its slow tail
+        await asyncio.sleep(0.2 if text.endswith("7 \n ") else 0.005)
+        in_flight[batch] -= 1
+        return "A"
+
+    monkeypatch.setattr(workload.StructuredOutputsProdUDF.inner, "submit_batch", record_submit)
+    monkeypatch.setattr(workload.StructuredOutputsProdUDF.inner, "generate", generate)
+    df = daft.from_pylist([{"question": f"q{i // 8}-{i % 8}", "choices_string": "", "image_base64": None} for i in range(32)])
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    out = pipeline.infer(df.into_batches(8), "model", max_in_flight=16, background_loop=True).to_pydict()
+
+    assert out["result"] == ["A"] * 32 and out["error"] == [None] * 32
+    assert len(set(batch_of.values())) == 4
+    # Requests of a later batch were sent while an earlier batch's tail was in flight
+    assert any(overlapped)
+
+
+def test_background_loop_rejects_runners_without_a_shared_process(monkeypatch):
+    monkeypatch.setattr(type(daft.context.get_context()), "get_or_infer_runner_type", lambda self: "ray")
+    df = daft.from_pylist([{"question": "q", "choices_string": "", "image_base64": None}])
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+
+    with pytest.raises(ValueError, match="native runner"):
+        pipeline.infer(df, "model", background_loop=True)
+    with pytest.raises(RuntimeError, match="same process"):
+        workload.collect_inference.inner(daft.Series.from_pylist([12345 << 32]))
+
+
+def test_response_cache_skips_server_on_repeat(tmp_path):
+    completions = FakeCompletions()
+    extra_body = {"guided_choice": ["A", "B"]}
+    texts = daft.Series.from_pylist(["A", "B", "A"])
+    images = daft.Series.from_pylist(["aW1n", "aW1n", "b3RoZXI="])
+
+    first = make_udf(completions, cache_dir=str(tmp_path))
+    assert results_of(first("model", texts, images, {"temperature": 0.0}, extra_body)) == ["A", "B", "A"]
+    first.close()
+    assert len(completions.calls) == 3
+
+    second = make_udf(completions, cache_dir=str(tmp_path))
+    assert results_of(second("model", texts, images, {"temperature": 0.0}, extra_body)) == ["A", "B", "A"]
+    assert len(completions.calls) == 3
+    assert second.cache.hits == 3
+
+    # Any change to the request, including the guided decoding spec, is a miss
+    second("model", texts, images, {"temperature": 0.0}, {"guided_choice": ["A", "B", "C"]})
+    assert len(completions.calls) == 6
+    second.close()
+
+
+def test_resent_requests_replace_their_cache_entries(tmp_path):
+    completions = FakeCompletions()
+    texts, images = daft.Series.from_pylist(["A"]), daft.Series.from_pylist([None])
+    first = make_udf(completions, cache_dir=str(tmp_path))
+    key, _ = first.cached_response("model", "A", None)
+    first.cache.put(key, "stale")
+    assert results_of(first("model", texts, images)) == ["stale"]
+    first.close()
+
+    resend = make_udf(completions, cache_dir=str(tmp_path), read_cache=False)
+    assert results_of(resend("model", texts, images)) == ["A"]
+    resend.close()
+    assert len(completions.calls) == 1
+
+    later = make_udf(completions, cache_dir=str(tmp_path))
+    assert results_of(later("model", texts, images)) == ["A"]
+    assert len(completions.calls) == 1
+    later.close()
+
+
+def test_load_checkpoint_prefers_the_latest_result_of_a_row(tmp_path):
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none", checkpoint_dir=str(tmp_path))
+    path = pipeline.checkpoint_path("model", {"temperature": 0.0}, None)
+    os.makedirs(path)
+    for result in ("stale", "fresh"):
+        inference = daft.Series.from_pylist([{"result": result, "error": None}]).cast(workload.INFERENCE_DTYPE)
+        workload.checkpoint_inference.inner(daft.Series.from_pylist([7]).cast(daft.DataType.uint64()), inference, path)
+        time.sleep(0.01)
+
+    assert pipeline.load_checkpoint(path).to_pylist() == [{"row_id": 7, "result": "fresh"}]
+    assert pipeline.checkpoint_path("other-model", {"temperature": 0.0}, None) != path
+
+
+def test_response_cache_keys_each_row_once_across_retries(tmp_path, monkeypatch):
+    completions = FakeCompletions()
+    create = completions.create
+    failures = [2]
+
+    async def flaky_create(*args, **kwargs):
+        if failures[0]:
+            failures[0] -= 1
+            raise workload.openai.APIConnectionError(request=workload.httpx.Request("POST", "http://fake/v1"))
+        return await create(*args, **kwargs)
+
+    completions.create = flaky_create
+    keys = []
+    cache_key = workload.RequestTemplate.cache_key
+    monkeypatch.setattr(workload.RequestTemplate, "cache_key", lambda self, *a: keys.append(a) or cache_key(self, *a))
+    udf = make_udf(completions, cache_dir=str(tmp_path))
+    udf.retry_policy.base_delay_s = 0.001
+    assert results_of(udf("model", daft.Series.from_pylist(["q"]), daft.Series.from_pylist(["aW1n"]))) == ["q"]
+    assert keys == [("q", "aW1n")]  # Not recomputed by the two retries or the cache write
+    assert udf.cache.get(cache_key(udf._templates[0], "q", "aW1n")) == "q"
+    udf.close()
+
+    template = workload.RequestTemplate("model", None, None, "image/png")
+    assert len({template.cache_key(*parts) for parts in [("ab", None), ("a", "b"), (None, "ab"), ("", "ab")]}) == 4
+
+
+def test_response_cache_hits_bypass_the_adaptive_controller(tmp_path):
+    completions = FakeCompletions()
+    texts = daft.Series.from_pylist([f"q{i}" for i in range(40)])
+    images = daft.Series.from_pylist([None] * 40)
+    warm = make_udf(completions, cache_dir=str(tmp_path))
+    warm("model", texts, images)
+    warm.close()
+
+    udf = make_udf(completions, cache_dir=str(tmp_path), adaptive_concurrency=True, max_in_flight=64)
+    limit = udf.controller.limit
+    assert results_of(udf("model", texts, images)) == [f"q{i}" for i in range(40)]
+    # Hits neither took a slot nor became the controller's latency baseline
+    assert udf.controller.baseline is None and udf.controller.limit == limit
+    assert udf.controller._peak == 0
+    assert len(completions.calls) == 40
+    udf.close()
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = workload.ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=10)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    assert cache.get("a") == "aaaa"  # "b" is now least recently used
+    cache.put("c", "cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+    cache.close()
+
+
+def make_ai2d_rows() -> list[dict]:
+    """Two cauldron-style rows: one image with two questions, and a repeat of the same image."""
+
+    def qa(question: str, answer: str) -> dict:
+        return {
+            "user": f"Question: {question}\nChoices:\nA. cat\nB. dog\nC. sun\nD. moon\nAnswer with the letter.",
+            "assistant": f"Answer: {answer}",
+            "source": "ai2d",
+        }
+
+    image = {"bytes": b"\x89PNG fake image", "path": None}
+    return [
+        {"images": [image], "texts": [qa("What is shown?", "B"), qa("Which is brightest?", "C")]},
+        {"images": [image], "texts": [qa("What animal barks?", "B")]},
+    ]
+
+
+def test_preprocess_encodes_each_unique_image_once():
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    rows = pipeline.preprocess(daft.from_pylist(make_ai2d_rows())).to_pylist()
+
+    assert [r["question"].strip() for r in rows] == ["What is shown?", "Which is brightest?", "What animal barks?"]
+    assert [r["answer"].strip() for r in rows] == ["B", "C", "B"]
+    assert len({r["image_hash"] for r in rows}) == 1
+    assert {r["image_base64"] for r in rows} == {base64.b64encode(b"\x89PNG fake image").decode()}
+
+
+def test_b64encode_arrow_matches_stdlib():
+    values = [b"a", None, b"abcd", b"", b"abc", b"ab", bytes(range(256)) * 7]
+    expected = [None if v is None else base64.b64encode(v).decode() for v in values]
+
+    array = pa.array(values, pa.binary())
+    assert workload.b64encode_arrow(array).to_pylist() == expected
+    assert workload.b64encode_arrow(array.slice(2)).to_pylist() == expected[2:]
+    assert workload.b64encode_arrow(pa.array([], pa.binary())).to_pylist() == []
+
+
+def test_encode_unique_images_base64_restores_row_order():
+    images = [b"first", b"second", b"first", None, b"second"]
+    series = daft.Series.from_pylist(images)
+    hashes = series.hash()
+
+    encoded = workload.encode_unique_images_base64.inner(hashes, series)
+
+    assert encoded.to_pylist() == [None if v is None else base64.b64encode(v).decode() for v in images]
+
+
+def test_preprocess_shrinks_and_reencodes_images():
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.effect_noise((1200, 600), 64).convert("RGB").save(buffer, format="PNG")
+    rows = make_ai2d_rows()
+    for row in rows:
+        row["images"] = [{"bytes": buffer.getvalue(), "path": None}]
+
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(
+        "http://fake/v1", "none", max_image_side=300, image_format="JPEG", image_quality=80
+    )
+    out = pipeline.preprocess(daft.from_pylist(rows)).to_pylist()
+
+    assert pipeline.image_mime_type == "image/jpeg"
+    assert all(r["image_bytes_saved"] > 0 for r in out)
+    with Image.open(io.BytesIO(base64.b64decode(out[0]["image_base64"]))) as img:
+        assert img.format == "JPEG"
+        assert img.size == (300, 150)
+
+
+def test_shrink_images_passes_undecodable_images_through():
+    pytest.importorskip("PIL.Image")
+    rows = make_ai2d_rows()
+    rows[0]["images"] = [{"bytes": png_bytes((600, 300)), "path": None}]
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none", max_image_side=300)
+    out = pipeline.preprocess(daft.from_pylist(rows)).to_pylist()
+
+    assert out[0]["image_bytes_saved"] > 0
+    assert base64.b64decode(out[2]["image_base64"]) == b"\x89PNG fake image"
+
+
+def png_bytes(size: tuple[int, int]) -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", size).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_vllm_udf_generates_batches_from_raw_image_bytes():
+    pytest.importorskip("PIL.Image")
+    udf = workload.StructuredOutputsVLLMUDF.inner("model", engine_factory=StubEngine)
+    image = png_bytes((8, 4))
+    outputs = udf(
+        "model",
+        daft.Series.from_pylist(["q0", "q1", "q2"]),
+        daft.Series.from_pylist([image, image, b"not an image"]),
+        sampling_params={"temperature": 0.0},
+        extra_body={"guided_choice": ["B", "A"], "top_k": 1},
+    )
+
+    assert results_of(outputs) == ["A", "A", None]
+    assert outputs[2]["error"]["type"] == "UnidentifiedImageError"
+    [batch] = udf.engine.batches
+    assert batch[0]["sampling_params"] == {"temperature": 0.0, "top_k": 1, "max_tokens": 1}
+    assert batch[0]["guided"] == {"choice": ["A", "B"]}  # Canonical order
+    assert batch[0]["image"].size == (8, 4)
+    assert batch[0]["image"] is batch[1]["image"]  # Decoded once per distinct image
+
+    # Base64 images, as sent to the server, work too
+    outputs = udf("model", daft.Series.from_pylist(["q"]), daft.Series.from_pylist([base64.b64encode(image).decode()]))
+    assert results_of(outputs) == ["q"] and udf.engine.batches[-1][0]["image"].size == (8, 4)
+
+    failing = workload.StructuredOutputsVLLMUDF.inner("model", engine_kwargs={"fail": True}, engine_factory=StubEngine)
+    outputs = failing("model", daft.Series.from_pylist(["q"]), daft.Series.from_pylist([None]))
+    assert outputs == [{"result": None, "error": {
+        "type": "RuntimeError", "message": "CUDA out of memory", "status_code": None, "attempts": 1,
+    }}]
+    other_model = udf("other", daft.Series.from_pylist(["q"]), daft.Series.from_pylist([None]))
+    assert other_model[0]["error"]["type"] == "ValueError"
+
+
+def test_pipeline_vllm_backend_skips_base64(monkeypatch):
+    pytest.importorskip("PIL.Image")
+    # UDF workers import the stub engine from this module
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([os.path.dirname(workload.__file__), os.path.dirname(__file__)]))
+    rows = make_ai2d_rows()
+    for row in rows:
+        row["images"] = [{"bytes": png_bytes((16, 16)), "path": None}]
+
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(
+        "http://unused/v1", "none", backend="vllm", engine_factory=StubEngine, num_gpus=0
+    )
+    df = pipeline.postprocess(pipeline.infer(pipeline.preprocess(daft.from_pylist(rows)), "model", concurrency=1))
+    out = df.to_pylist()
+
+    assert "image_base64" not in df.column_names
+    assert [r["result"] for r in out] == ["A", "A", "A"]
+    assert all(r["error"] is None for r in out)
+
+
+def test_parse_json_structs_parses_batches_and_nulls_bad_rows():
+    dtype = workload.response_model_dtype(Answer)
+    assert dtype == daft.DataType.struct({"answer": daft.DataType.string(), "confidence": daft.DataType.float64()})
+
+    parsed = workload.parse_json_structs(['{"answer": "B",\n "confidence": 0.5}', None, '{"answer": "C"}'], dtype)
+    assert parsed.type == dtype.to_arrow_dtype()
+    assert parsed.to_pylist() == [{"answer": "B", "confidence": 0.5}, None, {"answer": "C", "confidence": None}]
+    # Rows that are not objects of the model fail alone
+    parsed = workload.parse_json_structs(['{"answer": "B"}', "B", '{"confidence": "high"}', " "], dtype)
+    assert parsed.to_pylist() == [{"answer": "B", "confidence": None}, None, None, None]
+    # Objects without a required field parse, but do not conform to the model
+    required = workload.required_fields(Answer.model_json_schema())
+    assert required == ["answer"]
+    parsed = workload.parse_json_structs(['{}', '{"wrong": 1}', '{"answer": "A"}'], dtype, required)
+    assert parsed.to_pylist() == [None, None, {"answer": "A", "confidence": None}]
+    outputs = workload.typed_inference_outputs([{"result": "{}", "error": None}], dtype, required).to_pylist()
+    assert outputs[0]["result"] is None and outputs[0]["error"]["type"] == "OutputParseError"
+
+
+def test_pipeline_response_model_returns_and_validates_struct_results(monkeypatch):
+    pytest.importorskip("PIL.Image")
+    # UDF workers import the stub engine and model from this module
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([os.path.dirname(workload.__file__), os.path.dirname(__file__)]))
+    rows = make_ai2d_rows()
+    for row in rows:
+        row["images"] = [{"bytes": png_bytes((16, 16)), "path": None}]
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(
+        "http://unused/v1", "none", backend="vllm", engine_factory=StubEngine, num_gpus=0
+    )
+    df = pipeline.infer(
+        pipeline.preprocess(daft.from_pylist(rows)), "model", sampling_params=None, concurrency=1, response_model=Answer
+    )
+    df = pipeline.postprocess(df).collect()
+
+    assert df.schema()["result"].dtype == workload.response_model_dtype(Answer)
+    assert "is_correct" not in df.column_names
+    out = df.select(col("parsed").struct.get("answer"), "is_valid").to_pydict()
+    assert out == {"answer": ["A", "A", "A"], "is_valid": [True, True, True]}
+    metrics = pipeline.evaluate_metrics(df).to_pylist()[0]
+    assert (metrics["rows"], metrics["null_results"], metrics["invalid_rate"], metrics["accuracy"]) == (3, 0, 0.0, None)
+    assert pipeline.evaluate_subsets(df.with_column("subset", lit("ai2d")))["ai2d"]["invalid"] == 0
+
+    udf = workload.StructuredOutputsVLLMUDF.inner("model", engine_factory=StubEngine, response_model=Answer)
+    outputs = udf("model", daft.Series.from_pylist(["q"]), daft.Series.from_pylist([None]))
+    assert outputs.to_pylist() == [{"result": None, "error": {
+        "type": "OutputParseError", "message": "Output is not a JSON object of the response model: 'q'",
+        "status_code": None, "attempts": None,
+    }}]
+    assert udf.engine.batches[0][0]["guided"] == {}
+
+
+def test_run_streaming_writes_chunks_without_image_payloads(tmp_path):
+    source = tmp_path / "ai2d.parquet"
+    daft.from_pylist(make_ai2d_rows() * 3).write_parquet(str(source))
+
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    pipeline.infer = lambda df, *args, **kwargs: df.with_column("result", daft.col("answer"))
+
+    df = pipeline(
+        model_id="model", dataset_uri=str(source / "*.parquet"), output_dir=str(tmp_path / "out"), row_limit=4
+    )
+    rows = df.to_pylist()
+
+    assert len(list((tmp_path / "out").glob("part-*.parquet"))) >= 1
+    assert len(rows) == 6  # 4 source rows with 2 + 1 + 2 + 1 questions
+    assert all(r["is_correct"] for r in rows)
+    assert not {"images", "image_base64"} & set(df.column_names)
+
+    # A smaller rerun into the same directory does not read back the earlier chunks
+    pipeline.run_streaming("model", str(source / "*.parquet"), str(tmp_path / "out"), row_limit=4, chunk_rows=1)
+    df = pipeline.run_streaming("model", str(source / "*.parquet"), str(tmp_path / "out"), row_limit=2)
+    assert df.count_rows() == 3
+
+
+def test_run_streaming_keeps_one_inference_actor_pool(tmp_path, monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    source = tmp_path / "ai2d.parquet"
+    daft.from_pylist(make_ai2d_rows() * 4).write_parquet(str(source))
+    events_dir = tmp_path / "events"
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    monkeypatch.setenv(workload.METRICS_DIR_ENV, str(events_dir))
+    monkeypatch.setattr(workload, "_metrics", workload.MetricsRecorder())
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=1)) as server:
+        pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(server.base_url, "none")
+        df = pipeline.run_streaming("model", str(source / "*.parquet"), str(tmp_path / "out"), concurrency=1, chunk_rows=2)
+
+    assert df.count_rows() == 12
+    _, requests = workload.get_metrics().events()
+    assert len(requests) == 12
+    # Every request came from the same UDF worker process
+    request_files = [p for p in events_dir.glob("events-*.jsonl") if '"kind": "request"' in p.read_text()]
+    assert len(request_files) == 1
+    assert set(workload.get_metrics().report()["stages"]) == {"load_dataset", "preprocess", "infer", "postprocess"}
+
+
+def test_instrumented_run_reports_stages_lazily(tmp_path):
+    source = tmp_path / "ai2d.parquet"
+    daft.from_pylist(make_ai2d_rows()).write_parquet(str(source))
+
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    pipeline.infer = lambda df, *args, **kwargs: df.with_column("result", daft.col("answer"))
+
+    df = pipeline(model_id="model", dataset_uri=str(source / "*.parquet"), instrument=True)
+    assert workload.get_metrics().batches == []  # Nothing runs until the DataFrame is materialized
+
+    df.collect()
+    report = workload.get_metrics().report()
+    assert set(report["stages"]) == {"load_dataset", "preprocess", "infer", "postprocess"}
+    assert report["stages"]["load_dataset"]["rows"] == 2
+    assert report["stages"]["postprocess"]["rows"] == 3
+    assert report["stages"]["preprocess"]["bytes"] > 0
+
+    workload.get_metrics().write_report(str(tmp_path / "metrics.json"))
+    workload.get_metrics().write_report(str(tmp_path / "metrics.parquet"))
+    assert daft.read_parquet(str(tmp_path / "metrics.parquet")).count_rows() == 4
+
+
+def test_instrumented_run_collects_request_latencies_from_udf_workers(tmp_path, monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    source = tmp_path / "ai2d.parquet"
+    daft.from_pylist(make_ai2d_rows() * 3).write_parquet(str(source))
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    monkeypatch.delenv(workload.METRICS_DIR_ENV, raising=False)
+    monkeypatch.setattr(workload, "_metrics", workload.MetricsRecorder())
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=1)) as server:
+        pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(server.base_url, "none")
+        pipeline(model_id="model", dataset_uri=str(source / "*.parquet"), concurrency=1, instrument=True).collect()
+        sent = server.stats()["requests"]
+
+    report = workload.get_metrics().report()
+    assert sent == 9
+    assert report["requests"]["count"] == 9
+    assert report["requests"]["latency_p50_s"] > 0
+
+
+def test_metrics_recorder_owns_its_temporary_spool_dir(monkeypatch):
+    monkeypatch.delenv(workload.METRICS_DIR_ENV, raising=False)
+    metrics = workload.MetricsRecorder()
+    metrics.spool_to_temporary_dir()
+    events_dir = metrics.events_dir
+    metrics.spool_to_temporary_dir()
+    assert metrics.events_dir == events_dir and os.path.isdir(events_dir)
+    assert workload.METRICS_DIR_ENV not in os.environ
+
+    metrics.record_request(0.1)
+    metrics.close()
+    assert metrics.events_dir is None and not os.path.exists(events_dir)
+
+
+def test_metrics_recorder_spools_events_in_batches(tmp_path, monkeypatch):
+    metrics = workload.MetricsRecorder(str(tmp_path))
+    for i in range(3):
+        metrics.record_request(0.1)
+    assert not list(tmp_path.glob("*.jsonl"))  # Buffered until flushed
+
+    metrics.flush()
+    [spool] = tmp_path.glob("events-*.jsonl")
+    assert len(spool.read_text().splitlines()) == 3
+    monkeypatch.setattr(workload, "SPOOL_FLUSH_EVENTS", 2)
+    metrics.record_request(0.1)
+    metrics.record_request(0.1)
+    assert len(spool.read_text().splitlines()) == 5
+
+    metrics.started_at = 100.0
+    metrics.batches = [{"stage": "infer", "timestamp": t, "rows": 1, "bytes": 1} for t in (101.0, 101.5, 104.0)]
+    monkeypatch.setattr(metrics, "events_dir", None)
+    stage = metrics.report()["stages"]["infer"]
+    assert stage["batch_interval_p50_s"] == 1.0  # Intervals of 1, 0.5 and 2.5 seconds
+    assert stage["elapsed_s"] == 4.0
+
+
+def test_udf_records_request_latencies():
+    workload.get_metrics().reset()
+    udf = make_udf(FakeCompletions())
+    udf("model", daft.Series.from_pylist(["a", "b"]), daft.Series.from_pylist([None, None]))
+
+    requests = workload.get_metrics().report()["requests"]
+    assert requests["count"] == 2
+    assert requests["latency_p50_s"] > 0
+
+
+def test_adaptive_controller_grows_when_saturated_and_backs_off():
+    controller = workload.AdaptiveConcurrencyController(max_limit=64, initial_limit=4, window=4)
+
+    async def saturate(latency_s: float, windows: int = 1):
+        for _ in range(windows):
+            for _ in range(controller.limit):
+                await controller.acquire()
+            for _ in range(controller.window):
+                controller.observe(latency_s)
+            for _ in range(controller.in_flight):
+                controller.release()
+
+    asyncio.run(saturate(0.01, windows=5))
+    grown = controller.limit
+    assert grown > 4
+
+    asyncio.run(saturate(0.1))  # p50 10x the baseline
+    assert controller.limit < grown
+
+    before = controller.limit
+    controller.observe_status(429)
+    controller.observe(0.01, rejected=True)
+    for _ in range(controller.window):
+        controller.observe(0.01)
+    assert controller.limit <= before // 2 + 1
+
+
+def test_adaptive_udf_backs_off_from_queueing_server():
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=5, max_num_seqs=4)) as server:
+        udf = workload.StructuredOutputsProdUDF.inner(
+            base_url=server.base_url, api_key="none", max_in_flight=64, adaptive_concurrency=True
+        )
+        texts = [f"q{i}" for i in range(400)]
+        results = results_of(udf("model", daft.Series.from_pylist(texts), daft.Series.from_pylist([None] * 400)))
+
+    assert results == texts
+    assert udf.controller.limit < 64
+
+
+@pytest.mark.parametrize("transport", ["sdk", "http"])
+def test_udf_retries_transient_errors_and_reports_failures(transport):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    texts = [f"q{i}" for i in range(100)]
+    with MockOpenAIServer(MockServerConfig(latency_ms=1, error_rate=0.3, error_status=503, seed=0)) as server:
+        udf = workload.StructuredOutputsProdUDF.inner(
+            base_url=server.base_url, api_key="none", max_attempts=8, transport=transport
+        )
+        udf.retry_policy.base_delay_s = 0.001
+        udf.retry_policy.min_retries = 1000
+        outputs = udf("model", daft.Series.from_pylist(texts), daft.Series.from_pylist([None] * 100))
+    assert results_of(outputs) == texts
+    assert all(output["error"] is None for output in outputs)
+    assert udf.retry_policy.retries > 0
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=1, error_rate=1.0, error_status=400)) as server:
+        udf = workload.StructuredOutputsProdUDF.inner(base_url=server.base_url, api_key="none", transport=transport)
+        outputs = udf("model", daft.Series.from_pylist(["a", "b"]), daft.Series.from_pylist([None, None]))
+    assert results_of(outputs) == [None, None]
+    assert outputs[0]["error"]["status_code"] == 400
+    assert outputs[0]["error"]["type"] == "BadRequestError"  # The same exception with either transport
+    assert outputs[0]["error"]["attempts"] == 1  # Client errors are not retried
+
+
+def test_status_error_matches_sdk_exceptions():
+    request = workload.httpx.Request("POST", "http://fake/v1/chat/completions")
+    for status, error_class in [(400, "BadRequestError"), (429, "RateLimitError"), (503, "InternalServerError"), (418, "APIStatusError")]:
+        response = workload.httpx.Response(status, json={"error": {"message": "nope"}}, request=request)
+        error = workload.status_error(response)
+        assert type(error).__name__ == error_class
+        assert error.status_code == status and error.body == {"message": "nope"}
+    error = workload.status_error(workload.httpx.Response(502, text="Bad Gateway", request=request))
+    assert isinstance(error, workload.openai.InternalServerError) and error.body == "Bad Gateway"
+
+
+def test_request_template_splices_rows_into_serialized_body():
+    template = workload.RequestTemplate("model", {"temperature": 0.0}, {"guided_choice": ["A", "B"]}, "image/jpeg")
+    for text, image in [('Which "one"?\n é', "aW1n"), (None, "aW1n"), ("text only", None)]:
+        body = json.loads(template.body(text, image))
+        assert body == {
+            "model": "model",
+            "temperature": 0.0,
+            "max_tokens": 1,
+            "guided_choice": ["A", "B"],
+            "messages": template.messages(text, image),
+        }
+    assert template.messages(None, "aW1n")[0]["content"][0]["image_url"]["url"] == "data:image/jpeg;base64,aW1n"
+    assert template.cache_key("a", "aW1n") != template.cache_key("b", "aW1n")
+    other = workload.RequestTemplate("model", {"temperature": 0.0}, {"guided_choice": ["A", "C"]}, "image/jpeg")
+    assert template.cache_key("a", "aW1n") != other.cache_key("a", "aW1n")
+
+    udf = make_udf(FakeCompletions())
+    assert udf.template_for("model", {"temperature": 0.0}, None, "image/png") is udf.template_for(
+        "model", {"temperature": 0.0}, None, "image/png"
+    )
+
+
+def test_derive_max_tokens_bounds_structured_outputs():
+    assert workload.derive_max_tokens({"guided_choice": ["A", "B", "C", "D"]}) == 1
+    assert workload.derive_max_tokens({"guided_choice": ["yes", "no", "peut-être"]}) == 10  # UTF-8 bytes
+    assert workload.derive_max_tokens({"guided_regex": "(yes|no)"}) == 3
+    assert workload.derive_max_tokens({"guided_regex": "[A-D]{2}"}) == 2
+    assert workload.derive_max_tokens({"guided_regex": r"\d{1,3}"}) == 12  # \d also matches non-ASCII digits
+    assert workload.derive_max_tokens({"guided_regex": r"\w+@\w+\.com"}) is None
+    assert workload.derive_max_tokens({"guided_json": {"type": "object"}}) is None
+    assert workload.derive_max_tokens(None) is None
+
+    choice = {"guided_choice": ["A", "B"]}
+    assert workload.RequestTemplate("model", {"temperature": 0.0}, choice).request_params == {
+        "temperature": 0.0, "max_tokens": 1,
+    }
+    assert workload.RequestTemplate("model", {"max_tokens": 8}, choice).request_params == {"max_tokens": 8}
+    assert workload.RequestTemplate("model", None, choice, derive_output_tokens=False).request_params == {}
+
+
+def test_guided_spec_registry_interns_equivalent_specs():
+    registry = workload.GuidedSpecRegistry()
+    schema = {"type": "object", "properties": {"b": {"type": "string"}, "a": {"type": "integer"}}, "required": ["b", "a"]}
+    reordered = json.dumps({"required": ["b", "a"], "properties": {"b": {"type": "string"}, "a": {"type": "integer"}}, "type": "object"})
+
+    _, first, json_grammar = registry.canonicalize(None, {"guided_json": schema, "top_k": 1})
+    _, second, grammar = registry.canonicalize(None, {"guided_json": reordered})
+    assert grammar == json_grammar
+    assert first["guided_json"] is second["guided_json"] and first["top_k"] == 1
+    assert list(first["guided_json"]) == ["properties", "required", "type"]
+    assert list(first["guided_json"]["properties"]) == ["b", "a"]  # Field order is generation order
+
+    choices = [registry.canonicalize(None, {"guided_choice": c})[2] for c in (["B", "A"], ["A", "B", "A"])]
+    assert choices[0] == choices[1]
+    grammars = [registry.canonicalize(None, {"guided_grammar": g})[2] for g in ("root ::= x\n", "\n  root ::= x  ")]
+    assert grammars[0] == grammars[1]
+    response_format = {"type": "json_schema", "json_schema": {"name": "car", "schema": schema}}
+    params, _, _ = registry.canonicalize({"temperature": 0.0, "response_format": response_format}, None)
+    assert params["response_format"]["json_schema"]["schema"] == first["guided_json"]
+    assert registry.canonicalize({"temperature": 0.0}, {"top_k": 1}) == ({"temperature": 0.0}, {"top_k": 1}, None)
+    assert len(registry) == 4 and registry.uses[json_grammar] == 2
+
+
+def test_udf_reports_distinct_grammars():
+    workload.get_metrics().reset()
+    udf = make_udf(FakeCompletions())
+    texts, images = daft.Series.from_pylist(["A", "B"]), daft.Series.from_pylist([None, None])
+    for choices in (["A", "B"], ["B", "A"], ["A", "B", "C"]):
+        udf("model", texts, images, {"temperature": 0.0}, {"guided_choice": choices})
+
+    requests = workload.get_metrics().report()["requests"]
+    assert requests["count"] == 6 and requests["distinct_grammars"] == 2
+
+
+def test_token_budget_caps_estimated_tokens_in_flight():
+    completions = FakeCompletions(latency_s=0.005)
+    # Each request is 1 text token, 10 image tokens and at most 1 output token
+    udf = make_udf(completions, max_tokens_in_flight=36, image_tokens=10)
+    outputs = udf(
+        "model",
+        daft.Series.from_pylist(["q"] * 30),
+        daft.Series.from_pylist(["aW1n"] * 30),
+        sampling_params={"temperature": 0.0},
+        extra_body={"guided_choice": ["q"]},
+    )
+
+    assert results_of(outputs) == ["q"] * 30
+    assert completions.calls[0]["max_tokens"] == 1
+    assert completions.max_in_flight == 3
+    assert udf.token_budget.peak == 36 and udf.token_budget.in_flight == 0
+
+
+def test_token_budget_runs_oversized_requests_alone():
+    async def run():
+        budget = workload.TokenBudget(10)
+        running, peak = [], []
+
+        async def request(tokens):
+            async with budget.reserve(tokens):
+                running.append(tokens)
+                peak.append(list(running))
+                await asyncio.sleep(0.001)
+                running.remove(tokens)
+
+        await asyncio.gather(*(request(t) for t in [4, 4, 25, 4, 6]))
+        return peak
+
+    peak = asyncio.run(run())
+    assert all(sum(tokens) <= 10 or tokens == [25] for tokens in peak)
+    assert [25] in peak
+
+
+def test_retry_policy_budget_limits_retries():
+    policy = workload.RetryPolicy(max_attempts=5, budget_ratio=0.1, min_retries=2)
+    policy.requests = 10
+    error = workload.openai.APIConnectionError(request=None)
+    assert [policy.should_retry(1, error) for _ in range(4)] == [True, True, True, False]
+    assert not policy.should_retry(5, error)
+    assert not policy.should_retry(1, ValueError("bad"))
+    assert 0 <= policy.delay_s(3) <= policy.base_delay_s * 4
+
+
+def test_checkpointed_run_resumes_only_unfinished_rows(tmp_path, monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    # Daft runs the inference UDF in worker processes, which import the workload from PYTHONPATH
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    source = tmp_path / "ai2d.parquet"
+    rows = [
+        {"images": [{"bytes": b"%d" % i + row["images"][0]["bytes"], "path": None}], "texts": row["texts"]}
+        for i in range(10) for row in make_ai2d_rows()
+    ]
+    daft.from_pylist(rows).write_parquet(str(source))
+    checkpoint_dir = str(tmp_path / "checkpoint")
+
+    def run(config: MockServerConfig, model_id: str = "model") -> tuple[list[dict], int]:
+        with MockOpenAIServer(config) as server:
+            pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(
+                server.base_url, "none", checkpoint_dir=checkpoint_dir
+            )
+            rows = pipeline(model_id=model_id, dataset_uri=str(source / "*.parquet")).to_pylist()
+            return rows, server.stats()["requests"]
+
+    # Half the requests fail with a non-retryable error, leaving those rows out of the checkpoint
+    rows, _ = run(MockServerConfig(latency_ms=1, error_rate=0.5, error_status=400, seed=1))
+    failed = sum(r["result"] is None for r in rows)
+    assert 0 < failed < len(rows)
+
+    rows, requests = run(MockServerConfig(latency_ms=1))
+    assert len(rows) == 30
+    assert all(r["result"] in ("A", "B", "C", "D") for r in rows)
+    assert requests == failed
+
+    _, requests = run(MockServerConfig(latency_ms=1))
+    assert requests == 0
+    # Another model does not reuse the first model's results
+    _, requests = run(MockServerConfig(latency_ms=1), model_id="other-model")
+    assert requests == 30
+
+
+def test_process_limiter_grants_slots_round_robin_across_subsets():
+    limiter = workload._ProcessRequestLimiter(1)
+    order = []
+
+    async def request(subset):
+        async with limiter.slot(subset):
+            order.append(subset)
+            await asyncio.sleep(0.001)
+
+    async def main():
+        await limiter.acquire()  # Hold the only slot until every request is queued
+        tasks = [asyncio.ensure_future(request(s)) for s in ["a"] * 4 + ["b"] * 2]
+        await asyncio.sleep(0.01)
+        limiter.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == ["a", "b", "a", "b", "a", "a"]
+    assert workload.round_robin_order(["a", "a", "a", "b", "b"]) == [0, 3, 1, 4, 2]
+
+
+def test_evaluate_metrics_runs_lazy_pipeline_once():
+    calls = []
+
+    @daft.udf(return_dtype=daft.DataType.string())
+    def predict(results):
+        calls.append(len(results))
+        return results.to_pylist()
+
+    rows = [
+        {"subset": "ai2d", "answer": "A", "result": "A"},
+        {"subset": "ai2d", "answer": "B", "result": " A "},
+        {"subset": "ai2d", "answer": "B", "result": None},
+        {"subset": "chartqa", "answer": "C", "result": "C"},
+        {"subset": "chartqa", "answer": "D", "result": "maybe"},
+    ]
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    df = daft.from_pylist(rows).with_column("result", predict(col("result")))
+    metrics = pipeline.evaluate_metrics(pipeline.postprocess(df), by=["subset"])
+
+    assert sum(calls) == len(rows)
+    ai2d, chartqa = metrics.to_pylist()
+    assert (ai2d["subset"], ai2d["rows"], ai2d["correct"], ai2d["null_results"], ai2d["invalid_results"]) == ("ai2d", 3, 1, 1, 0)
+    assert ai2d["confusion"] == [
+        {"answer": "A", "prediction": "A", "count": 1},
+        {"answer": "B", "prediction": "A", "count": 1},
+        {"answer": "B", "prediction": None, "count": 1},
+    ]
+    assert (chartqa["accuracy"], chartqa["invalid_rate"], chartqa["null_rate"]) == (0.5, 0.5, 0.0)
+    assert pipeline.evaluate(df) == 0.4
+
+
+def test_validate_checks_choices_and_regexes_with_expressions():
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    df = daft.from_pylist([{"result": r} for r in ["A", "E", " B", None]])
+
+    assert pipeline.validate(df).to_pydict()["is_valid"] == [True, False, True, False]
+    emails = daft.from_pylist([{"result": r} for r in ["alan@enigma.com\n", "alan@enigma.org", "x alan@enigma.com\n"]])
+    out = pipeline.validate(emails, {"guided_regex": r"\w+@\w+\.com\n"}).to_pydict()
+    assert out["is_valid"] == [True, False, False]
+    assert out["parsed"] == out["result"]
+
+
+def test_postprocess_validates_each_config_with_its_own_constraint():
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    configs = {
+        "choice": {"model_id": "model"},
+        "yes_no": {"model_id": "model", "extra_body": {"guided_regex": "yes|no"}},
+    }
+    rows = [
+        {"config": "choice", "answer": "A", "result": "A"},
+        {"config": "choice", "answer": "A", "result": "yes"},
+        {"config": "yes_no", "answer": "A", "result": "yes"},
+        {"config": "yes_no", "answer": "A", "result": "A"},
+    ]
+    df = pipeline.postprocess(daft.from_pylist(rows), configs=configs)
+
+    assert df.to_pydict()["is_valid"] == [True, False, True, False]
+    metrics = pipeline.evaluate_metrics(df, by=["config"]).to_pylist()
+    assert [m["invalid_results"] for m in metrics] == [1, 1]
+
+
+def test_json_schema_dtype_maps_pydantic_schemas():
+    import enum
+    import pydantic
+
+    class CarType(str, enum.Enum):
+        SEDAN = "SEDAN"
+        SUV = "SUV"
+
+    class Car(pydantic.BaseModel):
+        brand: str
+        year: int | None = None
+        car_type: CarType
+        ratings: list[float]
+
+    assert workload.json_schema_dtype(Car.model_json_schema()) == daft.DataType.struct({
+        "brand": daft.DataType.string(),
+        "year": daft.DataType.int64(),
+        "car_type": daft.DataType.string(),
+        "ratings": daft.DataType.list(daft.DataType.float64()),
+    })
+    with pytest.raises(ValueError):
+        workload.json_schema_dtype({"anyOf": [{"type": "string"}, {"type": "integer"}]})
+
+
+def test_validate_checks_json_schemas_and_parses_results():
+    pytest.importorskip("jsonschema")
+    pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline("http://fake/v1", "none")
+    schema = {
+        "type": "object",
+        "properties": {"brand": {"type": "string"}, "year": {"type": "integer"}},
+        "required": ["brand", "year"],
+    }
+    results = ['{"brand": "Mazda", "year": 1990}', '{"brand": "Mazda"}', "not json", None]
+    out = pipeline.validate(daft.from_pylist([{"result": r} for r in results]), {"guided_json": schema}).to_pydict()
+
+    assert out["is_valid"] == [True, False, False, False]
+    assert out["parsed"][0] == {"brand": "Mazda", "year": 1990}
+    assert out["parsed"][2] is None
+
+
+def test_retry_invalid_resends_only_invalid_rows(monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    with MockOpenAIServer(MockServerConfig(latency_ms=1)) as server:
+        pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(server.base_url, "none")
+        df = pipeline.preprocess(daft.from_pylist(make_ai2d_rows()))
+        # Unconstrained, the mock echoes the prompt, which is not a valid choice
+        df = pipeline.postprocess(pipeline.infer(df, "model", extra_body={}, concurrency=1)).collect()
+        df = df.with_column("result", (col("row_id") == df.to_pydict()["row_id"][0]).if_else(lit("B"), col("result")))
+        df = pipeline.postprocess(df.exclude("is_correct", "is_valid", "parsed"))
+        assert df.to_pydict()["is_valid"] == [True, False, False]
+        server.reset_stats()
+
+        out = pipeline.retry_invalid(df, "model", concurrency=1).to_pylist()
+
+    assert server.stats()["requests"] == 2
+    assert len(out) == 3 and all(r["is_valid"] for r in out)
+
+
+def test_run_subsets_reports_accuracy_and_throughput_per_subset(tmp_path, monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    monkeypatch.setenv(workload.METRICS_DIR_ENV, str(tmp_path / "metrics"))
+    monkeypatch.setattr(workload.get_metrics(), "events_dir", str(tmp_path / "metrics"))
+    uris = {}
+    for subset, copies in (("ai2d", 3), ("chartqa", 1)):
+        daft.from_pylist(make_ai2d_rows() * copies).write_parquet(str(tmp_path / subset))
+        uris[subset] = str(tmp_path / subset / "*.parquet")
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=1)) as server:
+        pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(server.base_url, "none")
+        df = pipeline.run_subsets("model", uris).collect()
+        report = pipeline.evaluate_subsets(df)
+
+    assert not {"images", "texts"} & set(df.column_names)
+
+    assert set(report) == {"ai2d", "chartqa"}
+    assert report["ai2d"]["rows"] == 9
+    assert report["chartqa"]["rows"] == 3
+    assert all(0 <= r["accuracy"] <= 1 and r["failed"] == 0 for r in report.values())
+    assert all(r["requests_per_s"] > 0 for r in report.values())
+
+
+def test_interleave_subsets_orders_rows_round_robin():
+    df = daft.from_pydict({"subset": ["a"] * 4 + ["b"] * 2 + ["c"], "i": [0, 1, 2, 3, 0, 1, 0]})
+    out = workload.TheCauldronImageUnderstandingEvaluationPipeline.interleave_subsets(df).to_pydict()
+
+    assert list(zip(out["subset"], out["i"])) == [
+        ("a", 0), ("b", 0), ("c", 0), ("a", 1), ("b", 1), ("a", 2), ("a", 3),
+    ]
+
+
+def test_sweep_preprocesses_once_and_compares_configs(tmp_path, monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    monkeypatch.setenv(workload.METRICS_DIR_ENV, str(tmp_path / "metrics"))
+    monkeypatch.setattr(workload.get_metrics(), "events_dir", str(tmp_path / "metrics"))
+    source = tmp_path / "ai2d.parquet"
+    daft.from_pylist(make_ai2d_rows()).write_parquet(str(source))
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=1)) as server, MockOpenAIServer(MockServerConfig(latency_ms=1)) as other:
+        server.record_bodies = True
+        pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(server.base_url, "none")
+        configs = {
+            "greedy": {"model_id": "model-a"},
+            "sampled": {"model_id": "model-b", "sampling_params": {"temperature": 0.7}},
+            "other": {"model_id": "model-a", "base_url": other.base_url},
+        }
+        table = pipeline.sweep(str(source / "*.parquet"), configs, prepared_path=str(tmp_path / "prepared")).to_pylist()
+        assert server.stats()["requests"] == 6
+        assert other.stats()["requests"] == 3
+        assert {b["model"] for b in server.bodies} == {"model-a", "model-b"}
+        assert {b.get("temperature") for b in server.bodies} == {0.0, 0.7}
+
+        # A second sweep reuses the prepared rows rather than the source dataset
+        load_dataset, pipeline.load_dataset = pipeline.load_dataset, None
+        pipeline.sweep(str(source / "*.parquet"), {"greedy": configs["greedy"]}, prepared_path=str(tmp_path / "prepared"))
+        # but not for another row limit
+        pipeline.load_dataset = load_dataset
+        limited = pipeline.sweep(
+            str(source / "*.parquet"), {"greedy": configs["greedy"]}, row_limit=1, prepared_path=str(tmp_path / "prepared")
+        ).to_pylist()
+        assert limited[0]["rows"] == 2
+
+    assert [r["config"] for r in table] == ["greedy", "sampled", "other"]
+    assert all(r["rows"] == 3 and r["failed"] == 0 and r["requests_per_s"] > 0 for r in table)
+
+
+def test_endpoint_pool_routes_and_ejects_failing_replicas():
+    pool = workload.EndpointPool(["http://a/v1", "http://b/v1"], eject_after=2, ejection_s=0.0)
+    picked = [pool.pick() for _ in range(4)]
+    assert [e.base_url for e in picked] == ["http://a/v1", "http://b/v1"] * 2  # Least outstanding
+
+    a, b = pool.endpoints
+    error = workload.openai.APIConnectionError(request=None)
+    pool.record(a, 0.1, error)
+    pool.record(a, 0.1, error)
+    assert a.ejected and a.outstanding == 0
+    assert pool.pick() is b
+    assert pool.due_for_check() == [a]
+    pool.readmit(a)
+    assert pool.pick() is a
+
+    pool = workload.EndpointPool(["http://fast/v1", "http://slow/v1"], routing="latency")
+    fast, slow = pool.endpoints
+    assert pool.pick() is fast and pool.pick() is slow  # Untried replicas are tried first
+    pool.record(fast, 0.01)
+    pool.record(slow, 0.1)
+    assert [pool.pick() for _ in range(5)].count(fast) >= 4
+
+
+def test_udf_balances_across_endpoints_and_ejects_unhealthy():
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    texts = [f"q{i}" for i in range(200)]
+    with (
+        MockOpenAIServer(MockServerConfig(latency_ms=2)) as first,
+        MockOpenAIServer(MockServerConfig(latency_ms=2)) as second,
+        MockOpenAIServer(MockServerConfig(latency_ms=2, error_rate=1.0, error_status=503)) as broken,
+    ):
+        udf = workload.StructuredOutputsProdUDF.inner(
+            base_url=first.base_url, api_key="none", endpoints=[first.base_url, second.base_url, broken.base_url]
+        )
+        udf.retry_policy.base_delay_s = 0.001
+        results = results_of(udf("model", daft.Series.from_pylist(texts), daft.Series.from_pylist([None] * 200)))
+
+        assert results == texts
+        assert udf.pool.endpoints[2].ejected
+        assert broken.stats()["requests"] < 40  # Only the first window of requests reaches it
+        assert abs(first.stats()["requests"] - second.stats()["requests"]) < 50
+
+
+def test_health_checks_run_off_the_request_path():
+    completions = FakeCompletions()
+    udf = make_udf(completions, endpoints=["http://a/v1", "http://b/v1"])
+    udf.client_for = lambda base_url=None: udf.client
+    udf.pool.ejection_s = 0.0
+    a, b = udf.pool.endpoints
+    udf.pool.eject(a)
+    checked = []
+
+    async def hung_check(endpoint):
+        checked.append(endpoint)
+        await asyncio.sleep(5)
+
+    udf.check_endpoint = hung_check
+    start = time.perf_counter()
+    assert results_of(udf("model", daft.Series.from_pylist(["q0", "q1"]), daft.Series.from_pylist([None] * 2))) == ["q0", "q1"]
+
+    assert time.perf_counter() - start < 1  # Requests did not wait on the hung check
+    assert checked == [a] and a.probing and a.ejected
+    assert b.requests == 2
+
+
+def test_cancelled_requests_release_their_endpoint():
+    udf = make_udf(FakeCompletions(latency_s=5), endpoints=["http://a/v1"])
+    udf.client_for = lambda base_url=None: udf.client
+    [endpoint] = udf.pool.endpoints
+    endpoint.failures = 1
+
+    async def cancel_request():
+        task = asyncio.ensure_future(udf.generate("model", "q", None))
+        await asyncio.sleep(0.01)
+        assert endpoint.outstanding == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    udf.loop.run_until_complete(cancel_request())
+    assert endpoint.outstanding == 0
+    assert endpoint.failures == 1 and endpoint.latency_s is None  # Neither a success nor a failure
+
+
+def test_prefix_ordering_groups_shared_images_and_restores_order(tmp_path, monkeypatch):
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(workload.__file__))
+    source = tmp_path / "ai2d.parquet"
+    # Four images, each repeated in rows far apart from each other
+    rows = [
+        {"images": [{"bytes": b"image %d" % (i % 4), "path": None}], "texts": make_ai2d_rows()[0]["texts"]}
+        for i in range(16)
+    ]
+    daft.from_pylist(rows).write_parquet(str(source))
+
+    outputs, hits = {}, {}
+    for prefix_ordering in (False, True):
+        with MockOpenAIServer(MockServerConfig(latency_ms=1, prefix_cache_size=1)) as server:
+            pipeline = workload.TheCauldronImageUnderstandingEvaluationPipeline(
+                server.base_url, "none", prefix_ordering=prefix_ordering
+            )
+            df = pipeline(model_id="model", dataset_uri=str(source / "*.parquet"), concurrency=1)
+            outputs[prefix_ordering] = df.select("image_base64", "question", "result").to_pylist()
+            hits[prefix_ordering] = server.stats()["prefix_cache_hits"]
+
+    assert outputs[True] == outputs[False]  # Same rows in the same order
+    assert hits[True] >= 32 - 4 - 2  # Near every request after an image's first reuses its prefix
+    assert hits[True] > hits[False]
+
+
+def test_instances_on_background_loop_share_keep_alive_connections():
+    from mock_openai_server import MockOpenAIServer, MockServerConfig
+
+    with MockOpenAIServer(MockServerConfig(latency_ms=2)) as server:
+        workload.get_metrics().reset()
+        udfs = [
+            workload.StructuredOutputsProdUDF.inner(
+                base_url=server.base_url, api_key="none", max_in_flight=8, background_loop=True
+            )
+            for _ in range(2)
+        ]
+        assert udfs[0].client is udfs[1].client
+        for udf in udfs * 2:
+            udf("model", daft.Series.from_pylist(["q"] * 50), daft.Series.from_pylist([None] * 50))
+
+        requests = workload.get_metrics().report()["requests"]
+        assert requests["count"] == 200
+        assert 0 < requests["new_connections"] <= 8  # Opened by the first batch, then reused
+        [stats] = [s for s in workload.get_client_pool().stats() if s["base_url"] == server.base_url]
+        # None if httpcore's pool internals moved, see `ClientPool.stats`
+        assert stats["connections"] is not None and stats["waiting"] is not None
+        assert stats["connections"] <= 8 and stats["waiting"] == 0
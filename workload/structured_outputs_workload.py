@@ -15,27 +15,1716 @@ If you are using a different instance, you WILL need to adjust the memory utiliz
 # Import Dependencies & Define Variables
 
 import time
-from typing import Any
+from typing import Any, Awaitable, Callable, Iterable, TypeVar
 import asyncio
-import base64
+import atexit
+import binascii
+import concurrent.futures
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import operator
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import uuid
+from collections import deque
+from re import _constants as sre_constants, _parser as sre_parse
 
 import daft
-from daft import col, lit
-from daft.functions import format
+import httpx
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+from daft import Window, col, lit
+from daft.functions import format, monotonically_increasing_id, row_number
+import openai
 from openai import AsyncOpenAI
 
 import logging
 
 logger = logging.getLogger(__name__)
-@daft.udf(return_dtype=daft.DataType.string(), concurrency=4)
-class StructuredOutputsProdUDF:
-    def __init__(self, base_url: str, api_key: str):
-        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+
+T = TypeVar("T")
+
+# Default cap on in-flight requests per UDF instance. With the default of 4 actors this
+# matches vLLM's default `max_num_seqs` of 256, keeping the server queue full but bounded.
+DEFAULT_MAX_IN_FLIGHT = 64
+# Default cap on in-flight requests shared by every UDF instance in the process.
+DEFAULT_PROCESS_MAX_IN_FLIGHT = 256
+# HTTP statuses with which an overloaded server rejects requests
+REJECTION_STATUS_CODES = (429, 503)
+# HTTP statuses worth retrying
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+# Inference UDF output: the model's answer, or null with the error that prevented it
+INFERENCE_ERROR_DTYPE = daft.DataType.struct({
+    "type": daft.DataType.string(),
+    "message": daft.DataType.string(),
+    "status_code": daft.DataType.int64(),
+    "attempts": daft.DataType.int64(),
+})
+INFERENCE_DTYPE = daft.DataType.struct({
+    "result": daft.DataType.string(),
+    "error": INFERENCE_ERROR_DTYPE,
+})
+# Answers of the multiple choice questions, constrained with guided_choice during inference
+ANSWER_CHOICES = ["A", "B", "C", "D"]
+# Default number of rows processed at a time in streaming mode
+DEFAULT_STREAMING_CHUNK_ROWS = 256
+# Image payload columns dropped from streaming output, which only needs the inference results
+STREAMING_DROP_COLUMNS = ("images", "image_bytes", "image_base64")
+# Environment variable naming a directory that every process spools its metrics events to
+METRICS_DIR_ENV = "WORKLOAD_METRICS_DIR"
+# Buffered metrics events are spooled once there are this many, or this long after the last spool
+SPOOL_FLUSH_EVENTS = 256
+SPOOL_FLUSH_S = 1.0
+# Default size budget for the on-disk response cache before least-recently-used entries are evicted.
+DEFAULT_CACHE_MAX_BYTES = 1 << 30
+# How long idle keep-alive connections to the server are kept open. Matches httpx's default;
+# expiries of 30s and more measured several times slower against the benchmark's mock server.
+DEFAULT_KEEPALIVE_EXPIRY_S = 5.0
+# Request templates kept per UDF instance, one per inference config in the batch
+MAX_REQUEST_TEMPLATES = 16
+# Prompt token estimates for the token budget: Gemma 3 and 3n encode every image as 256 soft
+# tokens, and English text averages about 4 characters per token
+DEFAULT_IMAGE_TOKENS = 256
+CHARS_PER_TOKEN = 4
+
+
+class _ProcessRequestLimiter:
+    """Async semaphore shared by every UDF instance in the process.
+
+    Each UDF instance drives its own event loop, so an `asyncio.Semaphore` cannot be shared
+    between them. Waiters are parked on futures of their own loop and woken thread-safely.
+
+    Waiters are queued per key (e.g. the dataset subset a request belongs to) and slots are
+    granted round-robin across keys, so a key with a deep backlog cannot starve the others.
+    """
+
+    def __init__(self, limit: int):
+        self._lock = threading.Lock()
+        self._limit = limit
+        self._in_flight = 0
+        self._waiters: dict[Any, deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]]] = {}
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def set_limit(self, limit: int) -> None:
+        with self._lock:
+            self._limit = limit
+            self._wake_waiters()
+
+    async def acquire(self, key: Any = None) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._in_flight < self._limit and not self._waiters:
+                self._in_flight += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.setdefault(key, deque()).append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    queue = self._waiters[key]
+                    queue.remove((loop, waiter))
+                    if not queue:
+                        del self._waiters[key]
+                    granted = False
+                except (KeyError, ValueError):
+                    # Already granted a slot. If the grant has not been delivered yet,
+                    # `_deliver` sees the cancelled future and hands the slot back.
+                    granted = waiter.done() and not waiter.cancelled()
+            if granted:
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        # Caller must hold self._lock
+        while self._waiters and self._in_flight < self._limit:
+            # Serve the key at the front, then move it to the back of the rotation
+            key = next(iter(self._waiters))
+            queue = self._waiters.pop(key)
+            loop, waiter = queue.popleft()
+            if queue:
+                self._waiters[key] = queue
+            self._in_flight += 1
+            try:
+                loop.call_soon_threadsafe(self._deliver, waiter)
+            except RuntimeError:
+                # The waiter's loop has been closed, so nobody will consume this slot
+                self._in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key: Any = None):
+        """Holds one slot for the body, queueing fairly with other waiters of other keys."""
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _deliver(self, waiter: asyncio.Future) -> None:
+        if waiter.done():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+_process_limiter: _ProcessRequestLimiter | None = None
+_process_limiter_lock = threading.Lock()
+
+
+def get_process_limiter(limit: int = DEFAULT_PROCESS_MAX_IN_FLIGHT) -> _ProcessRequestLimiter:
+    """Returns the process-wide request limiter, resizing it to `limit` if it already exists."""
+    global _process_limiter
+    with _process_limiter_lock:
+        if _process_limiter is None:
+            _process_limiter = _ProcessRequestLimiter(limit)
+        elif _process_limiter.limit != limit:
+            _process_limiter.set_limit(limit)
+        return _process_limiter
+
+
+async def windowed_gather(coros: Iterable[Awaitable[T]], window: int) -> list[T]:
+    """Awaits `coros` with at most `window` in flight, returning results in input order.
+
+    Coroutines are pulled from the iterable lazily, so a new request is only built once a
+    slot in the window frees up rather than queueing the whole batch up front.
+    """
+    if window < 1:
+        raise ValueError(f"window must be >= 1, got {window}")
+
+    items = enumerate(coros)
+    pending: dict[asyncio.Future, int] = {}
+    results: dict[int, T] = {}
+
+    def fill():
+        for idx, coro in itertools.islice(items, window - len(pending)):
+            pending[asyncio.ensure_future(coro)] = idx
+
+    fill()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[pending.pop(task)] = task.result()
+            fill()
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+
+    return [results[i] for i in range(len(results))]
+
+
+def round_robin_order(keys: list[Any]) -> list[int]:
+    """Returns indices of `keys` visiting each distinct key in turn, keeping order within a key.
+
+    For example, keys `[a, a, a, b, b]` give `[0, 3, 1, 4, 2]`.
+    """
+    groups: dict[Any, deque[int]] = {}
+    for idx, key in enumerate(keys):
+        groups.setdefault(key, deque()).append(idx)
+    order = []
+    queues = list(groups.values())
+    while queues:
+        for queue in queues:
+            order.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return order
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Nearest-rank percentile of `values` for `q` in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+class MetricsRecorder:
+    """Collects per-stage batch and per-request timings while a pipeline runs lazily.
+
+    Stages report through pass-through probe UDFs (see
+    `TheCauldronImageUnderstandingEvaluationPipeline.instrument`) and inference requests report
+    from `StructuredOutputsProdUDF.generate`, so measuring never forces materialization.
+
+    Daft runs class UDFs with concurrency in worker processes. To include their events, set
+    `events_dir` (or the WORKLOAD_METRICS_DIR environment variable, which workers inherit) and
+    every process also appends its events to a JSONL file there. Events are buffered and
+    appended in batches, at the latest when the inference UDFs finish a batch, see `flush`.
+    Without either, `spool_to_temporary_dir` provides a directory, which `infer` passes to
+    the inference UDFs.
+    """
+
+    def __init__(self, events_dir: str | None = None):
+        self._lock = threading.Lock()
+        self.events_dir = events_dir or os.environ.get(METRICS_DIR_ENV)
+        self._temporary_dir: tempfile.TemporaryDirectory | None = None
+        self._clear()
+        atexit.register(self.close)
+
+    def _clear(self) -> None:
+        self.started_at = time.time()
+        self.batches: list[dict[str, Any]] = []
+        self.requests: list[dict[str, Any]] = []
+        self._unspooled: list[dict[str, Any]] = []
+        self._spooled_at = time.monotonic()
+
+    def reset(self) -> None:
+        """Clears recorded events, including those spooled to `events_dir` by any process."""
+        with self._lock:
+            # Not done on construction: worker processes create their recorder mid-run
+            self._clear()
+            if self.events_dir and os.path.isdir(self.events_dir):
+                for name in os.listdir(self.events_dir):
+                    if name.endswith(".jsonl"):
+                        os.remove(os.path.join(self.events_dir, name))
+
+    def record_batch(self, stage: str, num_rows: int, num_bytes: int) -> None:
+        self._record(self.batches, {"kind": "batch", "stage": stage, "timestamp": time.time(), "rows": num_rows, "bytes": num_bytes})
+
+    def record_request(self,
+        latency_s: float,
+        ok: bool = True,
+        cached: bool = False,
+        subset: str | None = None,
+        connect_s: float = 0.0,
+        grammar: str | None = None,
+    ) -> None:
+        self._record(self.requests, {
+            "kind": "request", "timestamp": time.time(), "latency_s": latency_s, "ok": ok, "cached": cached,
+            "subset": subset, "connect_s": connect_s, "grammar": grammar,
+        })
+
+    def _record(self, events: list[dict[str, Any]], event: dict[str, Any]) -> None:
+        with self._lock:
+            events.append(event)
+            if self.events_dir:
+                self._unspooled.append(event)
+                if len(self._unspooled) >= SPOOL_FLUSH_EVENTS or time.monotonic() - self._spooled_at >= SPOOL_FLUSH_S:
+                    self._spool()
+
+    def flush(self) -> None:
+        """Appends buffered events to this process's file in `events_dir`."""
+        with self._lock:
+            self._spool()
+
+    def spool_to_temporary_dir(self) -> None:
+        """Sets `events_dir` to a temporary directory of this recorder, if it has none. The
+        directory is created once and removed by `close`."""
+        with self._lock:
+            if self.events_dir is None:
+                if self._temporary_dir is None:
+                    self._temporary_dir = tempfile.TemporaryDirectory(prefix="workload-metrics-")
+                self.events_dir = self._temporary_dir.name
+
+    def close(self) -> None:
+        """Flushes buffered events and removes the directory of `spool_to_temporary_dir`.
+        Called at exit."""
+        self.flush()
+        with self._lock:
+            if self._temporary_dir is not None:
+                if self.events_dir == self._temporary_dir.name:
+                    self.events_dir = None
+                self._temporary_dir.cleanup()
+                self._temporary_dir = None
+
+    def _spool(self) -> None:
+        self._spooled_at = time.monotonic()
+        if not self.events_dir or not self._unspooled:
+            return
+        os.makedirs(self.events_dir, exist_ok=True)
+        with open(os.path.join(self.events_dir, f"events-{os.getpid()}.jsonl"), "a") as f:
+            f.write("".join(json.dumps(event) + "\n" for event in self._unspooled))
+        self._unspooled = []
+
+    def events(self) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        """Returns the batch and request events, including those spooled by other processes."""
+        with self._lock:
+            self._spool()
+            if not self.events_dir or not os.path.isdir(self.events_dir):
+                return list(self.batches), list(self.requests)
+            batches, requests = [], []
+            for name in sorted(os.listdir(self.events_dir)):
+                if not name.endswith(".jsonl"):
+                    continue
+                with open(os.path.join(self.events_dir, name)) as f:
+                    for line in f:
+                        event = json.loads(line)
+                        (batches if event["kind"] == "batch" else requests).append(event)
+            return batches, requests
+
+    def report(self) -> dict[str, Any]:
+        """Summarizes rows/s, bytes/s and latency percentiles per stage and for inference requests.
+
+        A stage's batch interval is the time between consecutive batches leaving it, the
+        first counted from the start of the run, and its throughput is measured over the time
+        until its last batch.
+        """
+        batches, requests = self.events()
+
+        stages = {}
+        for batch in batches:
+            stages.setdefault(batch["stage"], []).append(batch)
+
+        report: dict[str, Any] = {"started_at": self.started_at, "stages": {}, "requests": {}}
+        for stage, events in stages.items():
+            rows = sum(e["rows"] for e in events)
+            num_bytes = sum(e["bytes"] for e in events)
+            arrivals = sorted(e["timestamp"] - self.started_at for e in events)
+            intervals = [b - a for a, b in zip([0.0, *arrivals], arrivals)]
+            elapsed = max(arrivals[-1], 1e-9)
+            report["stages"][stage] = {
+                "batches": len(events),
+                "rows": rows,
+                "bytes": num_bytes,
+                "elapsed_s": elapsed,
+                "rows_per_s": rows / elapsed,
+                "bytes_per_s": num_bytes / elapsed,
+                "batch_interval_p50_s": percentile(intervals, 50),
+                "batch_interval_p99_s": percentile(intervals, 99),
+            }
+
+        latencies = [r["latency_s"] for r in requests if r["ok"] and not r["cached"]]
+        report["requests"] = {
+            "count": len(requests),
+            "errors": sum(not r["ok"] for r in requests),
+            "cache_hits": sum(r["cached"] for r in requests),
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p90_s": percentile(latencies, 90),
+            "latency_p99_s": percentile(latencies, 99),
+            "latency_max_s": max(latencies) if latencies else None,
+            # Requests that waited on opening a connection, and the total time spent doing so
+            "new_connections": sum(r.get("connect_s", 0) > 0 for r in requests),
+            "connect_s": sum(r.get("connect_s", 0) for r in requests),
+            # Distinct structured output specs, each compiled to a grammar by the server
+            "distinct_grammars": len({r["grammar"] for r in requests if r.get("grammar") is not None}),
+        }
+
+        # Per-subset throughput is measured from the subset's first request to its last response
+        subsets: dict[str, list[dict[str, Any]]] = {}
+        for request in requests:
+            if request.get("subset") is not None:
+                subsets.setdefault(request["subset"], []).append(request)
+        if subsets:
+            report["subsets"] = {}
+        for subset, events in subsets.items():
+            latencies = [e["latency_s"] for e in events if e["ok"] and not e["cached"]]
+            elapsed = max(
+                max(e["timestamp"] for e in events) - min(e["timestamp"] - e["latency_s"] for e in events), 1e-9
+            )
+            report["subsets"][subset] = {
+                "count": len(events),
+                "errors": sum(not e["ok"] for e in events),
+                "elapsed_s": elapsed,
+                "requests_per_s": len(events) / elapsed,
+                "latency_p50_s": percentile(latencies, 50),
+                "latency_p99_s": percentile(latencies, 99),
+            }
+        return report
+
+    def write_report(self, path: str) -> None:
+        """Writes the summary as JSON, or the raw batch and request events as Parquet."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith(".parquet"):
+            batches, requests = self.events()
+            events = batches + requests
+            columns = (
+                "kind", "stage", "timestamp", "rows", "bytes", "latency_s", "ok", "cached", "subset", "connect_s", "grammar",
+            )
+            pq.write_table(pa.table({c: [e.get(c) for e in events] for c in columns}), path)
+        else:
+            with open(path, "w") as f:
+                json.dump(self.report(), f, indent=2)
+
+
+_metrics = MetricsRecorder()
+
+
+def get_metrics() -> MetricsRecorder:
+    """Returns the process-wide metrics recorder."""
+    return _metrics
+
+
+def _probe_stage(values: daft.Series, stage: str) -> daft.Series:
+    get_metrics().record_batch(stage, len(values), values.size_bytes())
+    return values
+
+
+@daft.udf(return_dtype=INFERENCE_DTYPE)
+def checkpoint_inference(row_id: daft.Series, inference: daft.Series, checkpoint_dir: str) -> daft.Series:
+    """Appends the batch's completed rows to `checkpoint_dir` and passes `inference` through.
+
+    Each batch is written to its own Parquet file, renamed into place once complete so a
+    killed run never leaves a partial file behind. Failed rows are not checkpointed and are
+    retried by the next run. Rows are stamped with the time they were written, so results
+    of a resent row replace the earlier ones, see `load_checkpoint`.
+    """
+    result = inference.to_arrow().field("result")
+    completed = pc.is_valid(result)
+    table = pa.table({
+        "row_id": row_id.to_arrow(),
+        "result": result,
+        "checkpointed_at": pa.array([time.time()] * len(row_id), pa.float64()),
+    }).filter(completed)
+    if table.num_rows:
+        path = os.path.join(checkpoint_dir, f"part-{uuid.uuid4().hex}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return inference
+
+
+def json_schema_dtype(schema: dict[str, Any], defs: dict[str, Any] | None = None) -> daft.DataType:
+    """Maps a JSON schema to the Daft type of its instances, so outputs parse into columns.
+
+    Supports objects with `properties`, arrays, scalars, enums, local `$ref`s and optional
+    (nullable) members, which covers the schemas Pydantic generates for plain models.
+    Raises ValueError for other constructs, e.g. unions of several types.
+    """
+    defs = schema.get("$defs", schema.get("definitions", {})) if defs is None else defs
+    if "$ref" in schema:
+        return json_schema_dtype(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+    for union in ("anyOf", "oneOf"):
+        if union in schema:
+            members = [m for m in schema[union] if m.get("type") != "null"]
+            if len(members) != 1:
+                raise ValueError(f"Unsupported JSON schema union: {schema[union]}")
+            return json_schema_dtype(members[0], defs)
+
+    types = schema.get("type")
+    if types is None and ("enum" in schema or "const" in schema):
+        values = schema.get("enum", [schema.get("const")])
+        types = {str: "string", bool: "boolean", int: "integer", float: "number"}.get(type(values[0]))
+    if isinstance(types, list):
+        types = [t for t in types if t != "null"]
+        if len(types) != 1:
+            raise ValueError(f"Unsupported JSON schema union of types: {schema['type']}")
+        types = types[0]
+
+    scalars = {
+        "string": daft.DataType.string(),
+        "integer": daft.DataType.int64(),
+        "number": daft.DataType.float64(),
+        "boolean": daft.DataType.bool(),
+    }
+    if types in scalars:
+        return scalars[types]
+    if types == "array" and "items" in schema:
+        return daft.DataType.list(json_schema_dtype(schema["items"], defs))
+    if types == "object" and schema.get("properties"):
+        return daft.DataType.struct({
+            name: json_schema_dtype(member, defs) for name, member in schema["properties"].items()
+        })
+    raise ValueError(f"Unsupported JSON schema: {schema}")
+
+
+@functools.lru_cache(maxsize=64)
+def _json_schema_validator(schema: str):
+    # Compiled once per process and schema, then reused by every batch
+    import jsonschema
+
+    schema = json.loads(schema)
+    validator = jsonschema.validators.validator_for(schema)
+    validator.check_schema(schema)
+    return validator(schema)
+
+
+@daft.udf(return_dtype=daft.DataType.bool())
+def validate_json_schema(results: daft.Series, schema: str) -> list[bool]:
+    """Whether each result is a JSON document conforming to `schema`, given as a JSON string.
+
+    Requires the `jsonschema` package.
+    """
+    validator = _json_schema_validator(schema)
+    valid = []
+    for result in results.to_pylist():
         try:
-            self.loop = asyncio.get_running_loop()
-        except RuntimeError:
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
+            valid.append(result is not None and validator.is_valid(json.loads(result)))
+        except json.JSONDecodeError:
+            valid.append(False)
+    return valid
+
+
+def constraint_checks(
+    extra_body: dict[str, Any] | None = None,
+    response_format: dict[str, Any] | None = None,
+) -> tuple[daft.Expression, daft.Expression]:
+    """Expressions for whether `result` satisfies the structured output constraint the rows
+    were generated with, and for `result` as a typed value, see `Pipeline.validate`.
+
+    Choices are compared with surrounding whitespace stripped, like `is_correct`.
+    """
+    extra_body = {"guided_choice": ANSWER_CHOICES} if extra_body is None and response_format is None else extra_body or {}
+    result = col("result")
+    schema = extra_body.get("guided_json")
+    if response_format is not None and response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"].get("schema", {})
+
+    if extra_body.get("guided_choice"):
+        # `is_in` on a stripped string panics Daft's optimizer, compare with each choice instead
+        stripped = result.str.lstrip().str.rstrip()
+        return functools.reduce(operator.or_, (stripped == str(choice) for choice in extra_body["guided_choice"])), result
+    if extra_body.get("guided_regex"):
+        return result.str.match(f"^(?:{extra_body['guided_regex']})$"), result
+    if schema is not None:
+        schema = canonical_json_schema(schema)
+        return validate_json_schema(result, schema=json.dumps(schema)), result.try_deserialize("json", json_schema_dtype(schema))
+    return result.not_null(), result
+
+
+def response_model_dtype(response_model: type) -> daft.DataType:
+    """The Daft struct type of instances of a Pydantic model, see `json_schema_dtype`."""
+    return json_schema_dtype(response_model.model_json_schema())
+
+
+def required_fields(schema: dict[str, Any]) -> list[str]:
+    """The members an object of a JSON schema must have with a non-null value."""
+    def nullable(member: dict[str, Any]) -> bool:
+        types = member.get("type")
+        return (
+            types == "null" or isinstance(types, list) and "null" in types
+            or any(nullable(m) for union in ("anyOf", "oneOf") for m in member.get(union, []))
+        )
+    properties = schema.get("properties", {})
+    return [name for name in schema.get("required", []) if not nullable(properties.get(name, {}))]
+
+
+def response_format_for(response_model: type) -> dict[str, Any]:
+    """The OpenAI `json_schema` response format constraining outputs to a Pydantic model."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": response_model.__name__, "schema": response_model.model_json_schema()},
+    }
+
+
+def inference_dtype(result_dtype: daft.DataType) -> daft.DataType:
+    """The inference UDF output type with results of `result_dtype` instead of strings."""
+    return daft.DataType.struct({"result": result_dtype, "error": INFERENCE_ERROR_DTYPE})
+
+
+def _json_reader_type(dtype: pa.DataType) -> pa.DataType:
+    # Arrow's JSON reader only converts to 32-bit offset strings and lists
+    if pa.types.is_large_string(dtype):
+        return pa.string()
+    if pa.types.is_large_list(dtype) or pa.types.is_list(dtype):
+        return pa.list_(_json_reader_type(dtype.value_type))
+    if pa.types.is_struct(dtype):
+        return pa.struct([pa.field(field.name, _json_reader_type(field.type)) for field in dtype])
+    return dtype
+
+
+def _read_json_structs(documents: list[bytes], schema: pa.Schema) -> pa.StructArray | None:
+    """Reads one JSON object per document, or returns None if any document is not one."""
+    buffer = b"\n".join(documents) + b"\n"
+    try:
+        table = pa_json.read_json(
+            io.BytesIO(buffer),
+            read_options=pa_json.ReadOptions(block_size=max(len(buffer), 1 << 20)),
+            parse_options=pa_json.ParseOptions(
+                explicit_schema=schema, newlines_in_values=True, unexpected_field_behavior="ignore"
+            ),
+        )
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+    # A document of several objects, or of only whitespace, would misalign the rows
+    if table.num_rows != len(documents):
+        return None
+    return table.combine_chunks().to_struct_array().combine_chunks()
+
+
+def parse_json_structs(
+    results: list[str | None], dtype: daft.DataType, required: Iterable[str] = (),
+) -> pa.Array:
+    """Parses JSON objects into an Arrow struct array of `dtype` with Arrow's JSON reader.
+
+    The batch is parsed in one pass without building a Python object per row. If a result is
+    not an object of `dtype`, the results are parsed one at a time and those rows are null, as
+    are null results. Fields missing from an object are null, and so is the whole row if one
+    of the `required` fields is, see `required_fields`.
+    """
+    arrow_dtype = dtype.to_arrow_dtype()
+    schema = pa.schema(list(_json_reader_type(arrow_dtype)))
+    mask = pa.array([result is None for result in results])
+    documents = [b"{}" if result is None else result.encode("utf-8") for result in results]
+    parsed = _read_json_structs(documents, schema) if documents else pa.array([], pa.struct(list(schema)))
+    if parsed is None:
+        empty = _read_json_structs([b"{}"], schema)
+        rows = [_read_json_structs([document], schema) for document in documents]
+        mask = pa.array([result is None or row is None for result, row in zip(results, rows)])
+        parsed = pa.concat_arrays([empty if row is None else row for row in rows])
+    for name in required:
+        mask = pc.or_(mask, pc.is_null(parsed.field(name)))
+    return pc.if_else(mask, pa.scalar(None, parsed.type), parsed).cast(arrow_dtype)
+
+
+def typed_inference_outputs(
+    outputs: list[dict[str, Any]], result_dtype: daft.DataType, required: Iterable[str] = (),
+) -> pa.StructArray:
+    """Converts inference UDF outputs to an Arrow array of `inference_dtype(result_dtype)`.
+
+    Results that do not parse as `result_dtype`, or lack one of the `required` fields, are
+    null, with an `OutputParseError`.
+    """
+    results = [output["result"] for output in outputs]
+    parsed = parse_json_structs(results, result_dtype, required)
+    errors = [
+        output["error"] if result is None or is_parsed else {
+            "type": "OutputParseError",
+            "message": f"Output is not a JSON object of the response model: {result[:200]!r}",
+            "status_code": None,
+            "attempts": None,
+        }
+        for output, result, is_parsed in zip(outputs, results, parsed.is_valid().to_pylist())
+    ]
+    return pa.StructArray.from_arrays(
+        [parsed, pa.array(errors, INFERENCE_ERROR_DTYPE.to_arrow_dtype())], names=["result", "error"]
+    )
+
+
+def with_response_model(udf: Any, response_model: type) -> Any:
+    """Returns an inference UDF with init args whose results are structs of `response_model`.
+
+    Outputs are parsed in batch by `parse_json_structs` inside the UDF, so no per-row
+    `json.loads` is needed downstream. The requests still have to constrain the outputs to
+    the model, e.g. with `response_format_for(response_model)`.
+    """
+    args, kwargs = udf.init_args or ((), {})
+    udf = udf.with_init_args(*args, **{**kwargs, "response_model": response_model})
+    return dataclasses.replace(udf, return_dtype=inference_dtype(response_model_dtype(response_model)))
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of chat completion responses.
+
+    Entries live in a single SQLite file keyed by the sha256 of the canonical JSON request
+    (model, messages including base64 image data, sampling params and extra_body). Once the
+    stored responses exceed `max_bytes` the least recently read entries are evicted. The file
+    can be shared by UDF instances in different processes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._total_bytes = self._stored_bytes()
+
+    @staticmethod
+    def make_key(request: dict[str, Any]) -> str:
+        payload = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _stored_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self) -> None:
+        # Caller must hold self._lock. Other processes may share the file, so recount first.
+        self._total_bytes = self._stored_bytes()
+        excess = self._total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._total_bytes = self._stored_bytes()
+        logger.debug(f"Evicted {len(evicted)} cached responses, {self._total_bytes} bytes remain")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class AdaptiveConcurrencyController:
+    """Tunes the number of in-flight requests of one UDF instance with AIMD.
+
+    Latencies are collected over windows of `window` completed requests. At the end of each
+    window the limit is
+      - halved if the server rejected requests (429/503) or requests timed out,
+      - reduced by 10% if the window's p50 exceeds `latency_tolerance` times the baseline
+        (lowest p50 seen) or its p99 exceeds `tail_tolerance` times the baseline,
+      - otherwise grown by sqrt(limit) if the limit was actually reached during the window.
+    The baseline drifts up slowly, so the controller keeps probing if the server gets slower.
+    All methods must be called from the same event loop.
+    """
+
+    def __init__(self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: int | None = None,
+        window: int = 32,
+        latency_tolerance: float = 2.0,
+        tail_tolerance: float = 4.0,
+        backoff: float = 0.5,
+        baseline_drift: float = 0.01,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.window = window
+        self.latency_tolerance = latency_tolerance
+        self.tail_tolerance = tail_tolerance
+        self.backoff = backoff
+        self.baseline_drift = baseline_drift
+        self.baseline: float | None = None
+        self._limit = float(initial_limit or max(min_limit, min(max_limit, 16)))
+        self._in_flight = 0
+        self._peak = 0
+        self._samples: list[float] = []
+        self._rejections = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self) -> None:
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    self._wake_waiters()
+                raise
+        self._in_flight += 1
+        self._peak = max(self._peak, self._in_flight)
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        for _ in range(min(len(self._waiters), self.limit - self._in_flight)):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def observe(self, latency_s: float | None = None, rejected: bool = False) -> None:
+        """Records a completed request's latency, or a server rejection."""
+        if rejected:
+            self._rejections += 1
+        if latency_s is not None:
+            self._samples.append(latency_s)
+        if len(self._samples) >= self.window or self._rejections >= self.window:
+            self._update()
+
+    def observe_status(self, status_code: int) -> None:
+        """Records an HTTP error status, counting 429 and 503 as rejections."""
+        if status_code in REJECTION_STATUS_CODES:
+            self.observe(rejected=True)
+
+    def _update(self) -> None:
+        previous = self.limit
+        p50 = percentile(self._samples, 50)
+        p99 = percentile(self._samples, 99)
+        if p50 is not None:
+            self.baseline = p50 if self.baseline is None else min(self.baseline * (1 + self.baseline_drift), p50)
+
+        if self._rejections:
+            self._limit *= self.backoff
+        elif p50 is not None and (p50 > self.latency_tolerance * self.baseline or p99 > self.tail_tolerance * self.baseline):
+            self._limit *= 0.9
+        elif self._peak >= self.limit:
+            self._limit += math.sqrt(self._limit)
+        self._limit = min(float(self.max_limit), max(float(self.min_limit), self._limit))
+
+        self._samples = []
+        self._rejections = 0
+        self._peak = self._in_flight
+        if self.limit != previous:
+            logger.debug(f"Adaptive concurrency limit {previous} -> {self.limit} (p50={p50}, p99={p99}, baseline={self.baseline})")
+            self._wake_waiters()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class RetryPolicy:
+    """Jittered exponential backoff with a retry budget.
+
+    A retryable failure of attempt n waits a uniformly random time in
+    [0, min(max_delay_s, base_delay_s * 2**(n-1))], or the server's Retry-After if longer.
+    Retries are also capped at `min_retries` plus `budget_ratio` times the number of requests,
+    so an unhealthy server is not hit with a retry storm.
+    """
+
+    def __init__(self,
+        max_attempts: int = 4,
+        base_delay_s: float = 0.5,
+        max_delay_s: float = 20.0,
+        budget_ratio: float = 0.2,
+        min_retries: int = 10,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+
+    @staticmethod
+    def is_retryable(exc: BaseException) -> bool:
+        if isinstance(exc, openai.APIConnectionError): # Includes timeouts
+            return True
+        if isinstance(exc, openai.APIStatusError):
+            return exc.status_code in RETRYABLE_STATUS_CODES
+        return False
+
+    def should_retry(self, attempt: int, exc: BaseException) -> bool:
+        if attempt >= self.max_attempts or not self.is_retryable(exc):
+            return False
+        if self.retries >= self.min_retries + self.budget_ratio * self.requests:
+            logger.warning(f"Retry budget exhausted after {self.retries} retries for {self.requests} requests")
+            return False
+        self.retries += 1
+        return True
+
+    def delay_s(self, attempt: int, exc: BaseException | None = None) -> float:
+        delay = random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** (attempt - 1)))
+        if isinstance(exc, openai.APIStatusError):
+            try:
+                delay = max(delay, min(float(exc.response.headers.get("retry-after")), self.max_delay_s))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+
+def inference_error(exc: BaseException, attempts: int) -> dict[str, Any]:
+    return {
+        "type": type(exc).__name__,
+        "message": str(exc)[:1000],
+        "status_code": getattr(exc, "status_code", None),
+        "attempts": attempts,
+    }
+
+
+class Endpoint:
+    """Routing state of one replica in an `EndpointPool`."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.latency_s: float | None = None # Moving average of successful request latency
+        self.requests = 0
+        self.failures = 0 # Consecutive failures
+        self.ejections = 0 # Consecutive ejections, lengthening each ejection
+        self.ejected_until: float | None = None
+        self.probing = False
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until is not None
+
+
+class EndpointPool:
+    """Routes requests across replicas of an OpenAI-compatible server.
+
+    Each request goes to the admitted replica with the fewest outstanding requests
+    ("least_outstanding"), or with the lowest expected wait, its average latency times its
+    outstanding requests plus one ("latency"). A replica that fails `eject_after` requests in
+    a row with a connection error or 5xx is ejected for `ejection_s`, doubling up to
+    `max_ejection_s` while it keeps failing, and is readmitted once a health check succeeds.
+    If every replica is ejected, requests still go to the least loaded one.
+    All methods must be called from the same event loop.
+    """
+
+    ROUTING = ("least_outstanding", "latency")
+
+    def __init__(self,
+        base_urls: list[str],
+        routing: str = "least_outstanding",
+        eject_after: int = 3,
+        ejection_s: float = 5.0,
+        max_ejection_s: float = 60.0,
+        ewma_alpha: float = 0.2,
+    ):
+        if not base_urls:
+            raise ValueError("EndpointPool requires at least one base_url")
+        if routing not in self.ROUTING:
+            raise ValueError(f"routing must be one of {self.ROUTING}, got {routing!r}")
+        self.endpoints = [Endpoint(base_url) for base_url in dict.fromkeys(base_urls)]
+        self.routing = routing
+        self.eject_after = eject_after
+        self.ejection_s = ejection_s
+        self.max_ejection_s = max_ejection_s
+        self.ewma_alpha = ewma_alpha
+
+    @staticmethod
+    def is_endpoint_failure(exc: BaseException) -> bool:
+        """Whether `exc` indicates an unhealthy replica rather than a bad request."""
+        if isinstance(exc, openai.APIConnectionError):
+            return True
+        return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+    def due_for_check(self) -> list[Endpoint]:
+        """Returns ejected endpoints whose ejection has elapsed and that are not being checked."""
+        now = time.monotonic()
+        return [e for e in self.endpoints if e.ejected and e.ejected_until <= now and not e.probing]
+
+    def pick(self) -> Endpoint:
+        candidates = [e for e in self.endpoints if not e.ejected] or self.endpoints
+        if self.routing == "latency":
+            known = [e.latency_s for e in candidates if e.latency_s is not None]
+            # Replicas without samples yet are assumed as fast as the fastest, so they get tried
+            default = min(known) if known else 0.0
+            score = lambda e: ((e.latency_s if e.latency_s is not None else default) * (e.outstanding + 1), e.outstanding)
+        else:
+            score = lambda e: (e.outstanding, e.requests)
+        endpoint = min(candidates, key=score)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def record(self, endpoint: Endpoint, latency_s: float, exc: BaseException | None = None) -> None:
+        endpoint.outstanding -= 1
+        if exc is not None and not isinstance(exc, Exception):
+            return # Cancelled, which says nothing about the endpoint
+        if exc is None or not self.is_endpoint_failure(exc):
+            endpoint.failures = 0
+            if exc is None:
+                alpha = self.ewma_alpha
+                endpoint.latency_s = latency_s if endpoint.latency_s is None else (1 - alpha) * endpoint.latency_s + alpha * latency_s
+            return
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_after and not endpoint.ejected:
+            self.eject(endpoint)
+
+    def eject(self, endpoint: Endpoint) -> None:
+        endpoint.ejections += 1
+        duration = min(self.max_ejection_s, self.ejection_s * 2 ** (endpoint.ejections - 1))
+        endpoint.ejected_until = time.monotonic() + duration
+        logger.warning(f"Ejected {endpoint.base_url} for {duration:.1f}s after {endpoint.failures} consecutive failures")
+
+    def readmit(self, endpoint: Endpoint) -> None:
+        endpoint.ejected_until = None
+        endpoint.failures = 0
+        endpoint.ejections = 0
+        endpoint.latency_s = None # Measure afresh rather than trust pre-ejection latency
+        logger.info(f"Readmitted {endpoint.base_url}")
+
+
+class BackgroundEventLoop:
+    """An event loop running forever on a dedicated daemon thread.
+
+    Coroutines submitted from any thread are scheduled on the loop and tracked with a
+    `concurrent.futures.Future`, so callers can block on, or overlap, their results.
+    """
+
+    def __init__(self, name: str = "structured-outputs-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Awaitable[T]) -> concurrent.futures.Future[T]:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self) -> None:
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+_background_loop: BackgroundEventLoop | None = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> BackgroundEventLoop:
+    """Returns the process-wide background event loop, shared by UDF instances in the process."""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop.loop.is_closed():
+            _background_loop = BackgroundEventLoop()
+        return _background_loop
+
+
+# Time spent opening connections (TCP connect and TLS handshake) by the current request
+_connect_time: contextvars.ContextVar[list[float] | None] = contextvars.ContextVar("connect_time", default=None)
+
+
+async def _trace_connections(event_name: str, info: dict[str, Any]) -> None:
+    # httpcore trace callback, see https://www.encode.io/httpcore/extensions/#trace
+    timings = _connect_time.get()
+    if timings is None or not event_name.startswith(("connection.connect_tcp", "connection.start_tls")):
+        return
+    if event_name.endswith(".started"):
+        timings.append(-time.perf_counter())
+    elif event_name.endswith(".complete") and timings and timings[-1] < 0:
+        timings[-1] += time.perf_counter()
+
+
+async def _add_trace(request: httpx.Request) -> None:
+    request.extensions["trace"] = _trace_connections
+
+
+class ClientPool:
+    """Process-wide registry of `AsyncOpenAI` clients with explicitly sized connection pools.
+
+    Clients are keyed by event loop, endpoint, API key, HTTP version and pool size. httpx
+    connections belong to the event loop that opened them, so UDF instances share a client,
+    and its keep-alive connections, whenever they run on the same loop (e.g. with
+    `background_loop=True`), and every batch of an instance reuses it. Each pool keeps all of
+    its `max_connections` alive between requests (httpx only keeps 100 by default), so once
+    warm, requests up to the concurrency cap do not wait on connection setup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: dict[tuple, AsyncOpenAI] = {}
+        self._http_clients: dict[tuple, httpx.AsyncClient] = {}
+
+    def get(self,
+        base_url: str,
+        api_key: str,
+        max_connections: int,
+        http2: bool = False,
+        keepalive_expiry_s: float = DEFAULT_KEEPALIVE_EXPIRY_S,
+        loop: asyncio.AbstractEventLoop | None = None,
+    ) -> AsyncOpenAI:
+        """Returns the shared client for `base_url` on `loop`, creating it if needed.
+
+        `http2=True` requires the `h2` package (`pip install httpx[http2]`).
+        """
+        loop = loop or asyncio.get_event_loop()
+        key = (loop, base_url, api_key, http2, max_connections)
+        with self._lock:
+            for stale in [k for k in self._clients if k[0].is_closed()]:
+                del self._clients[stale]
+                del self._http_clients[stale]
+            if key not in self._clients:
+                http_client = self._http_clients[key] = openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=max_connections,
+                        max_keepalive_connections=max_connections,
+                        keepalive_expiry=keepalive_expiry_s,
+                    ),
+                    http2=http2,
+                    event_hooks={"request": [_add_trace]},
+                )
+                self._clients[key] = AsyncOpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    max_retries=0, # Retries are handled by the UDF's RetryPolicy
+                    http_client=http_client,
+                )
+            return self._clients[key]
+
+    def http_client(self, client: AsyncOpenAI) -> httpx.AsyncClient:
+        """Returns the httpx client, and so the connection pool, `client` was created with."""
+        with self._lock:
+            for key, pooled in self._clients.items():
+                if pooled is client:
+                    return self._http_clients[key]
+        raise KeyError(f"Client of {client.base_url} is not from this pool")
+
+    def stats(self) -> list[dict[str, Any]]:
+        """Returns the connections of each client's pool, for spotting pool saturation.
+
+        `waiting` counts requests queued for a connection, so a pool is saturated while it is
+        above zero. httpcore has no public API for these, so they are read from its pool's
+        internals, which the pinned httpcore version has. Counts are None if they change.
+        """
+        stats = []
+        with self._lock:
+            clients = list(self._http_clients.items())
+        for (_, base_url, _, http2, max_connections), http_client in clients:
+            pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+            try:
+                connections = list(pool.connections)
+                waiting = sum(request.is_queued() for request in pool._requests)
+                idle = sum(connection.is_idle() for connection in connections)
+            except AttributeError:
+                connections, waiting, idle = None, None, None
+            stats.append({
+                "base_url": base_url,
+                "http2": http2,
+                "max_connections": max_connections,
+                "connections": None if connections is None else len(connections),
+                "in_use": None if connections is None else len(connections) - idle,
+                "idle": idle,
+                "waiting": waiting,
+            })
+        return stats
+
+
+_client_pool = ClientPool()
+
+
+def get_client_pool() -> ClientPool:
+    """Returns the process-wide client pool."""
+    return _client_pool
+
+
+def _regex_is_ascii(items: sre_parse.SubPattern) -> bool:
+    """Whether a parsed regex only matches ASCII, i.e. one UTF-8 byte per character."""
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            ascii_only = av < 128
+        elif op is sre_constants.IN:
+            ascii_only = all(
+                o is sre_constants.LITERAL and a < 128 or o is sre_constants.RANGE and a[1] < 128 for o, a in av
+            )
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, sre_constants.POSSESSIVE_REPEAT):
+            ascii_only = _regex_is_ascii(av[2])
+        elif op is sre_constants.SUBPATTERN:
+            ascii_only = _regex_is_ascii(av[3])
+        elif op is sre_constants.BRANCH:
+            ascii_only = all(_regex_is_ascii(branch) for branch in av[1])
+        elif op is sre_constants.AT:
+            ascii_only = True  # Anchors match no characters
+        else:
+            ascii_only = False  # Any character, categories like \w, negations, ...
+        if not ascii_only:
+            return False
+    return True
+
+
+def derive_max_tokens(extra_body: dict[str, Any] | None) -> int | None:
+    """Returns an upper bound on the tokens of an output constrained by `extra_body`, or None.
+
+    Every token decodes to at least one byte, so the UTF-8 length of the longest output the
+    constraint admits bounds its tokens, whatever the tokenizer. Bounded for `guided_choice`
+    and for `guided_regex` without unbounded repeats. JSON schemas and grammars are not
+    bounded: vLLM's JSON grammars admit any amount of whitespace by default.
+    """
+    extra_body = extra_body or {}
+    if extra_body.get("guided_choice"):
+        return max(len(str(choice).encode("utf-8")) for choice in extra_body["guided_choice"]) or 1
+    if extra_body.get("guided_regex"):
+        try:
+            parsed = sre_parse.parse(extra_body["guided_regex"])
+        except re.error:
+            return None
+        max_chars = parsed.getwidth()[1]
+        if max_chars >= sre_constants.MAXREPEAT:
+            return None
+        ascii_only = not parsed.state.flags & re.IGNORECASE and _regex_is_ascii(parsed)
+        return max(max_chars * (1 if ascii_only else 4), 1)
+    return None
+
+
+# extra_body fields of vLLM's OpenAI server and the `GuidedDecodingParams` fields they map to
+GUIDED_DECODING_FIELDS = {
+    "guided_choice": "choice",
+    "guided_regex": "regex",
+    "guided_json": "json",
+    "guided_grammar": "grammar",
+}
+
+
+def canonical_json_schema(schema: Any) -> Any:
+    """Returns `schema` with object keys sorted, parsing it first if it is a JSON string.
+
+    The members of `properties` keep their order, since grammar backends generate object
+    fields in that order.
+    """
+    return _sort_schema_keys(json.loads(schema) if isinstance(schema, str) else schema)
+
+
+def _sort_schema_keys(schema: Any) -> Any:
+    if isinstance(schema, list):
+        return [_sort_schema_keys(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    canonical = {}
+    for key in sorted(schema):
+        value = schema[key]
+        if key == "properties" and isinstance(value, dict):
+            canonical[key] = {name: _sort_schema_keys(member) for name, member in value.items()}
+        else:
+            canonical[key] = _sort_schema_keys(value)
+    return canonical
+
+
+class GuidedSpecRegistry:
+    """Canonicalizes and interns the structured output specs of requests.
+
+    vLLM compiles a grammar per distinct spec string and caches it by that string, so specs
+    that differ only in formatting, e.g. JSON schema key order or duplicated choices, would
+    each pay for a compilation. Canonical specs are serialized byte-identically, and equal
+    specs share one interned object. Each spec is identified by a short `grammar` key, which
+    requests record so `MetricsRecorder.report` can count the distinct grammars of a job.
+
+    Canonicalization never changes what a spec admits:
+     - guided_choice: choices as strings, deduplicated and sorted
+     - guided_json and json_schema/structural_tag response formats: see `canonical_json_schema`
+     - guided_grammar: lines stripped, blank lines dropped
+     - guided_regex: kept as is, as rewriting it could change its meaning in the backend's dialect
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._specs: dict[str, dict[str, Any]] = {}
+        self.uses: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    @staticmethod
+    def canonical_spec(guided: dict[str, Any], response_format: dict[str, Any] | None) -> dict[str, Any]:
+        spec = {}
+        for key, value in guided.items():
+            if key == "guided_choice":
+                value = sorted(dict.fromkeys(str(choice) for choice in value))
+            elif key == "guided_json":
+                value = canonical_json_schema(value)
+            elif key == "guided_grammar":
+                value = "\n".join(line.strip() for line in value.splitlines() if line.strip())
+            spec[key] = value
+        if response_format is not None:
+            response_format = dict(response_format)
+            if response_format.get("type") == "json_schema":
+                response_format["json_schema"] = {
+                    **response_format["json_schema"],
+                    "schema": canonical_json_schema(response_format["json_schema"].get("schema", {})),
+                }
+            elif response_format.get("type") == "structural_tag":
+                response_format["structures"] = [
+                    {**structure, "schema": canonical_json_schema(structure.get("schema", {}))}
+                    for structure in response_format.get("structures", [])
+                ]
+            spec["response_format"] = response_format
+        return spec
+
+    def canonicalize(self,
+        sampling_params: dict[str, Any] | None,
+        extra_body: dict[str, Any] | None,
+        ) -> tuple[dict[str, Any] | None, dict[str, Any] | None, str | None]:
+        """Returns the sampling params and extra_body with their spec replaced by the interned
+        canonical one, and the spec's `grammar` key, or None for unconstrained requests."""
+        guided = {k: v for k, v in (extra_body or {}).items() if k in GUIDED_DECODING_FIELDS}
+        response_format = (sampling_params or {}).get("response_format")
+        if not guided and response_format is None:
+            return sampling_params, extra_body, None
+
+        spec = self.canonical_spec(guided, response_format)
+        grammar = hashlib.sha256(
+            json.dumps(spec, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()[:16]
+        with self._lock:
+            spec = self._specs.setdefault(grammar, spec)
+            self.uses[grammar] = self.uses.get(grammar, 0) + 1
+
+        if "response_format" in spec:
+            sampling_params = {**sampling_params, "response_format": spec["response_format"]}
+        if guided:
+            extra_body = {**extra_body, **{k: v for k, v in spec.items() if k != "response_format"}}
+        return sampling_params, extra_body, grammar
+
+
+_guided_registry = GuidedSpecRegistry()
+
+
+def get_guided_registry() -> GuidedSpecRegistry:
+    return _guided_registry
+
+
+class TokenBudget:
+    """Caps the estimated tokens, prompt plus output, of the requests in flight.
+
+    vLLM admits sequences while their KV cache blocks fit and preempts them when decoding
+    outgrows the cache, so sizing in-flight requests by tokens rather than by count keeps
+    the server's batch full without thrashing. Waiters are served in order; a request larger
+    than the whole budget runs once nothing else is in flight.
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.in_flight = 0
+        self.peak = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    def _fits(self, tokens: int) -> bool:
+        return self.in_flight == 0 or self.in_flight + tokens <= self.max_tokens
+
+    def _grant(self, tokens: int) -> None:
+        self.in_flight += tokens
+        self.peak = max(self.peak, self.in_flight)
+
+    async def acquire(self, tokens: int) -> None:
+        if not self._waiters and self._fits(tokens):
+            self._grant(tokens)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((tokens, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(tokens)
+            else:
+                self._waiters.remove((tokens, waiter))
+                self._wake_waiters()
+            raise
+
+    def release(self, tokens: int) -> None:
+        self.in_flight -= tokens
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._fits(self._waiters[0][0]):
+            tokens, waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._grant(tokens)
+                waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, tokens: int):
+        await self.acquire(tokens)
+        try:
+            yield
+        finally:
+            self.release(tokens)
+
+
+class RequestTemplate:
+    """A chat completion body with everything but the row's text and image serialized once.
+
+    `body` splices a row into the pre-serialized model, sampling params, `extra_body` (e.g.
+    the guided decoding spec) and message skeleton. The base64 image needs no JSON escaping,
+    so it is copied once into the body rather than escaped and re-encoded; only the short
+    prompt goes through `json.dumps`.
+
+    Unless the sampling params set `max_tokens`, it is derived from the structured output
+    constraint with `derive_max_tokens`, so the server does not budget for a full-length
+    generation. The structured output spec is canonicalized by `GuidedSpecRegistry`.
+    `request_params` and `request_extra_body` are what is actually sent.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        derive_output_tokens: bool = True,
+    ):
+        self.model_id = model_id
+        self.sampling_params = sampling_params
+        self.extra_body = extra_body
+        self.image_mime_type = image_mime_type
+        self.request_params = dict(sampling_params or {})
+        self.max_tokens = self.request_params.get("max_tokens", self.request_params.get("max_completion_tokens"))
+        if self.max_tokens is None and derive_output_tokens:
+            self.max_tokens = derive_max_tokens(extra_body)
+            if self.max_tokens is not None:
+                self.request_params["max_tokens"] = self.max_tokens
+        self.request_params, self.request_extra_body, self.grammar = get_guided_registry().canonicalize(
+            self.request_params, extra_body
+        )
+        static = {"model": model_id, **self.request_params, **(self.request_extra_body or {})}
+        self._head = json.dumps(static)[:-1].encode("utf-8") + b', "messages": [{"role": "user", "content": ['
+        self._image_head = b'{"type": "image_url", "image_url": {"url": "data:' + image_mime_type.encode("utf-8") + b';base64,'
+        self._key = hashlib.sha256(ResponseCache.make_key({
+            "model": model_id,
+            "sampling_params": self.request_params,
+            "extra_body": self.request_extra_body or {},
+            "image_mime_type": image_mime_type,
+        }).encode("utf-8"))
+
+    def matches(self, model_id: str, sampling_params, extra_body, image_mime_type: str) -> bool:
+        return (
+            self.model_id == model_id
+            and self.sampling_params == sampling_params
+            and self.extra_body == extra_body
+            and self.image_mime_type == image_mime_type
+        )
+
+    def body(self, text: str | None, image: str | None) -> bytes:
+        parts = [self._head]
+        if image:  # Dataset prefers image first
+            parts += [self._image_head, image.encode("ascii"), b'"}}']
+        if text:
+            parts += [b", " if image else b"", b'{"type": "text", "text": ', json.dumps(text).encode("utf-8"), b"}"]
+        parts.append(b"]}]}")
+        return b"".join(parts)
+
+    def messages(self, text: str | None, image: str | None) -> list[dict[str, Any]]:
+        content = []
+        if image:
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{self.image_mime_type};base64,{image}"},
+            })
+        if text:
+            content.append({"type": "text", "text": text})
+        return [{"role": "user", "content": content}]
+
+    def estimate_tokens(self, text: str | None, image: str | None, image_tokens: int = DEFAULT_IMAGE_TOKENS) -> int:
+        """Estimates the KV cache tokens of a row's request: its prompt and longest output.
+
+        Outputs without a `max_tokens` count as empty, so set one when budgeting free text.
+        """
+        prompt_tokens = math.ceil(len(text or "") / CHARS_PER_TOKEN) + (image_tokens if image else 0)
+        return prompt_tokens + (self.max_tokens or 0)
+
+    def cache_key(self, text: str | None, image: str | None) -> str:
+        # Each part is length-prefixed, so the base64 image is hashed without being escaped
+        key = self._key.copy()
+        for part in (text, image):
+            if part is None:
+                key.update(b"\x00")
+                continue
+            data = part.encode("utf-8")
+            key.update(b"\x01" + len(data).to_bytes(8, "little"))
+            key.update(data)
+        return key.hexdigest()
+
+
+# The `openai` exception the SDK raises for each HTTP error status
+STATUS_ERRORS: dict[int, type[openai.APIStatusError]] = {
+    400: openai.BadRequestError,
+    401: openai.AuthenticationError,
+    403: openai.PermissionDeniedError,
+    404: openai.NotFoundError,
+    409: openai.ConflictError,
+    422: openai.UnprocessableEntityError,
+    429: openai.RateLimitError,
+}
+
+
+def status_error(response: httpx.Response) -> openai.APIStatusError:
+    """Builds the `openai` exception the SDK raises for an HTTP error response."""
+    try:
+        body = response.json()
+    except ValueError:
+        body = response.text or None
+    if isinstance(body, dict):
+        body = body.get("error", body)
+    error_class = STATUS_ERRORS.get(
+        response.status_code, openai.InternalServerError if response.status_code >= 500 else openai.APIStatusError
+    )
+    return error_class(f"Error code: {response.status_code} - {body}", response=response, body=body)
+
+
+async def post_chat_completion(
+    http_client: httpx.AsyncClient, base_url: str, api_key: str, body: bytes
+) -> str | None:
+    """POSTs a serialized chat completion request with `http_client` and returns the first
+    choice's content.
+
+    Skips the SDK's request building and response model validation, only decoding the JSON
+    response. Failures raise the same `openai` exceptions as the SDK path.
+    """
+    url = base_url.rstrip("/") + "/chat/completions"
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    request = http_client.build_request("POST", url, content=body, headers=headers)
+    try:
+        response = await http_client.send(request)
+    except httpx.TimeoutException as exc:
+        raise openai.APITimeoutError(request=request) from exc
+    except httpx.TransportError as exc:
+        raise openai.APIConnectionError(request=request) from exc
+    if response.status_code >= 400:
+        raise status_error(response)
+    return json.loads(response.content)["choices"][0]["message"]["content"]
+
+
+@daft.udf(return_dtype=INFERENCE_DTYPE, concurrency=4)
+class StructuredOutputsProdUDF:
+    """Sends one chat completion per row and returns `{"result", "error"}` structs.
+
+    Failed requests are retried per `RetryPolicy`. Rows that still fail come back with a null
+    `result` and the final error, unless `on_error="raise"`.
+    """
+
+    def __init__(self,
+        base_url: str,
+        api_key: str,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        process_max_in_flight: int = DEFAULT_PROCESS_MAX_IN_FLIGHT,
+        background_loop: bool = False,
+        cache_dir: str | None = None,
+        cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        read_cache: bool = True,
+        adaptive_concurrency: bool = False,
+        min_in_flight: int = 1,
+        max_attempts: int = 4,
+        on_error: str = "null",
+        endpoints: list[str] | None = None,
+        routing: str = "least_outstanding",
+        http2: bool = False,
+        transport: str = "sdk",
+        derive_max_tokens: bool = True,
+        max_tokens_in_flight: int | None = None,
+        image_tokens: int = DEFAULT_IMAGE_TOKENS,
+        response_model: type | None = None,
+        metrics_dir: str | None = None,
+        ):
+        """
+        Args:
+            base_url: Base URL of the OpenAI-compatible server
+            api_key: API key for the server
+            max_in_flight: Cap on in-flight requests for this instance
+            process_max_in_flight: Cap on in-flight requests shared by all instances in the
+                process, which also sizes the shared connection pool, see `ClientPool`
+            background_loop: Run requests on the process-wide long-lived event loop thread.
+                The in-flight window is then shared across batches, so batches submitted with
+                `submit_batch` keep the server busy while earlier batches drain, and instances
+                in the process share keep-alive connections. Daft calls `__call__` one batch
+                at a time, so only `submit_inference` overlaps the batches of a Daft plan.
+            cache_dir: Directory of an on-disk response cache. Identical requests are answered
+                from the cache without contacting the server.
+            cache_max_bytes: Size budget of the response cache before LRU eviction
+            read_cache: False to send every request and only store the responses in the
+                cache, replacing earlier ones, see `retry_invalid`
+            adaptive_concurrency: Tune in-flight requests between `min_in_flight` and
+                `max_in_flight` from observed latency and server rejections, see
+                `AdaptiveConcurrencyController`
+            min_in_flight: Lower bound of the adaptive in-flight limit
+            max_attempts: Attempts per request, including the first, for retryable errors
+            on_error: "null" to return rows that failed every attempt with a null result and
+                their error, or "raise" to fail the batch
+            endpoints: Base URLs of replicas of the server to balance requests across instead
+                of sending them all to `base_url`, see `EndpointPool`
+            routing: "least_outstanding" or "latency", how requests are routed to `endpoints`
+            http2: Talk HTTP/2 to the server, multiplexing requests over fewer connections.
+                Requires the `h2` package.
+            transport: "sdk" to send requests through `AsyncOpenAI.chat.completions.create`, or
+                "http" to post the JSON body directly and parse only the answer, see
+                `post_chat_completion`
+            derive_max_tokens: Send a `max_tokens` bounding the structured output, e.g. the
+                longest `guided_choice`, unless the sampling params set one. Disable for
+                reasoning models, whose reasoning counts towards `max_tokens`.
+            max_tokens_in_flight: Cap on the estimated prompt and output tokens of this
+                instance's requests in flight, e.g. the server's KV cache capacity divided
+                by the number of instances, see `TokenBudget`. None to only cap requests.
+            image_tokens: Prompt tokens per image in the token estimate, which depend on the
+                model's vision encoder
+
+            response_model: Pydantic model the outputs are JSON objects of. `__call__` then
+                returns results as structs of its fields, see `with_response_model`.
+            metrics_dir: Directory to spool this process's metrics events to, see `MetricsRecorder`
+        """
+        if on_error not in ("null", "raise"):
+            raise ValueError(f"on_error must be 'null' or 'raise', got {on_error!r}")
+        if transport not in ("sdk", "http"):
+            raise ValueError(f"transport must be 'sdk' or 'http', got {transport!r}")
+        self.transport = transport
+        self.base_url = base_url
+        self.api_key = api_key
+        self.clients: dict[str, AsyncOpenAI] = {} # Clients of endpoints other than base_url
+        self.http_clients: dict[str, httpx.AsyncClient] = {}
+        self._templates: list[RequestTemplate] = [] # Most recently created first
+        self.derive_max_tokens = derive_max_tokens
+        self.token_budget = TokenBudget(max_tokens_in_flight) if max_tokens_in_flight else None
+        self.image_tokens = image_tokens
+        self.result_dtype = response_model_dtype(response_model) if response_model is not None else None
+        self.required_fields = required_fields(response_model.model_json_schema()) if response_model is not None else []
+        if metrics_dir is not None:
+            get_metrics().events_dir = metrics_dir
+        self.pool = EndpointPool(endpoints, routing) if endpoints else None
+        self._health_checks: set[asyncio.Task] = set() # Referenced until done so they are not collected
+        self.on_error = on_error
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts)
+        self.controller = None
+        if adaptive_concurrency:
+            self.controller = AdaptiveConcurrencyController(max_limit=max_in_flight, min_limit=min_in_flight)
+        self.max_in_flight = max_in_flight
+        self.process_limiter = get_process_limiter(process_max_in_flight)
+        self.cache = None
+        self.read_cache = read_cache
+        if cache_dir is not None:
+            self.cache = ResponseCache(os.path.join(cache_dir, "responses.sqlite"), cache_max_bytes)
+        self.background = None
+        self._window: asyncio.Semaphore | None = None
+        if background_loop:
+            self.background = get_background_loop()
+            self.loop = self.background.loop
+            self._window = asyncio.Semaphore(max_in_flight)
+        else:
+            try:
+                self.loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+
+        # The process limiter caps requests in flight, so a pool of that size never makes them queue
+        self.http2 = http2
+        self.max_connections = process_max_in_flight
+        self.client = self.client_for(base_url)
 
 
     def __call__(self,
@@ -43,48 +1732,745 @@ class StructuredOutputsProdUDF:
         text_col: daft.Series,
         image_col: daft.Series,
         sampling_params: dict[str, Any] | None = None,
-        extra_body: dict[str, Any] | None = None
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        subset_col: daft.Series | None = None,
+        config_col: daft.Series | None = None,
+        configs: dict[str, dict[str, Any]] | None = None,
         ):
+        """
+        Args:
+            subset_col: Optional group of each row, e.g. its dataset subset. Requests are
+                scheduled fairly across groups and their metrics are tagged with the group.
+            config_col: Optional name of the entry of `configs` each row is sent with
+            configs: Per-row overrides of `model_id`, `sampling_params`, `extra_body` and
+                `base_url`, keyed by the names in `config_col`
+        """
+        texts = text_col.to_pylist()
+        images = image_col.to_pylist()
+        subsets = subset_col.to_pylist() if subset_col is not None else None
+        row_configs = [configs[name] for name in config_col.to_pylist()] if config_col is not None else None
+
+        coro = self.gather_completions(
+            model_id, texts, images, sampling_params, extra_body, image_mime_type, subsets, row_configs
+        )
+        if self.background is not None:
+            outputs = self.background.submit(coro).result()
+        else:
+            outputs = self.loop.run_until_complete(coro)
+        get_metrics().flush()
+        return typed_inference_outputs(outputs, self.result_dtype, self.required_fields) if self.result_dtype is not None else outputs
+
+    def submit_batch(self,
+        model_id: str,
+        texts: list[str | None],
+        images: list[str | None],
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        subsets: list[str | None] | None = None,
+        row_configs: list[dict[str, Any]] | None = None,
+        ) -> concurrent.futures.Future[list[dict[str, Any]]]:
+        """Submits a batch without blocking. Requires `background_loop=True`.
+
+        Results of each future are in the order of its batch. Requests from later batches
+        queue behind earlier ones for slots in the shared in-flight window.
+        """
+        if self.background is None:
+            raise RuntimeError("submit_batch requires the UDF to be initialized with background_loop=True")
+        return self.background.submit(self.gather_completions(
+            model_id, texts, images, sampling_params, extra_body, image_mime_type, subsets, row_configs
+        ))
+
+    def client_for(self, base_url: str | None = None) -> AsyncOpenAI:
+        """Returns the client of `base_url`, defaulting to this instance's `base_url`."""
+        if (base_url is None or base_url == self.base_url) and getattr(self, "client", None) is not None:
+            return self.client
+        base_url = base_url or self.base_url
+        if base_url not in self.clients:
+            self.clients[base_url] = get_client_pool().get(
+                base_url, self.api_key, self.max_connections, http2=self.http2, loop=self.loop
+            )
+        return self.clients[base_url]
+
+    def http_client_for(self, base_url: str | None = None) -> httpx.AsyncClient:
+        """Returns the httpx client of `base_url`'s client, which the "http" transport posts with."""
+        base_url = base_url or self.base_url
+        if base_url not in self.http_clients:
+            self.http_clients[base_url] = get_client_pool().http_client(self.client_for(base_url))
+        return self.http_clients[base_url]
+
+    def schedule_health_checks(self) -> None:
+        """Starts a health check task for each ejected endpoint that is due.
+
+        Requests never wait on a check, which can take its whole timeout against a hung
+        replica; the replica stays ejected until its check succeeds.
+        """
+        for endpoint in self.pool.due_for_check():
+            endpoint.probing = True
+            task = asyncio.get_running_loop().create_task(self.check_endpoint(endpoint))
+            self._health_checks.add(task)
+            task.add_done_callback(self._health_checks.discard)
+
+    async def check_endpoint(self, endpoint: Endpoint) -> None:
+        """Health checks an ejected endpoint, readmitting it if it responds."""
+        try:
+            await self.client_for(endpoint.base_url).with_options(timeout=5.0).models.list()
+        except Exception as exc:
+            logger.warning(f"Health check of {endpoint.base_url} failed: {type(exc).__name__}: {exc}")
+            self.pool.eject(endpoint)
+        else:
+            self.pool.readmit(endpoint)
+        finally:
+            endpoint.probing = False
+
+    def template_for(self, model_id: str, sampling_params, extra_body, image_mime_type: str) -> RequestTemplate:
+        """Returns the request template of a config, serializing it on first use.
+
+        A batch has one config, or a few in a sweep, so comparing the dicts is cheaper than
+        serializing them per row.
+        """
+        for template in self._templates:
+            if template.matches(model_id, sampling_params, extra_body, image_mime_type):
+                return template
+        template = RequestTemplate(model_id, sampling_params, extra_body, image_mime_type, self.derive_max_tokens)
+        self._templates = [template] + self._templates[:MAX_REQUEST_TEMPLATES - 1]
+        return template
+
+    def estimate_tokens(self,
+        model_id: str,
+        text: str | None,
+        image: str | None,
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        ) -> int:
+        template = self.template_for(model_id, sampling_params, extra_body, image_mime_type)
+        return template.estimate_tokens(text, image, self.image_tokens)
 
-        async def generate(text: str, image: str) -> str:
-                content = []
-                if image:
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{image}"},
-                    })
-                if text:
-                    content.append({"type": "text", "text": text})
-
-                result = await self.client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": content # Dataset prefers image first
-                        }
-                    ],
+    def close(self) -> None:
+        # The background loop and clients are shared with other instances in the process
+        if self.cache is not None:
+            self.cache.close()
+
+    async def generate(self,
+        model_id: str,
+        text: str | None,
+        image: str | None,
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        subset: str | None = None,
+        base_url: str | None = None,
+        cache_key: str | None = None,
+        ) -> str:
+        template = self.template_for(model_id, sampling_params, extra_body, image_mime_type)
+        endpoint = None
+        if base_url is None and self.pool is not None:
+            self.schedule_health_checks()
+            endpoint = self.pool.pick()
+            base_url = endpoint.base_url
+
+        connect_time = []
+        _connect_time.set(connect_time)
+        start = time.perf_counter()
+        error: BaseException | None = None
+        try:
+            if self.transport == "http":
+                output = await post_chat_completion(
+                    self.http_client_for(base_url), base_url or self.base_url, self.api_key, template.body(text, image)
+                )
+            else:
+                result = await self.client_for(base_url).chat.completions.create(
+                    messages=template.messages(text, image),
                     model=model_id,
-                    extra_body=extra_body,
-                    **sampling_params
+                    extra_body=template.request_extra_body,
+                    **template.request_params
                 )
-                return result.choices[0].message.content
+                output = result.choices[0].message.content
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            # Also runs when the request is cancelled, e.g. by `windowed_gather`, so the
+            # endpoint's outstanding count is always released
+            latency_s = time.perf_counter() - start
+            if endpoint is not None:
+                self.pool.record(endpoint, latency_s, error)
+            if error is None or isinstance(error, Exception):
+                get_metrics().record_request(
+                    latency_s, ok=error is None, subset=subset, connect_s=sum(t for t in connect_time if t > 0),
+                    grammar=template.grammar,
+                )
+        if self.cache is not None and output is not None:
+            self.cache.put(cache_key or template.cache_key(text, image), output)
+        return output
+
+    def cached_response(self,
+        model_id: str,
+        text: str | None,
+        image: str | None,
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        subset: str | None = None,
+        base_url: str | None = None,
+        ) -> tuple[str | None, str | None]:
+        """Returns the request's cache key and its cached output, which is None if the request
+        has to be sent, always without `read_cache`. Both are None without a cache.
+
+        Looked up once per row, before any concurrency slot is taken, so hits neither hold
+        slots nor feed their near-zero latency to the adaptive controller, and retries reuse
+        the key.
+        """
+        if self.cache is None:
+            return None, None
+        template = self.template_for(model_id, sampling_params, extra_body, image_mime_type)
+        key = template.cache_key(text, image)
+        cached = self.cache.get(key) if self.read_cache else None
+        if cached is not None:
+            get_metrics().record_request(0.0, cached=True, subset=subset, grammar=template.grammar)
+        return key, cached
+
+    async def infer_with_semaphore(self, *args, **kwargs) -> str:
+        async with contextlib.AsyncExitStack() as stack:
+            if self._window is not None:
+                await stack.enter_async_context(self._window)
+            if self.controller is not None:
+                await stack.enter_async_context(self.controller)
+            if self.token_budget is not None:
+                await stack.enter_async_context(self.token_budget.reserve(self.estimate_tokens(*args)))
+            await stack.enter_async_context(self.process_limiter.slot(kwargs.get("subset")))
+
+            start = time.perf_counter()
+            try:
+                result = await self.generate(*args, **kwargs)
+            except openai.APITimeoutError:
+                if self.controller is not None:
+                    self.controller.observe(rejected=True)
+                raise
+            except openai.APIStatusError as exc:
+                if self.controller is not None:
+                    self.controller.observe_status(exc.status_code)
+                raise
+            if self.controller is not None:
+                self.controller.observe(time.perf_counter() - start)
+            return result
+
+    async def infer_with_retries(self, *args, **kwargs) -> dict[str, Any]:
+        self.retry_policy.requests += 1
+        cache_key, cached = self.cached_response(*args, **kwargs)
+        if cached is not None:
+            return {"result": cached, "error": None}
+        if cache_key is not None:
+            kwargs["cache_key"] = cache_key
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return {"result": await self.infer_with_semaphore(*args, **kwargs), "error": None}
+            except Exception as exc:
+                if self.retry_policy.should_retry(attempt, exc):
+                    # Concurrency slots are released while backing off
+                    await asyncio.sleep(self.retry_policy.delay_s(attempt, exc))
+                    continue
+                if self.on_error == "raise":
+                    raise
+                logger.warning(f"Request failed after {attempt} attempt(s): {type(exc).__name__}: {exc}")
+                return {"result": None, "error": inference_error(exc, attempt)}
+
+    async def gather_completions(self,
+        model_id: str,
+        texts: list[str | None],
+        images: list[str | None],
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        subsets: list[str | None] | None = None,
+        row_configs: list[dict[str, Any]] | None = None,
+        ) -> list[dict[str, Any]]:
+        if subsets is None and row_configs is None:
+            tasks = (
+                self.infer_with_retries(model_id, t, i, sampling_params, extra_body, image_mime_type)
+                for t, i in zip(texts, images)
+            )
+            return await windowed_gather(tasks, self.max_in_flight)
+
+        def request(idx: int):
+            config = row_configs[idx] if row_configs is not None else {}
+            return self.infer_with_retries(
+                config.get("model_id", model_id),
+                texts[idx],
+                images[idx],
+                config.get("sampling_params", sampling_params),
+                config.get("extra_body", extra_body),
+                image_mime_type,
+                subset=subsets[idx] if subsets is not None else None,
+                base_url=config.get("base_url"),
+            )
+
+        # Issue a batch that spans subsets round-robin, so each subset gets a share of the window
+        order = round_robin_order(subsets) if subsets is not None else list(range(len(texts)))
+        tasks = (request(idx) for idx in order)
+        results: list[dict[str, Any]] = [None] * len(order)
+        for idx, result in zip(order, await windowed_gather(tasks, self.max_in_flight)):
+            results[idx] = result
+        return results
+
+
+# Background-loop UDF instances of this process keyed by their init args, and the batches
+# submitted to them by `submit_inference` that `collect_inference` has not finished reading
+_background_udfs: dict[str, StructuredOutputsProdUDF] = {}
+_background_batches: dict[int, list[Any]] = {}
+_background_batches_lock = threading.Lock()
+_background_batch_ids = itertools.count()
 
-        async def infer_with_semaphore(t, i):
-            return await generate(t,i)
 
-        async def gather_completions(texts,images) -> list[str]:
-            tasks = [infer_with_semaphore(t,i) for t,i in zip(texts,images)]
-            return await asyncio.gather(*tasks)
+def _background_udf(init_args: dict[str, Any]) -> StructuredOutputsProdUDF:
+    key = json.dumps(init_args, sort_keys=True, default=repr)
+    with _background_batches_lock:
+        if key not in _background_udfs:
+            _background_udfs[key] = StructuredOutputsProdUDF.inner(**{**init_args, "background_loop": True})
+        return _background_udfs[key]
 
+
+@daft.udf(return_dtype=daft.DataType.int64())
+def submit_inference(
+    text_col: daft.Series,
+    image_col: daft.Series,
+    init_args: dict[str, Any],
+    model_id: str,
+    sampling_params: dict[str, Any] | None = None,
+    extra_body: dict[str, Any] | None = None,
+    image_mime_type: str = "image/png",
+    subset_col: daft.Series | None = None,
+    config_col: daft.Series | None = None,
+    configs: dict[str, dict[str, Any]] | None = None,
+    max_queued_rows: int = 2 * DEFAULT_MAX_IN_FLIGHT,
+) -> list[int]:
+    """Submits a batch to the background-loop `StructuredOutputsProdUDF` of this process
+    without waiting for it, and returns a ticket per row for `collect_inference`.
+
+    Daft runs one batch at a time through a UDF, so a UDF that returns its batch's results
+    leaves the server underused while the batch's tail drains. Split in two, the next batch
+    is submitted while `collect_inference` still waits on the tail of the previous one, and
+    both share the instance's in-flight window. Submitting blocks while more than
+    `max_queued_rows` rows are unfinished, which bounds the rows held in memory.
+
+    Both UDFs must run in the same process, as function UDFs do on the native runner.
+    """
+    udf = _background_udf(init_args)
+    texts, images = text_col.to_pylist(), image_col.to_pylist()
+    with _background_batches_lock:
+        pending = [batch for batch in _background_batches.values() if not batch[0].done()]
+    while pending and sum(batch[2] for batch in pending) + len(texts) > max_queued_rows:
+        concurrent.futures.wait([batch[0] for batch in pending], return_when=concurrent.futures.FIRST_COMPLETED)
+        pending = [batch for batch in pending if not batch[0].done()]
+
+    future = udf.submit_batch(
+        model_id, texts, images, sampling_params, extra_body, image_mime_type,
+        subset_col.to_pylist() if subset_col is not None else None,
+        [configs[name] for name in config_col.to_pylist()] if config_col is not None else None,
+    )
+    batch_id = next(_background_batch_ids)
+    with _background_batches_lock:
+        # The future, rows not collected yet, and rows in the batch
+        _background_batches[batch_id] = [future, len(texts), len(texts)]
+    return [batch_id << 32 | idx for idx in range(len(texts))]
+
+
+@daft.udf(return_dtype=INFERENCE_DTYPE)
+def collect_inference(
+    tickets: daft.Series, result_dtype: daft.DataType | None = None, required: list[str] | None = None,
+):
+    """Waits for the rows of `submit_inference` tickets and returns their `{"result", "error"}`
+    structs, with results parsed as `result_dtype` if given, see `with_response_model`."""
+    outputs = []
+    for ticket in tickets.to_pylist():
+        batch_id, idx = ticket >> 32, ticket & 0xFFFFFFFF
+        with _background_batches_lock:
+            batch = _background_batches.get(batch_id)
+        if batch is None:
+            raise RuntimeError(
+                "collect_inference found no batch submitted by submit_inference in this process, "
+                "both must run in the same process, as on the native runner"
+            )
+        outputs.append(batch[0].result()[idx])
+        with _background_batches_lock:
+            batch[1] -= 1
+            if batch[1] == 0:
+                del _background_batches[batch_id]
+    get_metrics().flush()
+    return typed_inference_outputs(outputs, result_dtype, required or ()) if result_dtype is not None else outputs
+
+
+class VLLMEngine:
+    """Adapter running chat requests on an in-process `vllm.LLM`.
+
+    `generate` takes a list of requests, each a dict of the prompt `text`, a PIL `image` or
+    None, `sampling_params` and `guided` decoding params, and returns the generated texts in
+    order. Stub engines with the same interface stand in for it in tests.
+    """
+
+    def __init__(self, model_id: str, **engine_kwargs):
+        from vllm import LLM
+
+        self.llm = LLM(model=model_id, **engine_kwargs)
+        self._sampling_params: dict[str, Any] = {}
+
+    def sampling_params(self, params: dict[str, Any], guided: dict[str, Any]):
+        """Builds vLLM sampling params once per distinct config."""
+        from vllm import SamplingParams
+        from vllm.sampling_params import GuidedDecodingParams
+
+        key = json.dumps([params, guided], sort_keys=True, default=str)
+        if key not in self._sampling_params:
+            self._sampling_params[key] = SamplingParams(
+                **params, guided_decoding=GuidedDecodingParams(**guided) if guided else None
+            )
+        return self._sampling_params[key]
+
+    def generate(self, requests: list[dict[str, Any]]) -> list[str]:
+        conversations = []
+        for request in requests:
+            content = []
+            if request["image"] is not None:
+                content.append({"type": "image_pil", "image_pil": request["image"]}) # Dataset prefers image first
+            if request["text"]:
+                content.append({"type": "text", "text": request["text"]})
+            conversations.append([{"role": "user", "content": content}])
+        params = [self.sampling_params(r["sampling_params"], r["guided"]) for r in requests]
+        outputs = self.llm.chat(conversations, sampling_params=params, use_tqdm=False)
+        return [output.outputs[0].text for output in outputs]
+
+
+@daft.udf(return_dtype=INFERENCE_DTYPE, concurrency=1)
+class StructuredOutputsVLLMUDF:
+    """Generates structured outputs with a vLLM engine held by each UDF instance.
+
+    A drop-in for `StructuredOutputsProdUDF` when Daft and vLLM share a machine: whole batches
+    go straight to the engine, skipping JSON serialization, base64 and HTTP. `image_col` may
+    hold raw image bytes, which are decoded once per distinct image, or base64 strings.
+    Returns the same `{"result", "error"}` structs.
+    """
+
+    def __init__(self,
+        model_id: str,
+        engine_kwargs: dict[str, Any] | None = None,
+        engine_factory: Callable[..., Any] | None = None,
+        on_error: str = "null",
+        derive_max_tokens: bool = True,
+        response_model: type | None = None,
+        metrics_dir: str | None = None,
+        ):
+        """
+        Args:
+            model_id: Model the engine loads. Rows must request this model.
+            engine_kwargs: Keyword arguments of `vllm.LLM`, e.g. `{"max_model_len": 4096}`
+            engine_factory: Builds the engine from `model_id` and `engine_kwargs`, by default
+                `VLLMEngine`. Any object with its `generate` interface works, e.g. a CPU stub.
+            on_error: "null" to return rows that failed with a null result and their error,
+                or "raise" to fail the batch
+            derive_max_tokens: Bound `max_tokens` by the structured output constraint unless
+                the sampling params set one, see `derive_max_tokens`
+
+            response_model: Pydantic model the outputs are JSON objects of, returned as
+                structs of its fields, see `with_response_model`
+            metrics_dir: Directory to spool this process's metrics events to, see `MetricsRecorder`
+        """
+        if on_error not in ("null", "raise"):
+            raise ValueError(f"on_error must be 'null' or 'raise', got {on_error!r}")
+        self.model_id = model_id
+        self.on_error = on_error
+        self.derive_max_tokens = derive_max_tokens
+        self.result_dtype = response_model_dtype(response_model) if response_model is not None else None
+        self.required_fields = required_fields(response_model.model_json_schema()) if response_model is not None else []
+        if metrics_dir is not None:
+            get_metrics().events_dir = metrics_dir
+        self.engine = (engine_factory or VLLMEngine)(model_id, **(engine_kwargs or {}))
+
+    def __call__(self,
+        model_id: str,
+        text_col: daft.Series,
+        image_col: daft.Series,
+        sampling_params: dict[str, Any] | None = None,
+        extra_body: dict[str, Any] | None = None,
+        image_mime_type: str = "image/png",
+        subset_col: daft.Series | None = None,
+        config_col: daft.Series | None = None,
+        configs: dict[str, dict[str, Any]] | None = None,
+        ):
+        """
+        Args:
+            image_mime_type: Unused, images are decoded from their bytes
+            subset_col: Optional group of each row, which its metrics are tagged with
+            config_col: Optional name of the entry of `configs` each row is generated with
+            configs: Per-row overrides of `sampling_params` and `extra_body` keyed by the names
+                in `config_col`. Their `model_id` must be the engine's; `base_url` is ignored.
+        """
         texts = text_col.to_pylist()
         images = image_col.to_pylist()
+        subsets = subset_col.to_pylist() if subset_col is not None else [None] * len(texts)
+        row_configs = [configs[name] for name in config_col.to_pylist()] if config_col is not None else None
+
+        outputs: list[dict[str, Any] | None] = [None] * len(texts)
+        requests, indices = [], []
+        decoded: dict[Any, Any] = {}  # Rows of the same image share its decoded pixels
+        canonical: dict[tuple[int, int], tuple] = {}  # Rows of the same config share its canonical spec
+        for idx, (text, image) in enumerate(zip(texts, images)):
+            config = row_configs[idx] if row_configs is not None else {}
+            try:
+                if config.get("model_id", model_id) != self.model_id:
+                    raise ValueError(f"Engine serves {self.model_id!r}, row requests {config.get('model_id', model_id)!r}")
+                row_params, row_body = config.get("sampling_params", sampling_params), config.get("extra_body", extra_body)
+                if (id(row_params), id(row_body)) not in canonical:
+                    canonical[id(row_params), id(row_body)] = get_guided_registry().canonicalize(row_params, row_body)
+                row_params, row_body, grammar = canonical[id(row_params), id(row_body)]
+                request = self.build_request(text, self.decode_image(image, decoded), row_params, row_body)
+                request["grammar"] = grammar
+                requests.append(request)
+                indices.append(idx)
+            except Exception as exc:
+                if self.on_error == "raise":
+                    raise
+                logger.warning(f"Request failed: {type(exc).__name__}: {exc}")
+                outputs[idx] = {"result": None, "error": inference_error(exc, 1)}
+
+        start = time.perf_counter()
+        try:
+            results = self.engine.generate(requests) if requests else []
+            error = None
+        except Exception as exc:
+            if self.on_error == "raise":
+                raise
+            logger.warning(f"Batch of {len(requests)} requests failed: {type(exc).__name__}: {exc}")
+            results, error = [None] * len(requests), inference_error(exc, 1)
+        elapsed = time.perf_counter() - start
+
+        # Requests of a batch are generated together, so each takes the batch's latency
+        for idx, request, result in zip(indices, requests, results):
+            outputs[idx] = {"result": result, "error": error}
+            get_metrics().record_request(elapsed, ok=error is None, subset=subsets[idx], grammar=request["grammar"])
+        get_metrics().flush()
+        return typed_inference_outputs(outputs, self.result_dtype, self.required_fields) if self.result_dtype is not None else outputs
+
+    def build_request(self,
+        text: str | None,
+        image: Any,
+        sampling_params: dict[str, Any] | None,
+        extra_body: dict[str, Any] | None,
+        ) -> dict[str, Any]:
+        """Maps OpenAI-style sampling params, including `response_format`, and vLLM extra_body
+        fields to an engine request."""
+        params = dict(sampling_params or {})
+        if "max_completion_tokens" in params:
+            params["max_tokens"] = params.pop("max_completion_tokens")
+        guided = {}
+        response_format = params.pop("response_format", None) or {}
+        if response_format.get("type") == "json_schema":
+            guided["json"] = response_format["json_schema"].get("schema", {})
+        elif response_format.get("type") == "json_object":
+            guided["json_object"] = True
+        elif response_format.get("type") == "structural_tag":
+            guided["structural_tag"] = json.dumps({k: v for k, v in response_format.items() if k != "type"})
+        for key, value in (extra_body or {}).items():
+            if key in GUIDED_DECODING_FIELDS:
+                guided[GUIDED_DECODING_FIELDS[key]] = value
+            else:
+                params[key] = value # e.g. top_k or stop
+        if "max_tokens" not in params and self.derive_max_tokens:
+            max_tokens = derive_max_tokens(extra_body)
+            if max_tokens is not None:
+                params["max_tokens"] = max_tokens
+        return {"text": text, "image": image, "sampling_params": params, "guided": guided}
+
+    @staticmethod
+    def decode_image(image: bytes | str | None, decoded: dict[Any, Any]) -> Any:
+        """Returns the PIL image of raw or base64 encoded image bytes, or None without one."""
+        if not image:
+            return None
+        if image not in decoded:
+            from PIL import Image
+
+            data = binascii.a2b_base64(image) if isinstance(image, str) else image
+            decoded[image] = Image.open(io.BytesIO(data)).convert("RGB")
+        return decoded[image]
+
+
+def b64encode_arrow(values: pa.Array) -> pa.LargeStringArray:
+    """Base64-encodes a binary Arrow array directly into an Arrow string array.
+
+    A Python loop encodes each value from a zero-copy view of the Arrow value buffer into a
+    `bytes` chunk, and the chunks are joined into one string buffer. This still builds a
+    `bytes` object and an offset `int` per row, but skips decoding every chunk to a `str` and
+    copying it into a new Arrow array.
+    """
+    values = values.cast(pa.large_binary())
+    _, offsets_buf, data = values.buffers()
+    offsets = pa.Array.from_buffers(
+        pa.int64(), len(values) + 1, [None, offsets_buf], offset=values.offset
+    ).to_pylist()
+    view = memoryview(data) if data is not None else memoryview(b"")
+
+    chunks = [binascii.b2a_base64(view[start:end], newline=False) for start, end in zip(offsets, offsets[1:])]
+    out_offsets = pa.array(itertools.accumulate((len(c) for c in chunks), initial=0), pa.int64())
+    validity = pc.is_valid(values).buffers()[1] if values.null_count else None
+
+    return pa.Array.from_buffers(
+        pa.large_string(),
+        len(values),
+        [validity, out_offsets.buffers()[1], pa.py_buffer(b"".join(chunks))],
+        null_count=values.null_count,
+    )
+
+
+@daft.udf(return_dtype=daft.DataType.string())
+def encode_unique_images_base64(image_hash: daft.Series, image_bytes: daft.Series) -> pa.Array:
+    """Base64-encodes each distinct image in the batch once and reuses the string for repeats."""
+    values = image_bytes.to_arrow()
+    slots: dict[tuple[int, int], int] = {}
+    unique_rows: list[int] = []
+    inverse: list[int] = []
+    for row, key in enumerate(zip(image_hash.to_pylist(), pc.binary_length(values).to_pylist())):
+        slot = slots.get(key)
+        if slot is None:
+            slot = slots[key] = len(unique_rows)
+            unique_rows.append(row)
+        inverse.append(slot)
+
+    if len(unique_rows) == len(values):
+        return b64encode_arrow(values)
+    return b64encode_arrow(values.take(pa.array(unique_rows))).take(pa.array(inverse))
+
+
+@daft.udf(return_dtype=daft.DataType.binary())
+def shrink_images(
+    image_hash: daft.Series,
+    image_bytes: daft.Series,
+    max_side: int,
+    image_format: str = "JPEG",
+    quality: int = 85,
+) -> list[bytes | None]:
+    """Downscales images to fit within `max_side` and re-encodes them at `quality`.
+
+    Aspect ratio is preserved and images are never upscaled. Each distinct image in the batch
+    is only decoded and re-encoded once. Images PIL cannot decode or re-encode are passed
+    through unchanged, as without `max_image_side`, rather than failing the batch.
+    """
+    from PIL import Image
+
+    shrunk: dict[tuple[int, int], bytes] = {}
+    results = []
+    bytes_in = bytes_out = failed = 0
+    for h, b in zip(image_hash.to_pylist(), image_bytes.to_pylist()):
+        if b is None:
+            results.append(None)
+            continue
+        key = (h, len(b))
+        if key not in shrunk:
+            try:
+                with Image.open(io.BytesIO(b)) as img:
+                    img.thumbnail((max_side, max_side))
+                    if image_format.upper() in ("JPEG", "JPG") and img.mode not in ("RGB", "L"):
+                        img = img.convert("RGB")
+                    buffer = io.BytesIO()
+                    img.save(buffer, format=image_format, quality=quality)
+                shrunk[key] = buffer.getvalue()
+            except (OSError, ValueError, Image.DecompressionBombError):
+                shrunk[key] = b
+                failed += 1
+            bytes_in += len(b)
+            bytes_out += len(shrunk[key])
+        results.append(shrunk[key])
+
+    if bytes_in:
+        logger.info(
+            f"Shrunk {len(shrunk) - failed} images from {bytes_in} to {bytes_out} bytes, "
+            f"saved {bytes_in - bytes_out} bytes ({1 - bytes_out / bytes_in:.1%})"
+            + (f", passed {failed} undecodable images through" if failed else "")
+        )
+    return results
 
-        return self.loop.run_until_complete(gather_completions(texts,images))
 
 class TheCauldronImageUnderstandingEvaluationPipeline:
-    def __init__(self, base_url: str, api_key: str):
+    def __init__(self,
+        base_url: str,
+        api_key: str,
+        cache_dir: str | None = None,
+        max_image_side: int | None = None,
+        image_format: str = "JPEG",
+        image_quality: int = 85,
+        checkpoint_dir: str | None = None,
+        endpoints: list[str] | None = None,
+        routing: str = "least_outstanding",
+        prefix_ordering: bool = False,
+        transport: str = "sdk",
+        max_tokens_in_flight: int | None = None,
+        backend: str = "openai",
+        engine_kwargs: dict[str, Any] | None = None,
+        engine_factory: Callable[..., Any] | None = None,
+        num_gpus: float | None = None,
+    ):
+        """
+        Args:
+            base_url: Base URL of the OpenAI-compatible server
+            api_key: API key for the server
+            cache_dir: Directory of an on-disk response cache shared by every run of the pipeline,
+                so re-running after changing `postprocess` or `evaluate` skips the server
+            max_image_side: If set, images are downscaled to fit within this many pixels and
+                re-encoded as `image_format` before base64 encoding
+            image_format: Pillow format used when re-encoding images, e.g. "JPEG" or "WEBP"
+            image_quality: Encoder quality used when re-encoding images
+            checkpoint_dir: Local directory completed results are persisted to as inference runs,
+                keyed by `row_id` in a subdirectory per inference configuration, see
+                `checkpoint_path`. A restarted run only sends the rows missing from it.
+            endpoints: Base URLs of several replicas of the server to load balance requests
+                across, with failing replicas ejected, see `EndpointPool`
+            routing: "least_outstanding" or "latency", how requests are routed to `endpoints`
+            prefix_ordering: Sort rows by image and prompt before inference, so requests sharing
+                a prefix reach the server back to back and hit vLLM's prefix cache. Rows are
+                returned in their original order. Both sorts materialize the rows.
+            transport: "sdk" or "http", how the inference UDF sends requests, see
+                `StructuredOutputsProdUDF`
+            max_tokens_in_flight: Cap on the estimated tokens in flight per inference UDF
+                instance, see `StructuredOutputsProdUDF`
+            backend: "openai" to send requests to the server at `base_url`, or "vllm" to run
+                an in-process vLLM engine per inference UDF instance on raw image bytes, see
+                `StructuredOutputsVLLMUDF`. Server options are ignored by the "vllm" backend.
+            engine_kwargs: Keyword arguments of `vllm.LLM` for the "vllm" backend
+            engine_factory: Engine of the "vllm" backend in place of `VLLMEngine`, e.g. a stub
+            num_gpus: GPUs per engine, by default `engine_kwargs["tensor_parallel_size"]` or 1
+        """
+        if backend not in ("openai", "vllm"):
+            raise ValueError(f"backend must be 'openai' or 'vllm', got {backend!r}")
         self.base_url = base_url
         self.api_key = api_key
+        self.cache_dir = cache_dir
+        self.max_image_side = max_image_side
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.checkpoint_dir = checkpoint_dir
+        self.endpoints = endpoints
+        self.routing = routing
+        self.prefix_ordering = prefix_ordering
+        self.transport = transport
+        self.max_tokens_in_flight = max_tokens_in_flight
+        self.backend = backend
+        self.engine_kwargs = engine_kwargs or {}
+        self.engine_factory = engine_factory
+        self.num_gpus = num_gpus if num_gpus is not None else self.engine_kwargs.get("tensor_parallel_size", 1)
+
+    @property
+    def image_mime_type(self) -> str:
+        if self.max_image_side is None:
+            return "image/png" # The cauldron stores images as png
+        image_format = self.image_format.lower()
+        return "image/jpeg" if image_format == "jpg" else f"image/{image_format}"
+
+    @property
+    def image_column(self) -> str:
+        """The preprocessed image column sent to inference: raw bytes for an in-process engine."""
+        return "image_bytes" if self.backend == "vllm" else "image_base64"
 
     def __call__(self,
         model_id: str,
@@ -93,6 +2479,8 @@ class TheCauldronImageUnderstandingEvaluationPipeline:
         concurrency: int = 4,
         row_limit: int | None = None,
         is_eager: bool = False,
+        output_dir: str | None = None,
+        instrument: bool = False,
     ) -> daft.DataFrame:
         """Executes dataset loading, preprocessing, inference, and post-processing.
         Evalutation must be run seperately since it requires materialization. 
@@ -101,10 +2489,21 @@ class TheCauldronImageUnderstandingEvaluationPipeline:
             model_id: The ID of the model to use
             dataset_uri: The URI of the dataset to use
             sampling_params: The sampling parameters to use
-            concurrency: The number of concurrent requests to make
+            concurrency: The number of concurrent inference UDF instances
             row_limit: The number of rows to limit the dataset to
             is_eager: Whether to eager load the dataset
+            output_dir: If set, runs in streaming mode (see `run_streaming`) and returns a
+                DataFrame reading the results written to this directory
+            instrument: Whether to record per-stage metrics into `get_metrics()` as the lazy
+                DataFrame executes, see `instrument`
         """
+        if instrument:
+            self._reset_spooled_metrics()
+
+        if output_dir is not None:
+            return self.run_streaming(
+                model_id, dataset_uri, output_dir, sampling_params, concurrency, row_limit
+            )
 
         if is_eager:
             # Load Dataset and Materialize
@@ -117,21 +2516,224 @@ class TheCauldronImageUnderstandingEvaluationPipeline:
             df = self._log_processing_time(df)
 
             # Perform Inference
-            df = self.infer(df, model_id, sampling_params)
+            df = self.infer(df, model_id, sampling_params, concurrency)
             df = self._log_processing_time(df)
 
             # Post-Process
             df = self.postprocess(df)
             df = self._log_processing_time(df)
+        elif instrument:
+            df = self.load_dataset(dataset_uri)
+            df = df.limit(row_limit) if row_limit else df
+            df = self.instrument(df, "load_dataset", "images")
+            df = self.instrument(self.preprocess(df), "preprocess", self.image_column)
+            df = self.instrument(self.infer(df, model_id, sampling_params, concurrency), "infer", "result")
+            df = self.instrument(self.postprocess(df), "postprocess", "is_correct")
         else:
             df = self.load_dataset(dataset_uri)
             df = self.preprocess(df)
-            df = self.infer(df, model_id, sampling_params)
+            df = self.infer(df, model_id, sampling_params, concurrency)
             df = self.postprocess(df)
             df = df.limit(row_limit) if row_limit else df
 
         return df
 
+    def run_subsets(self,
+        model_id: str,
+        dataset_uris: dict[str, str],
+        sampling_params: dict[str,Any] | None = None,
+        concurrency: int = 4,
+        row_limit: int | None = None,
+    ) -> daft.DataFrame:
+        """Evaluates several dataset subsets, e.g. of the_cauldron, in a single lazy Daft job.
+
+        Rows carry a `subset` column through the pipeline and are interleaved round-robin
+        across subsets before inference (see `interleave_subsets`), so every batch mixes the
+        subsets and they progress together rather than one after another. Within a batch the
+        inference UDF issues requests round-robin across subsets, and the request limiter of
+        each worker process grants its slots round-robin across them. Workers do not
+        coordinate with each other. Runs on whichever runner Daft is configured with (e.g.
+        DAFT_RUNNER=ray). Use `evaluate_subsets` for per-subset accuracy and throughput.
+
+        Args:
+            model_id: The ID of the model to use
+            dataset_uris: Subset name to the URI of its Parquet files
+            sampling_params: The sampling parameters to use
+            concurrency: The number of concurrent inference UDF instances
+            row_limit: The number of source rows to limit each subset to
+        """
+        self._reset_spooled_metrics()
+        df = self.load_subsets(dataset_uris, row_limit)
+        # Drop the raw image and text columns before the sort materializes the rows
+        df = self.interleave_subsets(self._exclude_raw_columns(self.preprocess(df)))
+        df = self.infer(df, model_id, sampling_params if sampling_params is not None else {"temperature": 0.0}, concurrency)
+        return self.postprocess(df)
+
+    def sweep(self,
+        dataset_uri: str,
+        configs: dict[str, dict[str, Any]],
+        concurrency: int = 4,
+        row_limit: int | None = None,
+        prepared_path: str | None = None,
+    ) -> daft.DataFrame:
+        """Compares inference configurations on the same preprocessed rows.
+
+        Rows are loaded and preprocessed once (see `prepare`). Every row is then paired with
+        every configuration and sent through a single inference job, so all configurations
+        progress together, share the in-flight window fairly and see the same server load.
+
+        Args:
+            dataset_uri: The URI of the dataset to use
+            configs: Configuration name to its `model_id` and optionally `sampling_params`,
+                `extra_body` and `base_url`, e.g.
+                `{"t0": {"model_id": "google/gemma-3n-e4b-it", "sampling_params": {"temperature": 0.0}}}`
+            concurrency: The number of concurrent inference UDF instances
+            row_limit: The number of source rows to limit the dataset to
+            prepared_path: Local directory to persist the preprocessed rows to as Parquet and
+                reuse them from on later sweeps of the same dataset and row limit, see
+                `prepare`. By default they are kept in memory.
+
+        Returns:
+            One row per configuration with its accuracy, failed rows, request throughput and
+            latency percentiles.
+        """
+        for name, config in configs.items():
+            if "model_id" not in config:
+                raise ValueError(f"Sweep config {name!r} has no model_id")
+
+        prepared = self.prepare(dataset_uri, row_limit, prepared_path)
+        self._reset_spooled_metrics()
+        df = prepared.with_column("config", lit(list(configs))).explode("config")
+        df = df.with_column("row_id", col("config").hash(seed=col("row_id"))) # Checkpoint each config separately
+        df = self.infer(df, concurrency=concurrency, configs=configs)
+        df = self.postprocess(df, configs=configs)
+
+        start = time.time()
+        rows = self.evaluate_metrics(df, by=["config"]).to_pylist()
+        elapsed = time.time() - start
+        logger.info(f"Swept {len(configs)} configs over {prepared.count_rows()} rows in {elapsed:.2f} sec")
+
+        requests = get_metrics().report().get("subsets", {})
+        rows = {row["config"]: row for row in rows}
+        return daft.from_pylist([
+            {
+                "config": name,
+                "model_id": config["model_id"],
+                "base_url": config.get("base_url", self.base_url),
+                "sampling_params": json.dumps(config.get("sampling_params", {}), sort_keys=True),
+                "rows": rows[name]["rows"],
+                "accuracy": rows[name]["accuracy"],
+                "failed": rows[name]["null_results"],
+                **{k: requests.get(name, {}).get(k) for k in ("requests_per_s", "latency_p50_s", "latency_p99_s")},
+            }
+            for name, config in configs.items()
+        ])
+
+    def prepare(self, dataset_uri: str, row_limit: int | None = None, path: str | None = None) -> daft.DataFrame:
+        """Returns the materialized output of `load_dataset` and `preprocess`, ready for `infer`.
+
+        The raw image columns are dropped once encoded. With `path`, the rows are written as
+        Parquet on first use to a subdirectory keyed by the dataset, row limit and image
+        settings, and read back from it by later calls with the same inputs.
+        """
+        if path is not None:
+            inputs = {
+                "dataset_uri": dataset_uri,
+                "row_limit": row_limit,
+                "max_image_side": self.max_image_side,
+                "image_format": self.image_format,
+                "image_quality": self.image_quality,
+                "backend": self.backend,
+            }
+            path = os.path.join(path, hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16])
+        if path is not None and os.path.isdir(path) and any(n.endswith(".parquet") for n in os.listdir(path)):
+            return daft.read_parquet(os.path.join(path, "*.parquet"))
+
+        df = self.load_dataset(dataset_uri)
+        df = df.limit(row_limit) if row_limit else df
+        df = self._exclude_raw_columns(self.preprocess(df))
+        if path is None:
+            return df.collect()
+        df.write_parquet(path)
+        return daft.read_parquet(os.path.join(path, "*.parquet"))
+
+    def _exclude_raw_columns(self, df: daft.DataFrame) -> daft.DataFrame:
+        # The raw images and texts are not needed once `preprocess` has encoded them
+        return df.exclude(*[c for c in ("images", "image_bytes", "texts") if c in df.column_names and c != self.image_column])
+
+    @staticmethod
+    def _reset_spooled_metrics() -> None:
+        # Per-request metrics from UDF worker processes are spooled to a shared directory,
+        # which `infer` passes to the inference UDFs
+        metrics = get_metrics()
+        metrics.spool_to_temporary_dir()
+        metrics.reset()
+
+    def run_streaming(self,
+        model_id: str,
+        dataset_uri: str,
+        output_dir: str,
+        sampling_params: dict[str,Any] | None = None,
+        concurrency: int = 4,
+        row_limit: int | None = None,
+        chunk_rows: int = DEFAULT_STREAMING_CHUNK_ROWS,
+    ) -> daft.DataFrame:
+        """Runs load -> preprocess -> infer -> postprocess as one lazy plan and writes its
+        output as it streams out.
+
+        Source rows flow through in batches of `chunk_rows`, so memory stays bounded by the
+        batch size rather than the dataset, while a single inference actor pool serves the
+        whole run. Each partition the plan yields is written to `output_dir` as a Parquet
+        file, without the image payload columns, replacing the files of an earlier run. Per-stage timings are recorded by the
+        `instrument` probes and logged at the end.
+
+        Args:
+            model_id: The ID of the model to use
+            dataset_uri: The URI of the dataset to use
+            output_dir: Local directory the Parquet results are written to
+            sampling_params: The sampling parameters to use
+            concurrency: The number of concurrent inference UDF instances
+            row_limit: The number of source rows to limit the dataset to
+            chunk_rows: The number of source rows per batch
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        # Chunks of an earlier run would otherwise be read back with this run's
+        for name in os.listdir(output_dir):
+            if name.startswith("part-") and name.endswith(".parquet"):
+                os.remove(os.path.join(output_dir, name))
+        sampling_params = sampling_params if sampling_params is not None else {"temperature": 0.0}
+        get_metrics().reset()
+
+        df = self.load_dataset(dataset_uri)
+        df = df.limit(row_limit) if row_limit else df
+        df = self.instrument(df.into_batches(chunk_rows), "load_dataset", "images")
+        df = self.instrument(self.preprocess(df), "preprocess", self.image_column)
+        df = self.instrument(self.infer(df, model_id, sampling_params, concurrency), "infer", "result")
+        df = self.instrument(self.postprocess(df), "postprocess", "is_correct")
+        df = df.exclude(*[c for c in STREAMING_DROP_COLUMNS if c in df.column_names])
+
+        num_chunks = 0
+        for partition in df.iter_partitions():
+            result = partition.to_arrow()
+            if not result.num_rows:
+                continue
+            pq.write_table(result, os.path.join(output_dir, f"part-{num_chunks:05d}.parquet"))
+            num_chunks += 1
+            logger.info(f"Wrote chunk {num_chunks} ({result.num_rows} rows) to {output_dir}")
+
+        for stage, stats in get_metrics().report()["stages"].items():
+            logger.info(f"{stage}: {stats['rows']} rows in {stats['elapsed_s']:.2f} sec, {stats['rows_per_s']:.2f} rows/s")
+        return daft.read_parquet(os.path.join(output_dir, "*.parquet"))
+
+    @staticmethod
+    def instrument(df: daft.DataFrame, stage: str, column: str) -> daft.DataFrame:
+        """Records rows and bytes of `column` for every batch that flows out of `stage`.
+
+        The column is passed through an identity UDF, so the plan stays lazy and streaming.
+        """
+        probe = daft.udf(return_dtype=df.schema()[column].dtype)(_probe_stage)
+        return df.with_column(column, probe(col(column), stage=stage))
+
     @staticmethod
     def _log_processing_time(df: daft.DataFrame):
         start = time.time()
@@ -144,16 +2746,53 @@ class TheCauldronImageUnderstandingEvaluationPipeline:
     def load_dataset(self, uri: str) -> daft.DataFrame:
         return daft.read_parquet(uri)
 
+    def load_subsets(self, uris: dict[str, str], row_limit: int | None = None) -> daft.DataFrame:
+        """Loads each subset's Parquet files into one DataFrame with a `subset` column."""
+        dfs = []
+        for subset, uri in uris.items():
+            df = self.load_dataset(uri)
+            df = df.limit(row_limit) if row_limit else df
+            dfs.append(df.with_column("subset", lit(subset)))
+        return functools.reduce(daft.DataFrame.concat, dfs)
+
+    @staticmethod
+    def interleave_subsets(df: daft.DataFrame) -> daft.DataFrame:
+        """Orders rows round-robin across their `subset`: the first row of every subset, then
+        the second, and so on.
+
+        Subsets are scanned one after another, so without this a batch rarely holds more than
+        one subset. Sorting materializes the rows, and `prefix_ordering` reorders them again.
+        """
+        df = df.with_column("_subset_order", monotonically_increasing_id())
+        df = df.with_column("_subset_rank", row_number().over(Window().partition_by("subset").order_by("_subset_order")))
+        return df.sort(["_subset_rank", "subset"]).exclude("_subset_order", "_subset_rank")
+
     def preprocess(self, df: daft.DataFrame) -> daft.DataFrame:
 
-        # Convert png image byte string to base64
-        df = df.explode(col("images")).with_column("image_base64", df["images"].struct.get("bytes").apply(
-        lambda x: base64.b64encode(x).decode('utf-8'),
-        return_dtype=daft.DataType.string()
-            )
-        )
+        # Hash each image once so identical images share a single base64 encoding
+        df = df.explode(col("images")).with_column("image_hash", col("images").struct.get("bytes").hash())
+        image_bytes = col("images").struct.get("bytes")
 
-        # Explode Lists of User Prompts and Assistant Answer Pairs
+        # Optionally shrink images before encoding to cut request size and server-side decode time
+        if self.max_image_side is not None:
+            df = df.with_column("image_bytes", shrink_images(
+                col("image_hash"),
+                image_bytes,
+                max_side=self.max_image_side,
+                image_format=self.image_format,
+                quality=self.image_quality,
+            ))
+            df = df.with_column("image_bytes_saved", image_bytes.binary.length() - col("image_bytes").binary.length())
+            image_bytes = col("image_bytes")
+
+        # Convert image byte string to base64, unless an in-process engine takes the bytes as is
+        if self.backend == "vllm":
+            df = df.with_column("image_bytes", image_bytes)
+        else:
+            df = df.with_column("image_base64", encode_unique_images_base64(col("image_hash"), image_bytes))
+
+        # Explode Lists of User Prompts and Assistant Answer Pairs.
+        # Encoding happens before this explode so every question of an image reuses its payload.
         df = df.explode(col("texts")).with_columns({
             "user": df["texts"].struct.get("user"),
             "assistant": df["texts"].struct.get("assistant")
@@ -173,35 +2812,366 @@ class TheCauldronImageUnderstandingEvaluationPipeline:
                 .str.extract(r"Answer:\s*(.*)$")
                 .str.replace("Answer:",""),
         })
+
+        # Stable id of each (image, question) pair, used to resume checkpointed runs
+        df = df.with_column("row_id", col("user").hash(seed=col("image_hash")))
         return df
 
+    def checkpoint_path(self,
+        model_id: str,
+        sampling_params: dict[str, Any] | None,
+        extra_body: dict[str, Any] | None,
+        configs: dict[str, dict[str, Any]] | None = None,
+    ) -> str | None:
+        """The subdirectory of `checkpoint_dir` holding the results of one inference
+        configuration, so runs with another model, sampling params, guided decoding fields or
+        image settings do not read each other's results."""
+        if self.checkpoint_dir is None:
+            return None
+        config = {
+            "model_id": model_id,
+            "sampling_params": sampling_params,
+            "extra_body": extra_body,
+            "configs": configs,
+            "backend": self.backend,
+            "max_image_side": self.max_image_side,
+            "image_format": self.image_format,
+            "image_quality": self.image_quality,
+        }
+        fingerprint = hashlib.sha256(json.dumps(config, sort_keys=True, default=repr).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.checkpoint_dir, fingerprint)
+
+    def load_checkpoint(self, path: str | None) -> daft.DataFrame | None:
+        """Returns the `row_id` and latest `result` of every row completed by previous runs in
+        the checkpoint at `path`, see `checkpoint_path`, if any."""
+        if path is None:
+            return None
+        os.makedirs(path, exist_ok=True)
+        if not any(name.endswith(".parquet") for name in os.listdir(path)):
+            return None
+        done = daft.read_parquet(os.path.join(path, "*.parquet"))
+        # The latest result of a row wins, e.g. one resent by `retry_invalid`
+        latest = done.groupby("row_id").agg(col("checkpointed_at").max().alias("_latest"))
+        done = done.join(latest, on="row_id").where(col("checkpointed_at") == col("_latest"))
+        return done.groupby("row_id").agg(col("result").any_value())
+
     def infer(self,
         df: daft.DataFrame,
         model_id: str = 'google/gemma-3n-e4b-it',
         sampling_params: dict[str,Any] = {"temperature": 0.0},
         concurrency: int = 4,
-        extra_body: dict[str, Any] = {"guided_choice": ["A", "B", "C", "D"]}
+        extra_body: dict[str, Any] = {"guided_choice": ANSWER_CHOICES},
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        process_max_in_flight: int = DEFAULT_PROCESS_MAX_IN_FLIGHT,
+        background_loop: bool = False,
+        adaptive_concurrency: bool = False,
+        configs: dict[str, dict[str, Any]] | None = None,
+        resend: bool = False,
+        response_model: type | None = None,
     ) -> daft.DataFrame:
+        """Adds a `result` column with the model's structured output for each row, and an
+        `error` column describing why `result` is null for rows that failed every retry.
+
+        With a `checkpoint_dir`, rows completed by earlier runs with the same configuration
+        are read back from it instead of being sent to the server, and newly completed rows
+        are appended to it.
+
+        Args:
+            concurrency: The number of UDF instances
+            max_in_flight: Cap on in-flight requests per UDF instance
+            process_max_in_flight: Cap on in-flight requests shared by all UDF instances in a process
+            background_loop: Submit batches to a process-wide long-lived event loop without
+                waiting for their tails, so requests of consecutive batches are in flight
+                together, see `submit_inference`. Inference then runs in the driver process
+                of the native runner instead of `concurrency` worker processes. Raises
+                ValueError on other runners, e.g. Ray.
+            adaptive_concurrency: Tune each UDF instance's in-flight requests (up to `max_in_flight`)
+                from observed latency and server rejections
+            configs: Overrides of `model_id`, `sampling_params`, `extra_body` and `base_url`
+                keyed by name, applied to each row according to its `config` column, see `sweep`
+            resend: Send every row to the server without reading the response cache or the
+                checkpoint. The new results are still written to both, replacing the earlier
+                ones for later runs, see `retry_invalid`
+            response_model: Pydantic model to constrain outputs to with a `json_schema` response
+                format, in place of the guided decoding fields of `extra_body`. `result` is
+                then a struct of the model's fields, null where the output does not parse.
+                Checkpoints hold string results and are not supported.
+        """
+        if response_model is not None:
+            if self.checkpoint_dir is not None and not resend:
+                raise ValueError("response_model does not support checkpoint_dir")
+            sampling_params = {"response_format": response_format_for(response_model), **(sampling_params or {})}
+            extra_body = {k: v for k, v in (extra_body or {}).items() if k not in GUIDED_DECODING_FIELDS}
+
+        # Dispatch rows sharing an image, then a prompt prefix, contiguously
+        if self.prefix_ordering:
+            df = df.with_column("_row_order", monotonically_increasing_id())
+            df = df.sort([col("image_hash"), format("{} \n {}", col("question"), col("choices_string"))])
 
-        return df.with_column("result", StructuredOutputsProdUDF.with_init_args(
-            base_url=self.base_url,
-            api_key=self.api_key,
-        ).with_concurrency(concurrency)(
+        # Skip rows a previous run with the same configuration already completed
+        checkpoint_path = self.checkpoint_path(model_id, sampling_params, extra_body, configs) if response_model is None else None
+        done = self.load_checkpoint(checkpoint_path) if not resend else None
+        if done is not None:
+            finished = df.join(done, on="row_id")
+            df = df.join(done.select("row_id"), on="row_id", how="anti")
+
+        if self.backend == "vllm":
+            udf = StructuredOutputsVLLMUDF.with_init_args(
+                model_id=model_id,
+                engine_kwargs=self.engine_kwargs,
+                engine_factory=self.engine_factory,
+                metrics_dir=get_metrics().events_dir,
+            ).override_options(num_gpus=self.num_gpus or None)
+        else:
+            udf = StructuredOutputsProdUDF.with_init_args(
+                base_url=self.base_url,
+                api_key=self.api_key,
+                max_in_flight=max_in_flight,
+                process_max_in_flight=process_max_in_flight,
+                background_loop=background_loop,
+                cache_dir=self.cache_dir,
+                read_cache=not resend,
+                adaptive_concurrency=adaptive_concurrency,
+                endpoints=self.endpoints,
+                routing=self.routing,
+                transport=self.transport,
+                max_tokens_in_flight=self.max_tokens_in_flight,
+                metrics_dir=get_metrics().events_dir,
+            )
+        if response_model is not None:
+            udf = with_response_model(udf, response_model)
+        request_kwargs = dict(
             model_id = model_id,
             text_col = format("{} \n {}", col("question"), col("choices_string")), # Prompt Template
-            image_col = col("image_base64"),
+            image_col = col(self.image_column),
             sampling_params = sampling_params,
-            extra_body=extra_body
-        ))
-
+            extra_body=extra_body,
+            image_mime_type=self.image_mime_type,
+            subset_col=col("config") if configs else col("subset") if "subset" in df.column_names else None,
+            config_col=col("config") if configs else None,
+            configs=configs,
+        )
+        if background_loop and self.backend != "vllm":
+            runner = daft.context.get_context().get_or_infer_runner_type()
+            if runner != "native":
+                raise ValueError(
+                    f"background_loop requires the native runner, which runs submit_inference and "
+                    f"collect_inference in the same process, not the {runner} runner"
+                )
+            init_args = udf.init_args[1]
+            df = df.with_column("_ticket", submit_inference(
+                init_args=init_args, max_queued_rows=2 * max_in_flight, **request_kwargs
+            ))
+            collect = dataclasses.replace(collect_inference, return_dtype=udf.return_dtype)
+            typed = {
+                "result_dtype": response_model_dtype(response_model),
+                "required": required_fields(response_model.model_json_schema()),
+            } if response_model is not None else {}
+            df = df.with_column("inference", collect(col("_ticket"), **typed)).exclude("_ticket")
+        else:
+            df = df.with_column("inference", udf.with_concurrency(concurrency)(**request_kwargs))
+        if checkpoint_path is not None:
+            df = df.with_column("inference", checkpoint_inference(
+                col("row_id"), col("inference"), checkpoint_dir=checkpoint_path
+            ))
+        df = df.with_columns({
+            "result": col("inference").struct.get("result"),
+            "error": col("inference").struct.get("error"),
+        }).exclude("inference")
 
-    def postprocess(self, df: daft.DataFrame) -> daft.DataFrame:
-        df = df.with_column("is_correct", col("result").str.lstrip().str.rstrip() == col("answer").str.lstrip().str.rstrip())
+        if done is not None:
+            finished = finished.with_column("error", lit(None).cast(INFERENCE_ERROR_DTYPE))
+            df = finished.select(*df.column_names).concat(df)
+        if self.prefix_ordering:
+            df = df.sort("_row_order").exclude("_row_order")
         return df
 
+
+    def postprocess(self,
+        df: daft.DataFrame,
+        extra_body: dict[str, Any] | None = None,
+        sampling_params: dict[str, Any] | None = None,
+        configs: dict[str, dict[str, Any]] | None = None,
+    ) -> daft.DataFrame:
+        """Adds `is_correct` and the `validate` columns, checking each row against the
+        `extra_body`, `sampling_params` or `configs` it was inferred with. Struct results of a
+        `response_model` are not compared with `answer` and get no `is_correct`."""
+        if not df.schema()["result"].dtype.is_struct():
+            df = df.with_column("is_correct", col("result").str.lstrip().str.rstrip() == col("answer").str.lstrip().str.rstrip())
+        return self.validate(df, extra_body, (sampling_params or {}).get("response_format"), configs)
+
+    def validate(self,
+        df: daft.DataFrame,
+        extra_body: dict[str, Any] | None = None,
+        response_format: dict[str, Any] | None = None,
+        configs: dict[str, dict[str, Any]] | None = None,
+    ) -> daft.DataFrame:
+        """Adds `is_valid`, whether `result` satisfies the structured output constraint, and
+        `parsed`, the result as a typed value.
+
+        Choices and regexes are checked with Daft expressions. JSON schemas are checked by
+        `validate_json_schema`, which needs `jsonschema`, and parsed into structs by Daft's
+        JSON deserializer. Struct results, parsed by `infer` for a `response_model`, are
+        already null where the output lacks a required field, so they are valid unless null
+        and are their own `parsed` value. Null results are invalid.
+
+        Args:
+            df: DataFrame with a `result` column
+            extra_body: The vLLM guided decoding fields the results were generated with,
+                defaults to the `guided_choice` of `infer`
+            response_format: The OpenAI `json_schema` response format the results were
+                generated with, instead of `extra_body`
+            configs: The `sweep` configurations the rows of each `config` were generated with,
+                whose `extra_body` and `sampling_params` override the arguments above. When
+                their constraints differ, `parsed` is the untyped result.
+        """
+        if df.schema()["result"].dtype.is_struct():
+            return df.with_columns({"is_valid": col("result").not_null(), "parsed": col("result")})
+        if not configs:
+            is_valid, parsed = constraint_checks(extra_body, response_format)
+            return df.with_columns({"is_valid": is_valid.fill_null(False), "parsed": parsed})
+
+        constraints = {
+            name: (
+                config.get("extra_body", extra_body),
+                config.get("sampling_params", {}).get("response_format", response_format),
+            )
+            for name, config in configs.items()
+        }
+        if len({json.dumps(constraint, sort_keys=True) for constraint in constraints.values()}) == 1:
+            return self.validate(df, *next(iter(constraints.values())))
+        is_valid = lit(False)
+        for name, constraint in constraints.items():
+            is_valid = (col("config") == name).if_else(constraint_checks(*constraint)[0], is_valid)
+        return df.with_columns({"is_valid": is_valid.fill_null(False), "parsed": col("result")})
+
+    def retry_invalid(self,
+        df: daft.DataFrame,
+        model_id: str = 'google/gemma-3n-e4b-it',
+        sampling_params: dict[str, Any] | None = None,
+        concurrency: int = 4,
+        extra_body: dict[str, Any] | None = None,
+    ) -> daft.DataFrame:
+        """Sends only the rows of a postprocessed `df` that are not `is_valid` to the server
+        again, without reading the response cache or checkpoint, and revalidates them.
+
+        `df` is materialized first, so valid rows are not inferred again, and comes back with
+        its valid rows first. At temperature 0 a server usually repeats its output, so pass
+        sampling params that resample, or a larger `max_tokens` for outputs cut short. The new
+        results replace the old ones in the cache and checkpoint of the request they were
+        sent with, so later runs with the same `sampling_params` and `extra_body` reuse them.
+        """
+        inference_columns = ["result", "error", "is_correct", "is_valid", "parsed"]
+        extra_body = extra_body if extra_body is not None else {"guided_choice": ANSWER_CHOICES}
+        df = df.collect()
+        valid = df.where(col("is_valid"))
+        invalid = df.where(~col("is_valid")).exclude(*inference_columns)
+        retried = self.infer(
+            invalid,
+            model_id,
+            sampling_params if sampling_params is not None else {"temperature": 0.0},
+            concurrency,
+            extra_body,
+            resend=True,
+        )
+        retried = self.postprocess(retried, extra_body, sampling_params)
+        return valid.concat(retried.select(*df.column_names))
+
     def evaluate(self, df: daft.DataFrame) -> float:
-        pass_fail_rate = df.where(col("is_correct")).count_rows() / df.count_rows()
-        return pass_fail_rate
+        return self.evaluate_metrics(df).to_pydict()["accuracy"][0]
+
+    def evaluate_metrics(self,
+        df: daft.DataFrame,
+        by: list[str] | None = None,
+        choices: list[str] | None = None,
+    ) -> daft.DataFrame:
+        """Computes accuracy, null and invalid output rates and confusion matrices in one pass.
+
+        Rows are counted per (`by`..., answer, prediction) in a single grouped aggregation, so
+        a lazy `df` runs inference once, and every metric is rolled up from those counts.
+        Struct results of a `response_model` are not compared with `answer`, so their
+        `correct` and `accuracy` are null and their `confusion` is empty.
+
+        Args:
+            df: Output of `postprocess`
+            by: Columns to break the metrics down by, e.g. ["subset"] or ["config"]
+            choices: Valid outputs, others count as invalid, when `df` has no `is_valid` column
+                from `validate`. Defaults to `ANSWER_CHOICES`.
+
+        Returns:
+            One row per group, or a single row without `by`, with `rows`, `correct`,
+            `accuracy`, `null_results`, `null_rate`, `invalid_results`, `invalid_rate` and
+            `confusion`, a list of `{answer, prediction, count}` structs.
+        """
+        by = list(by or [])
+        choices = set(choices if choices is not None else ANSWER_CHOICES)
+        structs = df.schema()["result"].dtype.is_struct()
+        if structs:
+            answers = predictions = lit(None).cast(daft.DataType.string())
+            valid = col("result").not_null()
+        else:
+            answers, predictions = col("answer").str.lstrip().str.rstrip(), col("result").str.lstrip().str.rstrip()
+            valid = constraint_checks({"guided_choice": sorted(choices)})[0].fill_null(False)
+        counts = df.with_columns({
+            "_answer": answers,
+            "_prediction": predictions,
+            "_null": col("result").is_null(),
+            "_valid": col("is_valid") if "is_valid" in df.column_names else valid,
+        }).groupby(*by, "_answer", "_prediction", "_null", "_valid").agg(col("_null").count("all").alias("count")).to_pylist()
+
+        groups: dict[tuple, dict[str, Any]] = {}
+        if not by:
+            groups[()] = {"rows": 0, "correct": 0, "null_results": 0, "invalid_results": 0, "confusion": {}}
+        for row in counts:
+            key = tuple(row[c] for c in by)
+            group = groups.setdefault(key, {
+                **{c: row[c] for c in by}, "rows": 0, "correct": 0, "null_results": 0, "invalid_results": 0, "confusion": {},
+            })
+            answer, prediction, count = row["_answer"], row["_prediction"], row["count"]
+            group["rows"] += count
+            if row["_null"]:
+                group["null_results"] += count
+            elif not row["_valid"]:
+                group["invalid_results"] += count
+            if prediction is not None and prediction == answer:
+                group["correct"] += count
+            if not structs:
+                group["confusion"][answer, prediction] = group["confusion"].get((answer, prediction), 0) + count
+
+        metrics = []
+        for key in sorted(groups, key=lambda key: [(v is None, str(v)) for v in key]):
+            group = groups[key]
+            rows = group["rows"]
+            confusion = [{"answer": answer, "prediction": prediction, "count": count} for (answer, prediction), count in group["confusion"].items()]
+            confusion.sort(key=lambda c: (str(c["answer"]), c["prediction"] is None, str(c["prediction"])))
+            metrics.append({
+                **{c: group[c] for c in by},
+                "rows": rows,
+                "correct": None if structs else group["correct"],
+                "accuracy": group["correct"] / rows if rows and not structs else None,
+                "null_results": group["null_results"],
+                "null_rate": group["null_results"] / rows if rows else None,
+                "invalid_results": group["invalid_results"],
+                "invalid_rate": group["invalid_results"] / rows if rows else None,
+                "confusion": confusion,
+            })
+        return daft.from_pylist(metrics)
+
+    def evaluate_subsets(self, df: daft.DataFrame) -> dict[str, dict[str, Any]]:
+        """Returns accuracy and failed requests per subset, with request throughput when recorded."""
+        rows = self.evaluate_metrics(df, by=["subset"]).to_pylist()
+        throughput = get_metrics().report().get("subsets", {})
+
+        report = {}
+        for row in rows:
+            report[row["subset"]] = {
+                "rows": row["rows"],
+                "accuracy": row["accuracy"],
+                "failed": row["null_results"],
+                "invalid": row["invalid_results"],
+                **{k: throughput.get(row["subset"], {}).get(k) for k in ("requests_per_s", "latency_p50_s", "latency_p99_s")},
+            }
+        return report
 
 if __name__ == "__main__":
     # Load Environment Variables 
@@ -213,7 +3183,14 @@ if __name__ == "__main__":
     # Define Variables
     model_id = os.getenv("MODEL_ID") or 'google/gemma-3n-e4b-it'
     base_url = os.getenv("OPENAI_BASE_URL") or "http://localhost:8000"
+    endpoints = [u for u in os.getenv("OPENAI_BASE_URLS", "").split(",") if u] or None # Optional, vLLM replicas
     api_key = os.getenv("OPENAI_API_KEY")
+    cache_dir = os.getenv("RESPONSE_CACHE_DIR") # Optional, e.g. ".cache/responses"
+    max_image_side = int(os.getenv("MAX_IMAGE_SIDE", 0)) or None # Optional, e.g. 768
+    metrics_path = os.getenv("METRICS_PATH") # Optional, e.g. "metrics/run.json" or "metrics/run.parquet"
+    checkpoint_dir = os.getenv("CHECKPOINT_DIR") # Optional, e.g. ".checkpoints/ai2d"
+    subsets = [s for s in os.getenv("SUBSETS", "").split(",") if s] # Optional, e.g. "ai2d,chartqa,scienceqa"
+    backend = os.getenv("INFERENCE_BACKEND") or "openai" # Optional, "vllm" runs the model in-process
     dataset_uri = 'hf://datasets/HuggingFaceM4/the_cauldron/ai2d/train-00000-of-00001-2ce340398c113b79.parquet' # 7462 rows
     concurrency = 4
     row_limit = 10
@@ -221,9 +3198,26 @@ if __name__ == "__main__":
     # Instantiate the pipeline
     pipeline = TheCauldronImageUnderstandingEvaluationPipeline(
         api_key  = api_key, 
-        base_url = base_url
+        base_url = base_url,
+        cache_dir = cache_dir,
+        max_image_side = max_image_side,
+        checkpoint_dir = checkpoint_dir,
+        endpoints = endpoints,
+        backend = backend,
     )
 
+    if subsets:
+        # Evaluate several cauldron subsets in one job
+        df = pipeline.run_subsets(
+            model_id = model_id,
+            dataset_uris = {s: f"hf://datasets/HuggingFaceM4/the_cauldron/{s}/*.parquet" for s in subsets},
+            row_limit = row_limit,
+            concurrency = concurrency,
+        ).collect()
+        for subset, subset_report in pipeline.evaluate_subsets(df).items():
+            print(f"{subset}: {subset_report}")
+        raise SystemExit(0)
+
     # Run the pipeline 
     df = pipeline(
         model_id = model_id, 
@@ -232,14 +3226,19 @@ if __name__ == "__main__":
         row_limit = row_limit,
         concurrency = concurrency,
         is_eager=False, # Helpful for debugging
+        instrument=metrics_path is not None,
     )
 
     # Materialize the dataframe
     df = df.collect() # Optionally measure performance with pipeline._log_processing_time(df)
 
+    if metrics_path:
+        get_metrics().write_report(metrics_path)
+
     # Evaluate the results
-    pass_fail_rate = pipeline.evaluate(df)
-    print(f"Pass/Fail Rate: {pass_fail_rate}")
+    metrics = pipeline.evaluate_metrics(df).to_pylist()[0]
+    print(f"Pass/Fail Rate: {metrics['accuracy']}")
+    print(f"Null/Invalid Rate: {metrics['null_rate']}/{metrics['invalid_rate']}")
 
 
 